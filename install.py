@@ -37,6 +37,7 @@ TRANSLATIONS = ('ca', 'cs', 'de', 'es', 'fr', 'gl', 'hr', 'hu', 'id', 'ja',
 # Files to be installed, as (source file, destination directory)
 FILES = (('src/about.py', 'share/comix/src'),
          ('src/archive.py', 'share/comix/src'),
+         ('src/archiveindex.py', 'share/comix/src'),
          ('src/bookmark.py', 'share/comix/src'),
          ('src/comix.py', 'share/comix/src'),
          ('src/comicthumb.py', 'share/comix/src'),
@@ -53,23 +54,28 @@ FILES = (('src/about.py', 'share/comix/src'),
          ('src/histogram.py', 'share/comix/src'),
          ('src/icons.py', 'share/comix/src'),
          ('src/image.py', 'share/comix/src'),
+         ('src/imagesize.py', 'share/comix/src'),
          ('src/labels.py', 'share/comix/src'),
          ('src/lens.py', 'share/comix/src'),
          ('src/library.py', 'share/comix/src'),
          ('src/librarybackend.py', 'share/comix/src'),
          ('src/main.py', 'share/comix/src'),
          ('src/mobiunpack.py', 'share/comix/src'),
+         ('src/pixbufcache.py', 'share/comix/src'),
          ('src/portability.py', 'share/comix/src'),
          ('src/preferences.py', 'share/comix/src'),
          ('src/process.py', 'share/comix/src'),
          ('src/properties.py', 'share/comix/src'),
          ('src/recent.py', 'share/comix/src'),
+         ('src/seekindex.py', 'share/comix/src'),
          ('src/slideshow.py', 'share/comix/src'),
          ('src/status.py', 'share/comix/src'),
+         ('src/thumbatlas.py', 'share/comix/src'),
          ('src/thumbbar.py', 'share/comix/src'),
          ('src/thumbnail.py', 'share/comix/src'),
          ('src/thumbremover.py', 'share/comix/src'),
          ('src/ui.py', 'share/comix/src'),
+         ('src/workerpool.py', 'share/comix/src'),
          ('images/16x16/comix.png', 'share/comix/images/16x16'),
          ('images/comix.svg', 'share/comix/images'),
          ('images/double-page.png', 'share/comix/images'),
@@ -1,11 +1,14 @@
 """archive.py - Archive handling (extract/create) for Comix."""
 
-import sys
 import os
 import re
+import stat
+import zlib
+import bz2
 import zipfile
 import tarfile
 import threading
+import struct
 import cStringIO
 try:
     from py7zlib import Archive7z
@@ -15,7 +18,10 @@ import mobiunpack
 
 import gtk
 
+import archiveindex
+import imagesize
 import process
+import seekindex
 from image import get_supported_format_extensions_preg
 
 ZIP, RAR, TAR, GZIP, BZIP2, SEVENZIP, MOBI, DIRECTORY = range(8)
@@ -23,6 +29,14 @@ ZIP, RAR, TAR, GZIP, BZIP2, SEVENZIP, MOBI, DIRECTORY = range(8)
 _rar_exec = None
 _7z_exec = None
 
+# Number of bytes read from the start of a file to tell its archive type.
+_SNIFF_SIZE = 4096
+# Memo of archive types, path -> ((size, mtime), type).
+_mime_type_cache = {}
+# Names of the files that are measured as images.
+_image_re = re.compile('\.(' +
+    '|'.join(get_supported_format_extensions_preg()) + ')\s*$', re.I)
+
 class Extractor:
 
     """Extractor is a threaded class for extracting different archive formats.
@@ -35,39 +49,90 @@ class Extractor:
     and a signal is sent on a condition after each extraction, so that it is
     possible for other threads to wait on specific files to be ready.
 
-    Note: Support for gzip/bzip2 compressed tar archives is limited, see
-    set_files() for more info.
+    Gzip and bzip2 compressed tar archives are read through the readers in
+    seekindex, so that their members can be extracted in any order too.
+
+    The sizes of the images in the archive are read from their headers
+    as soon as they are extracted, and stored in the archive index.
     """
 
     def __init__(self):
         self._setupped = False
 
-    def setup(self, src, dst):
+    def setup(self, src, dst, in_memory=False, quiet=False):
         """Setup the extractor with archive <src> and destination dir <dst>.
         Return a threading.Condition related to the is_ready() method, or
         None if the format of <src> isn't supported.
+
+        If <in_memory> is True and <src> is a ZIP archive, the files are
+        not written to <dst> when extracted, they are instead read straight
+        from the archive with read_file() when needed.
+
+        Archives that have been set up before are not listed again, their
+        file lists are read from the archive index instead.
+
+        If <quiet> is True no dialogs are shown (e.g. about missing
+        extractor programs), as needed when not called from the main
+        thread.
         """
         self._src = src
         self._dst = dst
-        self._type = archive_mime_type(src)
+        entry = archiveindex.load(src)
+        if entry is not None:
+            self._type = entry['type']
+        else:
+            self._type = archive_mime_type(src)
+        self._solid = True
+        self._in_memory = in_memory and self._type == ZIP
         self._files = []
         self._extracted = {}
         self._stop = False
-        self._extract_thread = None
+        self._extract_threads = []
         self._condition = threading.Condition()
+        self._read_lock = threading.Lock()
+        self._queue = []
+        self._queue_lock = threading.Lock()
+        self._image_sizes = {}
+        self._new_image_sizes = False
+        if entry is not None:
+            self._image_sizes = dict(entry.get('image sizes', {}))
 
         if self._type == ZIP:
             self._zfile = zipfile.ZipFile(src, 'r')
             self._files = self._zfile.namelist()
-        elif self._type in (TAR, GZIP, BZIP2):
+        elif self._type == TAR:
             self._tfile = tarfile.open(src, 'r')
-            self._files = self._tfile.getnames()
+            # Load all the members now, even if the file list comes from
+            # the index; otherwise the TarFile reads them lazily, which
+            # the parallel workers must not trigger.
+            members = self._tfile.getmembers()
+            if entry is None:
+                self._files = [member.name for member in members]
+        elif self._type in (GZIP, BZIP2):
+            if self._type == GZIP:
+                self._seekfile = seekindex.GzipReader(src)
+            else:
+                self._seekfile = seekindex.Bzip2Reader(src,
+                    entry and entry['seek index'])
+            self._tfile = tarfile.open(fileobj=self._seekfile, mode='r:')
+            if entry is None:
+                self._files = self._tfile.getnames()
+                # Pass the rest of the archive as well, for a complete
+                # seek index.
+                self._seekfile.scan()
+                self._tar_members = dict((member.name,
+                    (member.offset_data, member.size))
+                    for member in self._tfile.getmembers() if member.isreg())
+            else:
+                self._tar_members = entry['tar members']
         elif self._type == RAR:
             global _rar_exec
             if _rar_exec is None:
                 _rar_exec = _get_rar_exec()
                 if _rar_exec is None:
                     print( '! Could not find RAR file extractor.')
+                    if quiet:
+                        return None
                     dialog = gtk.MessageDialog(None, 0, gtk.MESSAGE_WARNING,
                         gtk.BUTTONS_CLOSE,
                         _("Could not find RAR file extractor!"))
@@ -76,11 +141,14 @@ class Extractor:
                     dialog.run()
                     dialog.destroy()
                     return None
-            proc = process.Process([_rar_exec, 'vb', '-p-', '--', src])
-            fd = proc.spawn()
-            self._files = [name.rstrip(os.linesep) for name in fd.readlines()]
-            fd.close()
-            proc.wait()
+            if entry is None:
+                proc = process.Process([_rar_exec, 'vb', '-p-', '--', src])
+                fd = proc.spawn()
+                self._files = [name.rstrip(os.linesep)
+                    for name in fd.readlines()]
+                fd.close()
+                proc.wait()
+                self._solid = _is_solid_rar(src)
         elif self._type == SEVENZIP:
             global _7z_exec, Archive7z
 
@@ -101,7 +169,7 @@ class Extractor:
 
             if _7z_exec is None:
                 print('! Could not find 7Z file extractor.')
-            elif not Archive7z:
+            elif not Archive7z and entry is None:
                 proc = process.Process([_7z_exec, 'l', '-bd', '-slt', '-p-', src])
                 fd = proc.spawn()
                 self._files = self._process_7z_names(fd)
@@ -109,6 +177,8 @@ class Extractor:
                 proc.wait()
 
             if not _7z_exec and not Archive7z:
+                if quiet:
+                    return None
                 dialog = gtk.MessageDialog(None, 0, gtk.MESSAGE_WARNING,
                     gtk.BUTTONS_CLOSE,
                     _("Could not find 7Z file extractor!"))
@@ -121,7 +191,8 @@ class Extractor:
             self._mobifile = None
             try:
                 self._mobifile = mobiunpack.MobiFile(src)
-                self._files = self._mobifile.getnames()
+                if entry is None:
+                    self._files = self._mobifile.getnames()
             except mobiunpack.unpackException as e:
                 print('! Failed to unpack MobiPocket:', e)
                 return None
@@ -136,11 +207,23 @@ class Extractor:
             print('! Non-supported archive format:', src)
             return None
 
+        if entry is not None:
+            self._files = entry['files'][:]
+            self._solid = entry['solid']
+        elif self._type != DIRECTORY:
+            entry = {'type': self._type, 'files': self._files,
+                'solid': self._solid}
+            if self._type in (GZIP, BZIP2):
+                entry['tar members'] = self._tar_members
+                entry['seek index'] = self._seekfile.get_index()
+            archiveindex.store(src, entry)
+
         self._setupped = True
         return self._condition
 
     def _process_7z_names(self, fd):
         START = "----------"
+        self._solid = True
         names = []
         started = False
         item = {}
@@ -165,6 +248,9 @@ class Extractor:
                     item = {}
                     continue
 
+                if not started and line.startswith('Solid = '):
+                    self._solid = line.split('=')[1].strip() == '+'
+
                 if started:
                     if line == "":
                         if item["Attributes"].find("D") == -1:
@@ -197,22 +283,32 @@ class Extractor:
         The second parameter, extracted allows a trick for the subarchive
         managing : setting files as extracted, in order to avoid any blocking
         wait on files not present in the original archive.
-
-        Note: Random access on gzip or bzip2 compressed tar archives is
-        no good idea. These formats are supported *only* for backwards
-        compability. They are fine formats for some purposes, but should
-        not be used for scanned comic books. So, we cheat and ignore the
-        ordering applied with this method on such archives.
         """
         if extracted:
             self._files = files
             for file in files:
                 self._extracted[file] = True
             return
-        if self._type in (GZIP, BZIP2):
-            self._files = [x for x in self._files if x in files]
-        else:
-            self._files = files
+        self._files = files
+
+    def prioritize(self, names):
+        """Move the files in <names>, in that order, to the front of the
+        queue of files that are still waiting to be extracted. Files that
+        are already extracted, or being extracted, are ignored.
+
+        Note: Solid RAR and 7z archives are extracted in archive order by
+        a single process, so this has no effect on them.
+        """
+        self._queue_lock.acquire()
+        try:
+            pending = set(self._queue)
+            wanted = [name for name in names if name in pending]
+            if wanted:
+                wanted_set = set(wanted)
+                self._queue = wanted + [name for name in self._queue
+                    if name not in wanted_set]
+        finally:
+            self._queue_lock.release()
 
     def is_ready(self, name):
         """Return True if the file <name> in the extractor's file list
@@ -226,21 +322,40 @@ class Extractor:
 
     def stop(self):
         """Signal the extractor to stop extracting and kill the extracting
-        thread. Blocks until the extracting thread has terminated.
+        threads. Blocks until the extracting threads have terminated.
         """
         self._stop = True
         if self._setupped:
-            self._extract_thread.join()
+            for thread in self._extract_threads:
+                thread.join()
+            if self._in_memory:
+                self.close()
             self.setupped = False
 
-    def extract(self):
+    def extract(self, workers=1):
         """Start extracting the files in the file list one by one using a
         new thread. Every time a new file is extracted a notify() will be
         signalled on the Condition that was returned by setup().
+
+        If <workers> is larger than 1 and the archive format allows files
+        to be read independently of each other (ZIP, tar and MobiPocket),
+        up to <workers> threads extract files in parallel, each taking the
+        next file in the file list when it is done with the previous one.
         """
-        self._extract_thread = threading.Thread(target=self._thread_extract)
-        self._extract_thread.setDaemon(False)
-        self._extract_thread.start()
+        self._queue = self._files[:]
+        if (self._type not in (ZIP, TAR, MOBI) or self._in_memory or
+          workers < 2):
+            workers = 1
+        workers = max(1, min(workers, len(self._queue)))
+        self._running_workers = workers
+        self._extract_threads = []
+        for worker in xrange(workers):
+            thread = threading.Thread(target=self._thread_extract,
+                args=(worker,))
+            thread.setDaemon(False)
+            self._extract_threads.append(thread)
+        for thread in self._extract_threads:
+            thread.start()
 
     def close(self):
         """Close any open file objects, need only be called manually if the
@@ -248,60 +363,193 @@ class Extractor:
         """
         if self._type == ZIP:
             self._zfile.close()
-        elif self._type in (TAR, GZIP, BZIP2):
+        elif self._type == TAR:
+            self._tfile.close()
+        elif self._type in (GZIP, BZIP2):
             self._tfile.close()
+            self._seekfile.close()
         elif self._type == MOBI and self._mobifile is not None:
             self._mobifile.close()
 
-    def _thread_extract(self):
-        """Extract the files in the file list one by one."""
+    def _thread_extract(self, worker=0):
+        """Extract the files in the file list one by one. Worker 0 uses the
+        archive opened by setup(), the other (parallel) workers open the
+        archive once more for themselves (except for MobiPocket files, whose
+        memory map is shared by all workers).
+        """
+        # Files read into memory are available right away, and the archive
+        # must be kept open for read_file().
+        if self._in_memory:
+            self._mark_ready(self._files)
+            self._store_image_sizes()
+            return
         # Extract 7z and rar whole archive - if it SOLID - extract one file is SLOW
-        if self._type in (SEVENZIP,) and _7z_exec is not None:
-            cmd = [_7z_exec, 'x', '-bd', '-p-',
+        if (self._type in (SEVENZIP,) and _7z_exec is not None and
+          not Archive7z and self._solid):
+            cmd = [_7z_exec, 'x', '-bd', '-bb1', '-p-',
                 '-o'+self._dst, '-y', self._src]
-            proc = process.Process(cmd)
-            proc.spawn()
-            proc.wait()
-            self._condition.acquire()
-            for name in self._files:
-                self._extracted[name] = True
-            self._condition.notify()
-            self._condition.release()
-        if self._type in (RAR,) and _rar_exec is not None:
-            cwd = os.getcwd()
-            os.chdir(self._dst)
-            cmd = [_rar_exec, 'x', '-kb', '-p-',
-                        '-o-', '-inul', '--', self._src]
-            proc = process.Process(cmd)
-            proc.spawn()
-            proc.wait()
-            os.chdir(cwd)
-            self._condition.acquire()
-            for name in self._files:
-                self._extracted[name] = True
-            self._condition.notify()
-            self._condition.release()
+            if not self._stream_extract(cmd, _7z_line_parser()):
+                # 7z versions older than 15.x don't know about -bb1.
+                cmd = [_7z_exec, 'x', '-bd', '-p-',
+                    '-o'+self._dst, '-y', self._src]
+                proc = process.Process(cmd)
+                proc.spawn()
+                proc.wait()
+            self._mark_ready(self._files)
+        elif self._type in (RAR,) and _rar_exec is not None and self._solid:
+            cmd = [_rar_exec, 'x', '-kb', '-p-', '-o-', '-idc', '-idp',
+                '--', self._src, os.path.join(self._dst, '')]
+            self._stream_extract(cmd, _parse_unrar_line)
+            self._mark_ready(self._files)
         else:
-            for name in self._files:
-                self._extract_file(name)
-        self.close()
+            reader = None
+            try:
+                # MobiPocket files are read from a memory map, which the
+                # workers can share.
+                if worker > 0 and self._type != MOBI:
+                    reader = self._open_reader()
+                name = self._next_file()
+                while name is not None:
+                    self._extract_file(name, reader)
+                    name = self._next_file()
+            finally:
+                if reader is not None:
+                    reader.close()
+        self._queue_lock.acquire()
+        self._running_workers -= 1
+        last_worker = self._running_workers == 0
+        self._queue_lock.release()
+        if last_worker:
+            self._store_image_sizes()
+            self.close()
+
+    def _next_file(self):
+        """Return the name of the next file to extract, or None if there
+        are no more files or the extractor has been stopped.
+        """
+        self._queue_lock.acquire()
+        try:
+            if self._stop or not self._queue:
+                return None
+            return self._queue.pop(0)
+        finally:
+            self._queue_lock.release()
+
+    def _open_reader(self):
+        """Return a new file object for reading the current archive, for
+        use by a parallel extracting thread.
+        """
+        if self._type == ZIP:
+            return zipfile.ZipFile(self._src, 'r')
+        return open(self._src, 'rb')
+
+    def _stream_extract(self, cmd, parse_line):
+        """Extract the whole archive with the single extractor process
+        <cmd>, whose output is read line by line while it runs. The
+        function <parse_line> should return the name of the file that a
+        line reports as written, or None, so that every file can be marked
+        as ready as soon as it is on disk.
+
+        The names may be given relative to the archive root (as 7z does) or
+        as the paths that the files are written to (as unrar does).
+
+        Return True if the extractor reported any files or finished
+        successfully. Files it didn't report are left for the caller to
+        mark, as failed files are handled by the main program anyway.
 
-    def _extract_file(self, name):
+        Used for solid archives, where extracting the files one by one
+        would mean decompressing the archive over and over again.
+        """
+        names = dict([(os.path.normpath(name), name) for name in self._files])
+        dst_prefix = os.path.join(os.path.normpath(self._dst), '')
+        reported = False
+        proc = process.Process(cmd)
+        fd = proc.spawn()
+        if fd is None:
+            return False
+        for line in iter(fd.readline, ''):
+            if self._stop:
+                proc.terminate()
+                break
+            name = parse_line(line.rstrip('\r\n'))
+            if name is None:
+                continue
+            name = os.path.normpath(name)
+            if name.startswith(dst_prefix):
+                name = name[len(dst_prefix):]
+            if name in names:
+                self._mark_ready([names[name]])
+                reported = True
+        fd.close()
+        return proc.wait() == 0 or reported
+
+    def _mark_ready(self, names):
+        """Mark the files in <names> as "ready" and signal a notify() on the
+        Condition returned by setup().
+        """
+        self._condition.acquire()
+        for name in names:
+            self._extracted[name] = True
+        self._condition.notifyAll()
+        self._condition.release()
+        self._measure_images(names)
+
+    def _measure_images(self, names):
+        """Read the sizes of the images among the files in <names> from
+        their headers, unless they are already known.
+        """
+        for name in names:
+            if self._stop:
+                break
+            if name in self._image_sizes or not _image_re.search(name):
+                continue
+            size = None
+            if self.is_in_memory(name):
+                try:
+                    # Only the start of the member is decompressed.
+                    member = self._zfile.open(name)
+                    try:
+                        size = imagesize.get_size(member)
+                    finally:
+                        member.close()
+                except Exception:
+                    pass
+            else:
+                size = imagesize.get_file_size(os.path.join(self._dst, name))
+            if size is not None:
+                self._image_sizes[name] = size
+                self._new_image_sizes = True
+
+    def _store_image_sizes(self):
+        """Add the image sizes found since setup() to the archive index."""
+        if self._new_image_sizes:
+            self._new_image_sizes = False
+            archiveindex.update(self._src,
+                **{'image sizes': dict(self._image_sizes)})
+
+    def get_image_size(self, name):
+        """Return the (width, height) of the image <name> in the archive,
+        or None if it is not known (yet). Sizes are known for the images
+        that have been extracted, or that were extracted the last time
+        the archive was opened.
+        """
+        return self._image_sizes.get(name)
+
+    def _extract_file(self, name, reader=None):
         """Extract the file named <name> to the destination directory,
         mark the file as "ready", then signal a notify() on the Condition
         returned by setup().
+
+        If <reader> is not None it is a file object from _open_reader()
+        that is used instead of the one opened by setup().
         """
-        if self._stop:
-            self.close()
-            sys.exit(0)
         try:
             if self._type in (ZIP, SEVENZIP):
                 dst_path = os.path.join(self._dst, name)
-                if not os.path.exists(os.path.dirname(dst_path)):
-                    os.makedirs(os.path.dirname(dst_path))
+                _make_dirs(os.path.dirname(dst_path))
                 new = open(dst_path, 'wb')
                 if self._type == ZIP:
-                    new.write(self._zfile.read(name, '-'))
+                    new.write((reader or self._zfile).read(name, '-'))
                 elif self._type == SEVENZIP:
                     if Archive7z is not None:
                         new.write(self._szfile.getmember(name).read())
@@ -316,35 +564,114 @@ class Extractor:
 
                 new.close()
             elif self._type in (TAR, GZIP, BZIP2):
-                if os.path.normpath(os.path.join(self._dst, name)).startswith(
-                  self._dst):
-                    self._tfile.extract(name, self._dst)
-                else:
+                if not os.path.normpath(os.path.join(self._dst, name)
+                  ).startswith(self._dst):
                     print '! Non-local tar member:', name, '\n'
+                elif reader is not None and self._get_tar_member(name).isreg():
+                    # Members of uncompressed tar archives are read straight
+                    # from their offsets, which the TarFile already knows.
+                    member = self._get_tar_member(name)
+                    dst_path = os.path.join(self._dst, name)
+                    _make_dirs(os.path.dirname(dst_path))
+                    reader.seek(member.offset_data)
+                    new = open(dst_path, 'wb')
+                    new.write(reader.read(member.size))
+                    new.close()
+                elif (self._type in (GZIP, BZIP2) and
+                  name in self._tar_members):
+                    dst_path = os.path.join(self._dst, name)
+                    _make_dirs(os.path.dirname(dst_path))
+                    data = self._read_tar_member(name)
+                    new = open(dst_path, 'wb')
+                    new.write(data)
+                    new.close()
+                else:
+                    self._read_lock.acquire()
+                    try:
+                        self._tfile.extract(name, self._dst)
+                    finally:
+                        self._read_lock.release()
             elif self._type == RAR:
                 if _rar_exec is not None:
-                    cwd = os.getcwd()
-                    os.chdir(self._dst)
                     proc = process.Process([_rar_exec, 'x', '-kb', '-p-',
-                        '-o-', '-inul', '--', self._src, name])
+                        '-o-', '-inul', '--', self._src, name,
+                        os.path.join(self._dst, '')])
                     proc.spawn()
                     proc.wait()
-                    os.chdir(cwd)
                 else:
                     print '! Could not find RAR file extractor.'
             elif self._type == MOBI:
                 dst_path = os.path.join(self._dst, name)
-                self._mobifile.extract(name, dst_path)
+                (reader or self._mobifile).extract(name, dst_path)
         except Exception:
             # Better to ignore any failed extractions (e.g. from a corrupt
             # archive) than to crash here and leave the main thread in a
             # possible infinite block. Damaged or missing files *should* be
             # handled gracefully by the main program anyway.
             pass
-        self._condition.acquire()
-        self._extracted[name] = True
-        self._condition.notify()
-        self._condition.release()
+        self._mark_ready([name])
+
+    def is_in_memory(self, name):
+        """Return True if the file <name> is only available through
+        read_file(), i.e. it has not been written to the destination
+        directory.
+        """
+        return (self._in_memory and
+            not os.path.exists(os.path.join(self._dst, name)))
+
+    def read_file(self, name):
+        """Return the contents of the file <name> as a string, read
+        straight from the archive if it is kept in memory.
+        """
+        if not self.is_in_memory(name):
+            return self.extract_file_io(name).read()
+        self._read_lock.acquire()
+        try:
+            return self._zfile.read(name)
+        finally:
+            self._read_lock.release()
+
+    def _get_tar_member(self, name):
+        """Return the TarInfo for the file <name> in the tar archive opened
+        by setup(). The TarFile is shared by the extracting threads, so
+        it is only used under the read lock.
+        """
+        self._read_lock.acquire()
+        try:
+            return self._tfile.getmember(name)
+        finally:
+            self._read_lock.release()
+
+    def _read_tar_member(self, name):
+        """Return the contents of the regular file <name> in a gzip or
+        bzip2 compressed tar archive, read from its offset through the
+        seek index.
+        """
+        offset, size = self._tar_members[name]
+        self._read_lock.acquire()
+        try:
+            self._seekfile.seek(offset)
+            return self._seekfile.read(size)
+        finally:
+            self._read_lock.release()
+
+    def write_file(self, name):
+        """Write the file <name> to the destination directory if it is
+        only kept in memory, for those that need a real file to read from.
+        """
+        if name.endswith('/') or not self.is_in_memory(name):
+            return
+        dst_path = os.path.join(self._dst, name)
+        try:
+            _make_dirs(os.path.dirname(dst_path))
+            # Write to a temporary name first so that is_in_memory() never
+            # sees a partially written file.
+            new = open(dst_path + '.comixtemp', 'wb')
+            new.write(self.read_file(name))
+            new.close()
+            os.rename(dst_path + '.comixtemp', dst_path)
+        except Exception:
+            print '! Could not write', dst_path
 
     def extract_file_io(self, chosen):
         """Extract the file named <name> to the destination directory,
@@ -359,8 +686,22 @@ class Extractor:
             return cStringIO.StringIO(open(os.path.join(self._src, chosen), 'rb').read())
         if self._type == ZIP:
             return cStringIO.StringIO(self._zfile.read(chosen))
-        elif self._type in [TAR, GZIP, BZIP2]:
-            return cStringIO.StringIO(self._tfile.extractfile(chosen).read())
+        elif self._type == TAR:
+            self._read_lock.acquire()
+            try:
+                return cStringIO.StringIO(
+                    self._tfile.extractfile(chosen).read())
+            finally:
+                self._read_lock.release()
+        elif self._type in (GZIP, BZIP2):
+            if chosen in self._tar_members:
+                return cStringIO.StringIO(self._read_tar_member(chosen))
+            self._read_lock.acquire()
+            try:
+                return cStringIO.StringIO(
+                    self._tfile.extractfile(chosen).read())
+            finally:
+                self._read_lock.release()
         elif self._type == RAR:
             proc = process.Process([_rar_exec, 'p', '-inul', '-p-', '--',
                 self._src, chosen])
@@ -374,6 +715,19 @@ class Extractor:
                     self._src, chosen])
                 fobj = proc.spawn()
                 return cStringIO.StringIO(fobj.read())
+        elif self._type == MOBI:
+            # A view of the memory mapped file, nothing is copied. The
+            # last worker closes the file when it is done, but by then the
+            # file has been extracted to disk.
+            data = None
+            if self._mobifile is not None:
+                data = self._mobifile.read(chosen)
+            if data is not None:
+                return cStringIO.StringIO(data)
+            path = os.path.join(self._dst, chosen)
+            if os.path.exists(path):
+                return cStringIO.StringIO(open(path, 'rb').read())
+            return None
 
 
 class Packer:
@@ -463,37 +817,101 @@ class Packer:
 
 
 def archive_mime_type(path):
-    """Return the archive type of <path> or None for non-archives."""
+    """Return the archive type of <path> or None for non-archives.
+
+    The type is told from the first block of the file, read at once.
+    Results are remembered for as long as the size and modification time
+    of <path> are unchanged, so asking again (e.g. for every file in a
+    directory when looking for the next archive) is cheap.
+    """
     try:
-        if os.path.isfile(path):
-            if not os.access(path, os.R_OK):
-                return None
-            if zipfile.is_zipfile(path):
-                return ZIP
-            fd = open(path, 'rb')
-            magic = fd.read(4)
-            fd.seek(60)
-            magic2 = fd.read(8)
-            fd.close()
-            if tarfile.is_tarfile(path) and os.path.getsize(path) > 0:
-                if magic.startswith('BZh'):
-                    return BZIP2
-                if magic.startswith('\037\213'):
-                    return GZIP
-                return TAR
-            if magic == 'Rar!':
-                return RAR
-            if magic == '7z\xbc\xaf':
-                return SEVENZIP
-            if magic2 == 'BOOKMOBI':
-                return MOBI
-        elif os.path.isdir(path):
+        info = os.stat(path)
+    except OSError:
+        return None
+    try:
+        if stat.S_ISDIR(info.st_mode):
             return DIRECTORY
+        if not stat.S_ISREG(info.st_mode) or not os.access(path, os.R_OK):
+            return None
+        key = (info.st_size, info.st_mtime)
+        cached = _mime_type_cache.get(path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        fd = open(path, 'rb')
+        try:
+            archive_type = _sniff_archive_type(fd)
+        finally:
+            fd.close()
+        _mime_type_cache[path] = (key, archive_type)
+        return archive_type
     except Exception:
         print '! Error while reading', path
     return None
 
 
+def _sniff_archive_type(fd):
+    """Return the archive type of the open file <fd>, or None."""
+    header = fd.read(_SNIFF_SIZE)
+    if header.startswith('PK'):
+        # Check the central directory at the end as well, so that
+        # truncated downloads are not taken for archives.
+        if zipfile.is_zipfile(fd):
+            return ZIP
+        return None
+    if header.startswith('Rar!'):
+        return RAR
+    if header.startswith('7z\xbc\xaf'):
+        return SEVENZIP
+    if header[60:68] == 'BOOKMOBI':
+        return MOBI
+    if _is_tar_header(header):
+        return TAR
+    if header.startswith('\037\213'):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if _is_tar_header(_decompress_header(fd, header, decompressor)):
+            return GZIP
+    elif header.startswith('BZh'):
+        # Nothing comes out of bzip2 before a whole block (up to 900 kB)
+        # has been read, so more than the first block has to be read here.
+        decompressor = bz2.BZ2Decompressor()
+        if _is_tar_header(_decompress_header(fd, header, decompressor)):
+            return BZIP2
+    # ZIP archives can have other data in front of them (e.g. self-
+    # extracting ones), they are only found from their end.
+    if zipfile.is_zipfile(fd):
+        return ZIP
+    return None
+
+
+def _decompress_header(fd, data, decompressor):
+    """Return (at least) the first tar block of the data decompressed by
+    <decompressor>, starting with the compressed <data> and then reading
+    on from <fd> if needed.
+    """
+    out = ''
+    try:
+        while data and len(out) < 512:
+            out += decompressor.decompress(data)
+            data = fd.read(_SNIFF_SIZE)
+    except Exception:
+        pass
+    return out
+
+
+def _is_tar_header(block):
+    """Return True if <block> starts with a valid tar header block."""
+    if len(block) < 512:
+        return False
+    try:
+        checksum = int(block[148:156].strip(' \0'), 8)
+    except ValueError:
+        return False
+    # Like tarfile, accept checksums computed with signed bytes too. The
+    # checksum field itself counts as eight spaces.
+    return checksum in (256 + sum(struct.unpack('148B8x356B', block[:512])),
+        256 + sum(struct.unpack('148b8x356b', block[:512])))
+
+
 def get_name(archive_type):
     """Return a text representation of an archive type."""
     return {ZIP:   _('ZIP archive'),
@@ -524,6 +942,98 @@ def get_archive_info(path):
     return (mime, num_pages, size)
 
 
+def _make_dirs(path):
+    """Create the directory <path>, and any missing parent directories,
+    unless it already exists (perhaps created by another thread).
+    """
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
+def _is_solid_rar(path):
+    """Return True if the RAR archive at <path> is a solid archive, or if
+    that can't be determined.
+    """
+    try:
+        fd = open(path, 'rb')
+        header = fd.read(64)
+        fd.close()
+        if header.startswith('Rar!\x1a\x07\x00'):
+            # RAR 1.5 - 4.x: the main header follows the 7 byte marker
+            # block, and has the MHD_SOLID flag set for solid archives.
+            flags, = struct.unpack_from('<H', header, 10)
+            return bool(flags & 0x0008)
+        if header.startswith('Rar!\x1a\x07\x01\x00'):
+            # RAR 5.0: the main header follows the 8 byte signature and a
+            # CRC32, with all the fields up to the archive flags stored as
+            # variable length integers.
+            pos = 12
+            fields = []
+            while len(fields) < 3:
+                value, pos = _read_rar_vint(header, pos)
+                fields.append(value)
+            size, head_type, head_flags = fields
+            if head_type != 1:
+                return True
+            if head_flags & 0x0001: # Extra area size is present
+                value, pos = _read_rar_vint(header, pos)
+            if head_flags & 0x0002: # Data size is present
+                value, pos = _read_rar_vint(header, pos)
+            archive_flags, pos = _read_rar_vint(header, pos)
+            return bool(archive_flags & 0x0004)
+    except Exception:
+        pass
+    return True
+
+
+def _read_rar_vint(data, pos):
+    """Return a tuple (value, new_pos) with the RAR 5.0 variable length
+    integer read from <data> at <pos>, and the position following it.
+    """
+    value = 0
+    shift = 0
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+
+def _parse_unrar_line(line):
+    """Return the path of the file that the unrar output <line> reports
+    as successfully extracted, or None. Unrar gives the path that the file
+    is written to, i.e. with the destination directory in front.
+    """
+    line = line.rstrip()
+    if line.startswith('Extracting  ') and line.endswith('OK'):
+        return line[len('Extracting'):-len('OK')].strip()
+    return None
+
+
+def _7z_line_parser():
+    """Return a function that parses the output of "7z x -bb1" line by
+    line, like _parse_unrar_line(). As 7z names a file when it starts
+    writing it, a file is reported once 7z has moved on to the next one.
+    """
+    current = [None]
+    def parse_line(line):
+        if not line.startswith('- '):
+            return None
+        try:
+            # For non-ascii files names, as in _process_7z_names()
+            line = line.decode("utf-8")
+        except:
+            pass
+        done, current[0] = current[0], line[2:]
+        return done
+    return parse_line
+
+
 def _get_rar_exec():
     """Return the name of the RAR file extractor executable, or None if
     no such executable is found.
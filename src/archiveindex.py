@@ -0,0 +1,128 @@
+"""archiveindex.py - Persistent index of archive contents.
+
+The index keeps what Comix has learnt about an archive the last time it
+was opened, most importantly the list of files in it, so that opening the
+archive again (or scanning it for the library or for a thumbnail) does not
+require listing it all over. For RAR and 7z archives listing means
+spawning an external program and parsing its output.
+
+Entries are stored one per archive, keyed by the archive path, and are
+only valid as long as the size and modification time of the archive are
+unchanged. At most _MAX_ENTRIES entries are kept, the least recently
+stored ones are removed first.
+"""
+
+import os
+import cPickle
+import tempfile
+try: # The md5 module is deprecated as of Python 2.5, replaced by hashlib.
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+import constants
+
+_index_dir = os.path.join(constants.DATA_DIR, 'archive_index')
+
+# Bump this whenever the layout of the entries changes.
+_INDEX_VERSION = 2
+
+_MAX_ENTRIES = 1000
+
+
+def load(path):
+    """Return the index entry (a dict) for the archive at <path>, or None
+    if there is no valid entry for it.
+    """
+    try:
+        stat = os.stat(path)
+        index = open(_path_to_indexpath(path), 'rb')
+        try:
+            version = cPickle.load(index)
+            entry = cPickle.load(index)
+        finally:
+            index.close()
+    except Exception:
+        return None
+    if (version != _INDEX_VERSION or entry.get('path') != path or
+      entry.get('size') != stat.st_size or
+      entry.get('mtime') != stat.st_mtime):
+        return None
+    return entry
+
+
+def store(path, entry):
+    """Store the dict <entry> as the index entry for the archive at <path>.
+
+    Archives in the temporary directory (e.g. sub-archives extracted from
+    other archives) are not indexed, they will never be opened again.
+    """
+    if os.path.abspath(path).startswith(
+      os.path.join(tempfile.gettempdir(), '')):
+        return
+    indexpath = _path_to_indexpath(path)
+    try:
+        stat = os.stat(path)
+        entry = dict(entry)
+        entry['path'] = path
+        entry['size'] = stat.st_size
+        entry['mtime'] = stat.st_mtime
+        if not os.path.isdir(_index_dir):
+            os.makedirs(_index_dir, 0700)
+        index = open(indexpath + '-comixtemp', 'wb')
+        cPickle.dump(_INDEX_VERSION, index, cPickle.HIGHEST_PROTOCOL)
+        cPickle.dump(entry, index, cPickle.HIGHEST_PROTOCOL)
+        index.close()
+        os.rename(indexpath + '-comixtemp', indexpath)
+    except Exception:
+        print '! archiveindex.py: Could not write', indexpath
+        return
+    _evict(indexpath)
+
+
+def update(path, **fields):
+    """Add the <fields> to the existing index entry for the archive at
+    <path>. Nothing is stored if there is no valid entry.
+    """
+    entry = load(path)
+    if entry is not None:
+        entry.update(fields)
+        store(path, entry)
+
+
+def _evict(keep):
+    """Remove the least recently stored index entries until there are at
+    most _MAX_ENTRIES. The entry at <keep> is never removed.
+    """
+    try:
+        names = os.listdir(_index_dir)
+    except OSError:
+        return
+    if len(names) <= _MAX_ENTRIES:
+        return
+    entries = []
+    for name in names:
+        indexpath = os.path.join(_index_dir, name)
+        try:
+            entries.append((os.stat(indexpath).st_mtime, indexpath))
+        except OSError:
+            pass
+    entries.sort()
+    excess = len(entries) - _MAX_ENTRIES
+    for mtime, indexpath in entries:
+        if excess <= 0:
+            break
+        if indexpath == keep:
+            continue
+        try:
+            os.remove(indexpath)
+            excess -= 1
+        except OSError:
+            pass
+
+
+def _path_to_indexpath(path):
+    """Return the path to the index entry file for the archive at <path>."""
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    return os.path.join(_index_dir, md5(os.path.normpath(path)).hexdigest())
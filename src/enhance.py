@@ -6,6 +6,7 @@ import gtk
 
 import histogram
 import image
+from preferences import prefs
 
 _dialog = None
 
@@ -27,13 +28,24 @@ class ImageEnhancer:
 
     def enhance(self, pixbuf):
         """Return an "enhanced" version of <pixbuf>."""
-        if (self.brightness != 1.0 or self.contrast != 1.0 or
-          self.saturation != 1.0 or self.sharpness != 1.0 or
-          self.autocontrast):
+        if self.is_active():
             return image.enhance(pixbuf, self.brightness, self.contrast,
                 self.saturation, self.sharpness, self.autocontrast)
         return pixbuf
 
+    def is_active(self):
+        """Return True if the current values change the pixbufs at all."""
+        return (self.brightness != 1.0 or self.contrast != 1.0 or
+            self.saturation != 1.0 or self.sharpness != 1.0 or
+            self.autocontrast)
+
+    def get_parameters(self):
+        """Return a tuple with the current enhancement values, e.g. for
+        use in cache keys.
+        """
+        return (self.brightness, self.contrast, self.saturation,
+            self.sharpness, self.autocontrast)
+
     def signal_update(self):
         """Signal to the main window that a change in the enhancement
         values has been made.
@@ -56,8 +68,12 @@ class _EnhanceImageDialog(gtk.Dialog):
         self.connect('response', self._response)
         self.set_default_response(gtk.RESPONSE_OK)
 
+        self._window = window
         self._enhancer = window.enhancer
         self._block = False
+        # Histogram data of the displayed pages, by the state of the display
+        # (see draw_histogram()), as tuples (enhancement values, data).
+        self._hist_data = {}
 
         vbox = gtk.VBox(False, 10)
         self.set_border_width(4)
@@ -142,15 +158,31 @@ class _EnhanceImageDialog(gtk.Dialog):
         self.show_all()
 
     def draw_histogram(self, image):
-        """Draw a histogram representing <image> in the dialog."""
+        """Draw a histogram representing <image> in the dialog. The pixels
+        are only counted again when the displayed page or the enhancement
+        values have changed since the last time.
+        """
         pixbuf = image.get_pixbuf()
         if pixbuf is not None:
+            key = (self._window.file_handler.get_current_page(),
+                self._window.displayed_double(), self._window.is_manga_mode,
+                prefs['checkered bg for transparent images'],
+                pixbuf.get_width(), pixbuf.get_height())
+            parameters = self._enhancer.get_parameters()
+            hist_data = None
+            if key in self._hist_data and \
+              self._hist_data[key][0] == parameters:
+                hist_data = self._hist_data[key][1]
+            else:
+                hist_data = histogram.get_histogram_data(pixbuf)
+                self._hist_data[key] = (parameters, hist_data)
             self._hist_image.set_from_pixbuf(histogram.draw_histogram(pixbuf,
-                text=False))
+                text=False, hist_data=hist_data))
 
     def clear_histogram(self):
         """Clear the histogram in the dialog."""
         self._hist_image.clear()
+        self._hist_data.clear()
 
     def _change_values(self, *args):
         if self._block:
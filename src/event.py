@@ -44,7 +44,7 @@ class EventHandler:
                 prefs['window height'] = event.height
             self._window.width = event.width
             self._window.height = event.height
-            self._window.draw_image(scroll=False)
+            self._window.draw_image(scroll=False, interactive=True)
 
     def key_press_event(self, widget, event, *args):
         """Handle key press events on the main window."""
@@ -1,7 +1,6 @@
 """filehandler.py - File handler."""
 
 import os
-import sys
 import shutil
 import locale
 import tempfile
@@ -9,6 +8,14 @@ import gc
 import shutil
 import threading
 import re
+import cStringIO
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 import gtk
 
@@ -16,10 +23,15 @@ import archive
 import cursor
 import encoding
 import image
+import imagesize
+import pixbufcache
+import preferences
 from preferences import prefs
 import thumbnail
+import workerpool
 from image import get_supported_format_extensions_preg
 
+
 class FileHandler:
 
     """The FileHandler keeps track of images, pages, caches and reads files.
@@ -43,86 +55,156 @@ class FileHandler:
         self._image_files = []
         self._current_image_index = 0
         self._comment_files = []
-        self._raw_pixbufs = {}
+        self._raw_pixbufs = pixbufcache.PixbufCache(
+            prefs['cache size'] * 1048576)
         self._name_table = {}
+        self._image_sizes = {}
         self._extractor = archive.Extractor()
         self._condition = None
+        self._prefetch = None
+        # The archive that was found to have no next archive to prefetch.
+        self._no_next_archive = None
+        self._decoder = workerpool.WorkerPool(2)
+        self._thumbnailer = workerpool.WorkerPool(1)
+        self._thumbnail_callback = None
+        self._thumbnail_size = None
+        self._validator = workerpool.WorkerPool(1)
 
         self._image_re = re.compile('\.('+'|'.join(get_supported_format_extensions_preg())+')\s*$', re.I)
 
         self.update_comment_extensions()
 
-    def _get_pixbuf(self, index):
+    def _get_pixbuf(self, index, full_size=False):
         """Return the pixbuf indexed by <index> from cache.
         Pixbufs not found in cache are fetched from disk first.
-        """
-        if index not in self._raw_pixbufs:
-            self._wait_on_page(index + 1)
-            pxb_err = False
-            try:
-                """ Check for gif in the name of the file.  If it is a gif,
-                and the user wishes GIFs to be animated, load it as a
-                PixbufAnimation and make sure that it actually is animated. 
-                If it isn't animated, load a pixbuf instead.  """
-                if not (prefs['animate gifs'] or prefs['animate']) \
-                    or "gif" not in self._image_files[index][-3:].lower():
-                    self._raw_pixbufs[index] = gtk.gdk.pixbuf_new_from_file(self._image_files[index])
-                else:
-                    self._raw_pixbufs[index] = gtk.gdk.PixbufAnimation(self._image_files[index])
-                    if self._raw_pixbufs[index].is_static_image():
-                        self._raw_pixbufs[index] = self._raw_pixbufs[index].get_static_image()
-            except Exception:
-                pxb_err = True
 
-            if pxb_err:
-                try:
-                    im = image.Image.open( self._image_files[index] )
-                    self._raw_pixbufs[index] = image.pil_to_pixbuf( im )
-                except Exception:
-                    self._raw_pixbufs[index] = self._get_missing_image()
-        return self._raw_pixbufs[index]
+        Large images may be decoded at a reduced size that is good enough
+        for displaying them in the current zoom mode, unless <full_size>
+        is True. Cached pixbufs that are too small are decoded again.
+        """
+        target = None
+        if not full_size:
+            target = self._get_decode_target()
+        pixbuf = self._raw_pixbufs.get(index)
+        if not self._is_large_enough(pixbuf, target):
+            # It may be being decoded in the background already.
+            pixbuf = self._decoder.take(index)
+            if not self._is_large_enough(pixbuf, target):
+                self._wait_on_page(index + 1, materialize=False)
+                pixbuf = self._load_pixbuf(index, target)
+            self._raw_pixbufs.put(index, pixbuf)
+        return pixbuf
+
+    def _is_large_enough(self, pixbuf, target):
+        """Return True if <pixbuf> is not None and was not decoded at a
+        smaller size than what <target> calls for.
+        """
+        if pixbuf is None:
+            return False
+        reduction = image.get_reduction(pixbuf)
+        if reduction == 1:
+            return True
+        if target is None:
+            return False
+        width, height = image.get_original_size(pixbuf)
+        return reduction <= image.get_decode_reduction(width, height, target)
 
-    def get_pixbufs(self, single=False):
+    def _get_decode_target(self):
+        """Return the (width, height) box that images are fitted in when
+        displayed, for decoding them at a reduced size. Return None if
+        they should be decoded at full size, e.g. when zooming manually.
+        """
+        if (not prefs['decode at display size'] or
+          self._window.zoom_mode == preferences.ZOOM_MODE_MANUAL):
+            return None
+        width, height = self._window.get_visible_area_size()
+        if self._window.zoom_mode == preferences.ZOOM_MODE_HEIGHT:
+            width = -1
+        elif self._window.zoom_mode == preferences.ZOOM_MODE_WIDTH:
+            height = -1
+        return width, height
+
+    def _load_pixbuf(self, index, target=None):
+        """Decode and return the pixbuf for the image indexed by <index>.
+        Images that the extractor only keeps in memory are decoded straight
+        from their data, all other are read from disk. <target> is passed
+        on to decode_pixbuf().
+        """
+        path = self._image_files[index]
+        data = None
+        if (self.archive_type not in (None, archive.DIRECTORY,) and
+          self._extractor.is_in_memory(self._name_table[path])):
+            data = self._extractor.read_file(self._name_table[path])
+        pixbuf = decode_pixbuf(path, data, target)
+        if pixbuf is None:
+            return self._get_missing_image()
+        return pixbuf
+
+    def get_pixbufs(self, single=False, full_size=False):
         """Return the pixbuf(s) for the image(s) that should be currently
         displayed, from cache. Return two pixbufs in double-page mode unless
         <single> is True. Pixbufs not found in cache are fetched from
-        disk first.
+        disk first. If <full_size> is True they are at full resolution.
         """
+        # The pages are protected right away, do_cacheing() is only called
+        # once they are on display.
         if not self._window.displayed_double() or single:
-            return self._get_pixbuf(self._current_image_index)
-        return (self._get_pixbuf(self._current_image_index),
-                self._get_pixbuf(self._current_image_index + 1))
+            self._raw_pixbufs.protect([self._current_image_index])
+            return self._get_pixbuf(self._current_image_index, full_size)
+        self._raw_pixbufs.protect([self._current_image_index,
+            self._current_image_index + 1])
+        return (self._get_pixbuf(self._current_image_index, full_size),
+                self._get_pixbuf(self._current_image_index + 1, full_size))
 
     def do_cacheing(self):
         """Make sure that the correct pixbufs are stored in cache. These
-        are (in the current implementation) the current image(s), and
-        if cacheing is enabled, also the one or two pixbufs before and
-        after them. All other pixbufs are deleted and garbage collected
-        directly in order to save memory.
+        are the current image(s), and if cacheing is enabled, also the one
+        or two pixbufs before and after them, which are decoded in the
+        background. Other pixbufs are kept as long as they fit in the
+        'cache size' budget, the least recently used ones are removed
+        first.
         """
         # Get list of wanted pixbufs.
         first_wanted = self._current_image_index
         last_wanted = first_wanted + 1
         if self._window.is_double_page:
             last_wanted += 1
+        self._raw_pixbufs.protect(range(first_wanted, last_wanted))
         if prefs['cache']:
+            self._raw_pixbufs.set_max_size(prefs['cache size'] * 1048576)
             first_wanted -= self._get_backward_step_length()
             last_wanted += self._get_forward_step_length()
+        else:
+            self._raw_pixbufs.set_max_size(0)
         first_wanted = max(0, first_wanted)
         last_wanted = min(self.get_number_of_pages(), last_wanted)
         wanted_pixbufs = range(first_wanted, last_wanted)
 
-        # Remove old pixbufs.
-        for page in set(self._raw_pixbufs) - set(wanted_pixbufs):
-            del self._raw_pixbufs[page]
-        if sys.version_info[:3] >= (2, 5, 0):
-            gc.collect(0)
-        else:
-            gc.collect()
-
-        # Cache new pixbufs if they are not already cached.
+        # Cache new pixbufs if they are not already cached. The current
+        # images first, then the following and then the preceding ones.
+        current = self._current_image_index
+        wanted_pixbufs.sort(key=lambda p: (p < current, abs(p - current)))
+        self._decoder.clear_queue()
         for wanted in wanted_pixbufs:
-            self._get_pixbuf(wanted)
+            if wanted not in self._raw_pixbufs:
+                self._decode_in_background(wanted)
+
+    def _decode_in_background(self, index):
+        """Decode the image indexed by <index> in a worker thread, and put
+        it in the cache when it is done.
+        """
+        path = self._image_files[index]
+        name = None
+        if self.archive_type not in (None, archive.DIRECTORY,):
+            name = self._name_table[path]
+        self._decoder.submit(index, _decode_page,
+            (path, name, self._extractor, self._condition,
+            self._get_decode_target()), self._pixbuf_decoded)
+
+    def _pixbuf_decoded(self, index, pixbuf):
+        """Put <pixbuf>, decoded in the background, in the cache."""
+        if pixbuf is not None and index not in self._raw_pixbufs:
+            self._raw_pixbufs.put(index, pixbuf)
 
     def next_page(self):
         """Set up filehandler to the next page. Return True if this results
@@ -138,6 +220,7 @@ class FileHandler:
                 self._open_next_archive()
             return False
         self._current_image_index += self._get_forward_step_length()
+        self._page_changed(old_page)
         return old_page != self.get_current_page()
 
     def previous_page(self):
@@ -157,6 +240,7 @@ class FileHandler:
         self._current_image_index -= step
         if (step == 2 and self.get_virtual_double_page()):
             self._current_image_index += 1
+        self._page_changed(old_page)
         return old_page != self.get_current_page()
 
     def first_page(self):
@@ -167,6 +251,7 @@ class FileHandler:
             return False
         old_page = self.get_current_page()
         self._current_image_index = 0
+        self._page_changed(old_page)
         return old_page != self.get_current_page()
 
     def last_page(self):
@@ -179,6 +264,7 @@ class FileHandler:
         offset = self._window.is_double_page and 2 or 1
         offset = min(self.get_number_of_pages(), offset)
         self._current_image_index = self.get_number_of_pages() - offset
+        self._page_changed(old_page)
         if (offset == 2 and self.get_virtual_double_page()):
             self._current_image_index += 1
         return old_page != self.get_current_page()
@@ -191,6 +277,7 @@ class FileHandler:
             return False
         old_page = self.get_current_page()
         self._current_image_index = page_num - 1
+        self._page_changed(old_page)
         return old_page != self.get_current_page()
 
     def get_virtual_double_page(self):
@@ -204,14 +291,40 @@ class FileHandler:
           self.get_current_page() == self.get_number_of_pages()):
             return False
 
-        page1 = self._get_pixbuf(self._current_image_index)
-        if page1.get_width() > page1.get_height():
-            return True
-        page2 = self._get_pixbuf(self._current_image_index + 1)
-        if page2.get_width() > page2.get_height():
-            return True
+        for index in (self._current_image_index,
+          self._current_image_index + 1):
+            width, height = self._get_image_size(index)
+            if width > height:
+                return True
         return False
 
+    def _get_image_size(self, index):
+        """Return the (width, height) of the image indexed by <index>,
+        without decoding it if possible. The size is taken from the
+        dimension index of the archive, or read from the image header,
+        and only if neither works the image is decoded.
+        """
+        path = self._image_files[index]
+        size = self._image_sizes.get(path)
+        if size is not None:
+            return size
+        if self.archive_type not in (None, archive.DIRECTORY,):
+            name = self._name_table[path]
+            size = self._extractor.get_image_size(name)
+            if size is None:
+                self._wait_on_page(index + 1, materialize=False)
+                if self._extractor.is_in_memory(name):
+                    size = imagesize.get_size(cStringIO.StringIO(
+                        self._extractor.read_file(name)))
+                else:
+                    size = imagesize.get_file_size(path)
+        else:
+            size = imagesize.get_file_size(path)
+        if size is None:
+            size = image.get_original_size(self._get_pixbuf(index))
+        self._image_sizes[path] = size
+        return size
+
     def open_file(self, path, start_page=1):
         """Open the file pointed to by <path>.
 
@@ -246,6 +359,7 @@ class FileHandler:
 
         # We close the previously opened file.
         self._window.cursor_handler.set_cursor_type(cursor.WAIT)
+        prefetch = self._take_prefetch(path)
         if self.file_loaded:
             self.close_file()
         while gtk.events_pending():
@@ -257,8 +371,17 @@ class FileHandler:
         # as the ones to be extracted.
         if self.archive_type not in (None, archive.DIRECTORY,):
             self._base_path = path
-            self._condition = self._extractor.setup(path, self._tmp_dir)
-            files = self._extractor.get_files()
+            if prefetch is not None:
+                # The archive has already been set up in the background.
+                os.rmdir(self._tmp_dir)
+                self._tmp_dir = prefetch.tmp_dir
+                self._extractor = prefetch.extractor
+                self._condition = prefetch.condition
+                files = prefetch.files
+            else:
+                self._condition = self._extractor.setup(path, self._tmp_dir,
+                    in_memory=prefs['extract zip in memory'])
+                files = self._extractor.get_files()
             image_files = filter(self._image_re.search, files)
             alphanumeric_sort(image_files)
             comment_files = filter(self._comment_re.search, files)
@@ -276,26 +399,37 @@ class FileHandler:
             for name in unknown_files:
                 self._name_table[self._tmp_dir + name] = name
 
-            self._redo_priority_ordering(start_page, image_files)
+            self._set_start_page(start_page)
 
-            self._extractor.extract()
+            if prefetch is None:
+                self._extractor.extract(workers=prefs['extraction workers'])
+            elif start_page == 1:
+                for index, pixbuf in prefetch.pixbufs.items():
+                    self._raw_pixbufs.put(index, pixbuf)
+            # The pages around the start page are extracted first.
+            self._prioritize_extraction()
         else:
             # If <path> is an image we scan its directory for more (or for
             # any at all if <path> is directory).
             self._base_path = dir_path if dir_path else os.path.dirname(path)
-            # Not necessary to sort *all* of it, but whatever.
-            for r,d,fls in os.walk(self._base_path):
-                for f in fls:
-                    fpath = os.path.join(r, f)
-                    if is_image_file(fpath):
-                        self._image_files.append(fpath)
-                        self._name_table[fpath] = f
+            # The files are only picked by name (or magic bytes) here, so
+            # that the page can be shown right away. Their contents are
+            # validated later on.
+            self._image_files = scan_image_dir(self._base_path,
+                self._image_re)
+            if not dir_path and path not in self._image_files:
+                self._image_files.append(path)
+            for fpath in self._image_files:
+                self._name_table[fpath] = os.path.basename(fpath)
 
             alphanumeric_sort(self._image_files)
             if dir_path:
-                self._redo_priority_ordering(start_page, self._image_files)
+                self._set_start_page(start_page)
             else:
                 self._current_image_index = self._image_files.index(path)
+            self._validator.submit('validate', _find_invalid_images,
+                ([f for f in self._image_files if f != path],),
+                self._images_validated)
 
         # Manage subarchive
         if unknown_files:
@@ -311,6 +445,8 @@ class FileHandler:
             if has_subarchive:
                 # Now, get all files, and move them into the temp directory
                 # while renaming them to avoid any sorting error.
+                for full_path in self._image_files + self._comment_files:
+                    self._wait_on_file(full_path)
                 self._image_files = []
                 tmpdir_len = len(self._tmp_dir)
                 extracted_files = []
@@ -330,7 +466,7 @@ class FileHandler:
                     self._name_table[full_path] = os.path.basename(full_path)
                 self._extractor.set_files(extracted_files, True)
                 #redo calculation of current_index from start_page
-                self._redo_priority_ordering(start_page, self._image_files)
+                self._set_start_page(start_page)
 
         if not self._image_files:
             self._window.statusbar.set_message(_("No images or subarchives in '%s'") %
@@ -344,8 +480,12 @@ class FileHandler:
         self._window.ui_manager.set_sensitivities()
         self._window.new_page()
         self._window.ui_manager.recent.add(path)
+        self._update_prefetch()
 
-    def _redo_priority_ordering(self, start_page, list):
+    def _set_start_page(self, start_page):
+        """Set the current page to <start_page>, or to the last page if it
+        is non-positive.
+        """
         if start_page <= 0:
             if self._window.is_double_page:
                 self._current_image_index = self.get_number_of_pages() - 2
@@ -355,17 +495,85 @@ class FileHandler:
             self._current_image_index = start_page - 1
         self._current_image_index = max(0, self._current_image_index)
 
+    def _get_priority_ordering(self):
+        """Return a list with the indices of the images around the current
+        page, in the order in which they are most likely to be viewed.
+        """
         depth = self._window.is_double_page and 2 or 1
         priority_ordering = (
             range(self._current_image_index,
                 self._current_image_index + depth * 2) +
             range(self._current_image_index - depth,
                 self._current_image_index)[::-1])
-        priority_ordering = [list[p] for p in priority_ordering
+        return [p for p in priority_ordering
             if 0 <= p <= self.get_number_of_pages() - 1]
-        for i, name in enumerate(priority_ordering):
-            list.remove(name)
-            list.insert(i, name)
+
+    def _prioritize_extraction(self):
+        """Make the extractor extract the images around the current page
+        before any other files that are still waiting to be extracted,
+        e.g. after a jump to another part of the archive.
+        """
+        if self.archive_type in (None, archive.DIRECTORY,):
+            return
+        names = [self._name_table[self._image_files[p]]
+            for p in self._get_priority_ordering()]
+        self._extractor.prioritize(names)
+
+    def _page_changed(self, old_page):
+        """Run the tasks that follow a move from <old_page> to another
+        page.
+        """
+        self._prioritize_extraction()
+        if self.get_current_page() < old_page:
+            self._cancel_prefetch()
+        else:
+            self._update_prefetch()
+
+    def _update_prefetch(self):
+        """Start preparing the next archive in the directory when the
+        current page is close enough to the end, as set by the
+        'prefetch next archive pages' preference. Cancel any preparations
+        when it no longer is.
+        """
+        if (not prefs['auto open next archive'] or not self.file_loaded or
+          self.archive_type in (None, archive.DIRECTORY,) or
+          self.get_number_of_pages() - self.get_current_page() >=
+          prefs['prefetch next archive pages']):
+            self._cancel_prefetch()
+            return
+        if (self._prefetch is not None or
+          self._no_next_archive == self._base_path):
+            return
+        path = self._get_next_archive_path()
+        if (path is None or
+          archive.archive_mime_type(path) == archive.DIRECTORY):
+            # Not looked for again on every page turn.
+            self._no_next_archive = self._base_path
+            return
+        self._prefetch = _ArchivePrefetch(path, self._image_re,
+            self._comment_re, self._window.is_double_page and 2 or 1,
+            self._get_decode_target())
+
+    def _take_prefetch(self, path):
+        """Return the prefetch of the archive at <path> if there is a
+        successful one, or None. Any other prefetch is cancelled.
+        """
+        prefetch = self._prefetch
+        self._prefetch = None
+        if prefetch is None:
+            return None
+        if prefetch.path != path:
+            prefetch.cancel()
+            return None
+        if not prefetch.take():
+            return None
+        return prefetch
+
+    def _cancel_prefetch(self):
+        """Cancel the preparation of the next archive, if any."""
+        if self._prefetch is not None:
+            self._prefetch.cancel()
+            self._prefetch = None
 
     def _open_subarchive(self, dir, path):
         """Allows to recursively extract all subarchives"""
@@ -382,12 +590,41 @@ class FileHandler:
                 condition.wait()
             condition.release()
             dname = dir + "/" + name
-            name_type = archive.archive_mime_type(dname)
             if archive.archive_mime_type(dname) not in (None, archive.DIRECTORY,):
                 self._open_subarchive(os.path.dirname(dir), os.path.basename(name))
         if not os.path.isdir(fullpath):
             os.remove(fullpath)
 
+    def _images_validated(self, key, invalid):
+        """Remove the files in the set <invalid>, which were found in
+        directory mode but turned out not to be images, from the pages.
+        What is cached for the other pages is kept, under their new page
+        numbers.
+        """
+        if not invalid:
+            return
+        # The current page is kept, it is shown as a missing image anyway.
+        invalid.discard(self._image_files[self._current_image_index])
+        if not invalid:
+            return
+        mapping = {}  # Old index -> new index.
+        image_files = []
+        for index, path in enumerate(self._image_files):
+            if path in invalid:
+                del self._name_table[path]
+                self._image_sizes.pop(path, None)
+            else:
+                mapping[index] = len(image_files)
+                image_files.append(path)
+        self._image_files = image_files
+        self._current_image_index = mapping[self._current_image_index]
+        # Pages being decoded would be put in the cache at their old index.
+        self._decoder.cancel_all()
+        self._raw_pixbufs.remap(mapping.get)
+        self._window.remap_pages(dict([(index + 1, new_index + 1)
+            for index, new_index in mapping.iteritems()]))
+        self._window.draw_image(scroll=False)
+
     def close_file(self, *args):
         """Run tasks for "closing" the currently opened file(s)."""
         self.file_loaded = False
@@ -396,10 +633,16 @@ class FileHandler:
         self._current_image_index = 0
         self._comment_files = []
         self._name_table.clear()
+        self._image_sizes.clear()
+        self._validator.cancel_all()
+        self._decoder.cancel_all()
+        self.cancel_thumbnails()
         self._raw_pixbufs.clear()
         self._window.clear()
         self._window.ui_manager.set_sensitivities()
         self._extractor.stop()
+        self._cancel_prefetch()
+        self._no_next_archive = None
         thread_delete(self._tmp_dir)
         self._tmp_dir = tempfile.mkdtemp(prefix='comix.', suffix=os.sep)
         gc.collect()
@@ -407,6 +650,7 @@ class FileHandler:
     def cleanup(self):
         """Run clean-up tasks. Should be called prior to exit."""
         self._extractor.stop()
+        self._cancel_prefetch()
         thread_delete(self._tmp_dir)
 
     def is_last_page(self):
@@ -460,6 +704,14 @@ class FileHandler:
             return self._image_files[self._current_image_index]
         return self._image_files[page - 1]
 
+    def get_extracted_path_to_page(self, page=None):
+        """Return the full path to the image file for <page>, like
+        get_path_to_page(), but make sure that the file actually exists
+        on disk first.
+        """
+        self._wait_on_page(page)
+        return self.get_path_to_page(page)
+
     def get_path_to_base(self):
         """Return the full path to the current base (path to archive or
         image directory.)
@@ -510,11 +762,9 @@ class FileHandler:
         """Return a tuple (width, height) with the size of <page>. If <page>
         is None, return the size of the current page.
         """
-        self._wait_on_page(page)
-        info = gtk.gdk.pixbuf_get_file_info(self.get_path_to_page(page))
-        if info is not None:
-            return (info[1], info[2])
-        return (0, 0)
+        if page is None:
+            page = self.get_current_page()
+        return self._get_image_size(page - 1)
 
     def get_mime_name(self, page=None):
         """Return a string with the name of the mime type of <page>. If
@@ -532,33 +782,74 @@ class FileHandler:
         page if <page> is None.
 
         If <create> is True, and <width>x<height> <= 128x128, the
-        thumbnail is also stored on disk.
+        thumbnail is also stored on disk. Otherwise pages that are in the
+        cache are scaled down from there, rather than read again.
         """
+        if page is None:
+            page = self.get_current_page()
+        if not create and page - 1 in self._raw_pixbufs:
+            pixbuf = self._raw_pixbufs.get(page - 1)
+            if not isinstance(pixbuf, gtk.gdk.PixbufAnimation):
+                return image.fit_in_rectangle(pixbuf, width, height,
+                    mipmap=prefs['mipmap pages'])
         self._wait_on_page(page)
-        path = self.get_path_to_page(page)
-        if width <= 128 and height <= 128:
-            thumb = thumbnail.get_thumbnail(path, create)
-        else:
-            try:
-                if "gif" not in path[-3:].lower():
-                    thumb = gtk.gdk.pixbuf_new_from_file_at_size(path, width, height)
-                else:
-                    thumb = gtk.gdk.PixbufAnimation(path).get_static_image()
-                    src_width = thumb.get_width()
-                    src_height = thumb.get_height()
-                    if float(src_width) / width > float(src_height) / height:
-                        thumb = thumb.scale_simple(width,
-                            int(max(src_height * width / src_width, 1)), gtk.gdk.INTERP_TILES)
-                    else:
-                        thumb = thumb.scale_simple(int(max(src_width * height / src_height, 1)),
-                            height, gtk.gdk.INTERP_TILES)
-            except Exception:
-                thumb = None
+        thumb = get_thumbnail_from_file(self.get_path_to_page(page), width,
+            height, create)
         if thumb is None:
             thumb = self._get_missing_image()
         thumb = image.fit_in_rectangle(thumb, width, height)
         return thumb
 
+    def request_thumbnails(self, pages, width, height, create, callback):
+        """Make thumbnails, as get_thumbnail() does, for the sequence of
+        <pages> in a worker thread, in the order given. Each thumbnail is
+        handed to callback(page, thumbnail, failed) in the main loop as soon
+        as it is done, where <failed> is True if no thumbnail could be made
+        and <thumbnail> is a missing image instead.
+
+        Pages that were requested earlier and have not been started yet
+        are dropped, so a new request can put other pages first.
+        """
+        self._thumbnailer.clear_queue()
+        self._thumbnail_callback = callback
+        self._thumbnail_size = (width, height)
+        for page in pages:
+            path = self.get_path_to_page(page)
+            name = None
+            if self.archive_type not in (None, archive.DIRECTORY,):
+                name = self._name_table[path]
+            pixbuf = None
+            if not create and page - 1 in self._raw_pixbufs:
+                pixbuf = self._raw_pixbufs.get(page - 1)
+            self._thumbnailer.submit(page, _load_thumbnail,
+                (path, name, self._extractor, self._condition, pixbuf,
+                width, height, create), self._thumbnail_loaded)
+
+    def cancel_thumbnails(self):
+        """Drop all thumbnails requested by request_thumbnails() that have
+        not been handed over yet.
+        """
+        self._thumbnailer.cancel_all()
+        self._thumbnail_callback = None
+
+    def _thumbnail_loaded(self, page, thumb):
+        """Hand <thumb>, made in the background, over to the callback given
+        to request_thumbnails(), or a missing image if it is None.
+        """
+        if self._thumbnail_callback is None:
+            return
+        failed = thumb is None
+        if failed:
+            thumb = image.fit_in_rectangle(self._get_missing_image(),
+                *self._thumbnail_size)
+        self._thumbnail_callback(page, thumb, failed)
+
+    def get_cache_stats(self):
+        """Return a tuple (hits, misses, number of pixbufs, used bytes,
+        budget in bytes) for the cache of decoded pages.
+        """
+        return self._raw_pixbufs.get_stats()
+
     def get_stats(self, page=None):
         """Return a stat object, as used by the stat module, for <page>.
         If <page> is None, return a stat object for the current page.
@@ -589,17 +880,26 @@ class FileHandler:
         """Open the archive that comes directly after the currently loaded
         archive in that archive's directory listing, sorted alphabetically.
         """
+        path = self._get_next_archive_path()
+        if path is not None:
+            self.open_file(path)
+
+    def _get_next_archive_path(self):
+        """Return the path to the archive that comes directly after the
+        currently loaded archive in that archive's directory listing, sorted
+        alphabetically, or None if there is none.
+        """
         arch_dir = os.path.dirname(self._base_path)
         files = list_dir_sorted(arch_dir)
         try:
             current_index = files.index(os.path.basename(self._base_path))
         except ValueError:
-            return
+            return None
         for f in files[current_index + 1:]:
             path = os.path.join(arch_dir, f)
             if archive.archive_mime_type(path) is not None:
-                self.open_file(path)
-                return
+                return path
+        return None
 
     def _open_previous_archive(self):
         """Open the archive that comes directly before the currently loaded
@@ -622,12 +922,12 @@ class FileHandler:
         return self._window.render_icon(gtk.STOCK_MISSING_IMAGE,
             gtk.ICON_SIZE_DIALOG)
 
-    def _wait_on_page(self, page):
+    def _wait_on_page(self, page, materialize=True):
         """Block the running (main) thread until the file corresponding to
         image <page> has been fully extracted.
         """
         path = self.get_path_to_page(page)
-        self._wait_on_file(path)
+        self._wait_on_file(path, materialize)
 
     def _wait_on_comment(self, num):
         """Block the running (main) thread until the file corresponding to
@@ -636,20 +936,304 @@ class FileHandler:
         path = self._comment_files[num - 1]
         self._wait_on_file(path)
 
-    def _wait_on_file(self, path):
+    def _wait_on_file(self, path, materialize=True):
         """Block the running (main) thread if the file <path> is from an
         archive and has not yet been extracted. Return when the file is
         ready.
+
+        If <materialize> is True, files that the extractor only keeps in
+        memory are written to <path> as well before returning.
         """
         if self.archive_type in (None, archive.DIRECTORY,):
             return
         name = self._name_table[path]
-        if self._extractor.is_ready(name):
-            return
-        self._condition.acquire()
-        while not self._extractor.is_ready(name):
-            self._condition.wait()
-        self._condition.release()
+        if not self._extractor.is_ready(name):
+            self._condition.acquire()
+            while not self._extractor.is_ready(name):
+                self._condition.wait()
+            self._condition.release()
+        if materialize:
+            self._extractor.write_file(name)
+
+
+class _ArchivePrefetch:
+
+    """Speculative opening of the archive that is likely to be opened
+    next. The archive is set up with an Extractor of its own, in a
+    temporary directory of its own, and its first <pages> images are
+    extracted first and decoded, all in a background thread. Images and
+    comments are picked out of the archive with the regular expressions
+    <image_re> and <comment_re>, and the images are decoded for display
+    in <target> (see decode_pixbuf()).
+    """
+
+    def __init__(self, path, image_re, comment_re, pages, target=None):
+        self.path = path
+        self.tmp_dir = tempfile.mkdtemp(prefix='comix.', suffix=os.sep)
+        self.extractor = archive.Extractor()
+        self.condition = None
+        self.files = []
+        self.pixbufs = {}
+        self._image_re = image_re
+        self._comment_re = comment_re
+        self._pages = pages
+        self._target = target
+        self._cancelled = False
+        self._extracting = False
+        self._taken = False
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def take(self):
+        """Return True if the archive has been set up and is being
+        extracted. The caller then owns the extractor and the temporary
+        directory, and <pixbufs> holds the images decoded so far. The
+        prefetch is not waited for, if the archive is still being set up
+        (or could not be) it is cancelled and False is returned.
+        """
+        self._lock.acquire()
+        try:
+            if self._extracting and not self._cancelled:
+                self._taken = True
+                return True
+        finally:
+            self._lock.release()
+        self.cancel()
+        return False
+
+    def cancel(self):
+        """Stop the prefetch and remove its temporary directory. Returns
+        without waiting for the background thread if it is still setting up
+        the archive, the thread cleans up after itself then.
+        """
+        self._lock.acquire()
+        try:
+            if self._cancelled:
+                return
+            self._cancelled = True
+            if not self._extracting and self._thread.isAlive():
+                return
+        finally:
+            self._lock.release()
+        self._cleanup()
+
+    def _cleanup(self):
+        if self._extracting:
+            self.extractor.stop()
+        thread_delete(self.tmp_dir)
+
+    def _run(self):
+        condition = self.extractor.setup(self.path, self.tmp_dir,
+            in_memory=prefs['extract zip in memory'], quiet=True)
+        self._lock.acquire()
+        try:
+            if self._cancelled:
+                # cancel() left the cleaning up to us.
+                self._cleanup()
+                return
+            if condition is None:
+                return
+            self.condition = condition
+            self.files = self.extractor.get_files()
+            # The files are extracted in page order, as open_file() would
+            # have them, the first pages first. Other files are kept for
+            # the sub-archives among them.
+            image_files = filter(self._image_re.search, self.files)
+            alphanumeric_sort(image_files)
+            comment_files = filter(self._comment_re.search, self.files)
+            wanted = set(image_files + comment_files)
+            self.extractor.set_files(image_files + comment_files +
+                [name for name in self.files if name not in wanted])
+            self.extractor.extract(workers=prefs['extraction workers'])
+            self.extractor.prioritize(image_files[:self._pages])
+            self._extracting = True
+        finally:
+            self._lock.release()
+        for index, name in enumerate(image_files[:self._pages]):
+            condition.acquire()
+            while not self.extractor.is_ready(name):
+                if self._cancelled or self._taken:
+                    condition.release()
+                    return
+                condition.wait(0.2)
+            condition.release()
+            if self._cancelled or self._taken:
+                return
+            data = None
+            if self.extractor.is_in_memory(name):
+                data = self.extractor.read_file(name)
+            pixbuf = decode_pixbuf(os.path.join(self.tmp_dir, name), data,
+                self._target)
+            self._lock.acquire()
+            try:
+                # Once taken, the pixbufs have been handed over already.
+                if self._taken:
+                    return
+                if pixbuf is not None:
+                    self.pixbufs[index] = pixbuf
+            finally:
+                self._lock.release()
+
+
+def _find_invalid_images(paths, cancelled):
+    """Return the set of the files in <paths> that are not image files (see
+    is_image_file()), or None if cancelled() returns True on the way. For
+    use in a worker thread.
+    """
+    invalid = set()
+    for path in paths:
+        if cancelled():
+            return None
+        if not is_image_file(path):
+            invalid.add(path)
+    return invalid
+
+
+def _decode_page(path, name, extractor, condition, target, cancelled):
+    """Decode and return a pixbuf for the image at <path>, or None. If
+    <name> is not None the image is the file <name> in the archive of
+    <extractor>, and it is waited for (on <condition>) until it has been
+    extracted, or until cancelled() returns True. <target> is passed on
+    to decode_pixbuf(). For use in worker threads.
+    """
+    data = None
+    if name is not None:
+        if not _wait_for_extraction(name, extractor, condition, cancelled):
+            return None
+        if extractor.is_in_memory(name):
+            data = extractor.read_file(name)
+    if cancelled():
+        return None
+    return decode_pixbuf(path, data, target)
+
+
+def _load_thumbnail(path, name, extractor, condition, pixbuf, width, height,
+  create, cancelled):
+    """Return a thumbnail that fits in <width> x <height> for the image at
+    <path>, or None if none can be made. It is scaled from <pixbuf> if
+    that is not None (a decoded page from the cache). <name>, <extractor>
+    and <condition> are as for _decode_page(), and <create> is passed on
+    to get_thumbnail_from_file(). For use in worker threads.
+    """
+    if pixbuf is not None and not isinstance(pixbuf, gtk.gdk.PixbufAnimation):
+        return image.fit_in_rectangle(pixbuf, width, height,
+            mipmap=prefs['mipmap pages'])
+    if name is not None:
+        if not _wait_for_extraction(name, extractor, condition, cancelled):
+            return None
+        if extractor.is_in_memory(name):
+            # Decoded straight from the data, at about the thumbnail size.
+            pixbuf = decode_pixbuf(path, extractor.read_file(name),
+                (width, height))
+            if pixbuf is None:
+                return None
+            if isinstance(pixbuf, gtk.gdk.PixbufAnimation):
+                pixbuf = pixbuf.get_static_image()
+            return image.fit_in_rectangle(pixbuf, width, height)
+    if cancelled():
+        return None
+    thumb = get_thumbnail_from_file(path, width, height, create)
+    if thumb is None:
+        return None
+    return image.fit_in_rectangle(thumb, width, height)
+
+
+def _wait_for_extraction(name, extractor, condition, cancelled):
+    """Wait (on <condition>) until the file <name> has been extracted by
+    <extractor>. Return False if cancelled() returned True before that.
+    """
+    condition.acquire()
+    try:
+        while not extractor.is_ready(name):
+            if cancelled():
+                return False
+            condition.wait(0.2)
+    finally:
+        condition.release()
+    return True
+
+
+def get_thumbnail_from_file(path, width, height, create=False):
+    """Return a thumbnail pixbuf for the image file at <path> that fits in
+    <width> x <height>, or None if it can not be read. Normal size
+    thumbnails (at most 128x128) come from the thumbnail module, and are
+    stored on disk if <create> is True.
+    """
+    if width <= 128 and height <= 128:
+        return thumbnail.get_thumbnail(path, create)
+    try:
+        if "gif" not in path[-3:].lower():
+            return gtk.gdk.pixbuf_new_from_file_at_size(path, width, height)
+        thumb = gtk.gdk.PixbufAnimation(path).get_static_image()
+        src_width = thumb.get_width()
+        src_height = thumb.get_height()
+        if float(src_width) / width > float(src_height) / height:
+            return thumb.scale_simple(width,
+                int(max(src_height * width / src_width, 1)), gtk.gdk.INTERP_TILES)
+        return thumb.scale_simple(int(max(src_width * height / src_height, 1)),
+            height, gtk.gdk.INTERP_TILES)
+    except Exception:
+        return None
+
+
+def decode_pixbuf(path, data=None, target=None):
+    """Decode and return a pixbuf for the image file at <path>, or from
+    <data> (the contents of that file) if it is given. Return None if the
+    image can not be decoded.
+
+    If <target> is a (width, height) tuple, large images are decoded at
+    a reduced size that still fills it (see image.get_decode_reduction()).
+    """
+    # If the image is a gif, and the user wishes GIFs to be animated,
+    # load it as a PixbufAnimation and make sure that it actually is
+    # animated. If it isn't animated, load a pixbuf instead.
+    animated = ((prefs['animate gifs'] or prefs['animate']) and
+        "gif" in path[-3:].lower())
+    try:
+        if data is not None:
+            return image.pixbuf_from_data(data, animated, target)
+        if not animated:
+            info = None
+            if target is not None:
+                info = gtk.gdk.pixbuf_get_file_info(path)
+            if info is not None:
+                width, height = info[1:]
+                reduction = image.get_decode_reduction(width, height, target)
+                if reduction > 1:
+                    pixbuf = gtk.gdk.pixbuf_new_from_file_at_size(path,
+                        max(width // reduction, 1),
+                        max(height // reduction, 1))
+                    image.set_original_size(pixbuf, width, height, reduction)
+                    return pixbuf
+            return gtk.gdk.pixbuf_new_from_file(path)
+        pixbuf = gtk.gdk.PixbufAnimation(path)
+        if pixbuf.is_static_image():
+            pixbuf = pixbuf.get_static_image()
+        return pixbuf
+    except Exception:
+        pass
+
+    try:
+        if data is not None:
+            im = image.Image.open(cStringIO.StringIO(data))
+        else:
+            im = image.Image.open(path)
+        width, height = im.size
+        reduction = 1
+        if target is not None:
+            reduction = image.get_decode_reduction(width, height, target)
+        if reduction > 1:
+            # Only JPEG images can be decoded at reduced size like this.
+            im.draft(im.mode, (width // reduction, height // reduction))
+        pixbuf = image.pil_to_pixbuf(im)
+        if pixbuf.get_width() < width:
+            image.set_original_size(pixbuf, width, height,
+                width // pixbuf.get_width())
+        return pixbuf
+    except Exception:
+        return None
 
 
 def thread_delete(path):
@@ -661,6 +1245,54 @@ def thread_delete(path):
     del_thread.start()
 
 
+def scan_image_dir(dir_path, image_re):
+    """Return a list of paths to the image files in the directory tree at
+    <dir_path>. Files are picked by their names matching <image_re>, and
+    only files with other names are opened, to check their magic bytes.
+    The contents are not validated, see is_image_file() for that.
+
+    If scandir() is available the directories are listed with it, which
+    tells files from directories without a stat() per file.
+    """
+    images = []
+    if scandir is None:
+        for root, dirs, files in os.walk(dir_path):
+            for name in files:
+                path = os.path.join(root, name)
+                if image_re.search(name) or has_image_magic(path):
+                    images.append(path)
+        return images
+    dirs = [dir_path]
+    while dirs:
+        try:
+            for entry in scandir(dirs.pop()):
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.path)
+                elif entry.is_file() and (image_re.search(entry.name) or
+                  has_image_magic(entry.path)):
+                    images.append(entry.path)
+        except OSError:
+            pass
+    return images
+
+
+def has_image_magic(path):
+    """Return True if the file at <path> starts like one of the common
+    image formats (JPEG, PNG, GIF, BMP, TIFF or WebP).
+    """
+    try:
+        fd = open(path, 'rb')
+        try:
+            magic = fd.read(12)
+        finally:
+            fd.close()
+    except IOError:
+        return False
+    return (magic.startswith(('\xff\xd8\xff', '\x89PNG', 'GIF8', 'BM',
+        'II*\x00', 'MM\x00*')) or
+        (magic.startswith('RIFF') and magic[8:12] == 'WEBP'))
+
+
 def is_image_file(path):
     """Return True if the file at <path> is an image file recognized by PyGTK.
     """
@@ -10,11 +10,22 @@ except:
     import Image
     import ImageDraw
     import ImageOps
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 import image
 
 
-def draw_histogram(pixbuf, height=170, fill=170, text=True):
+def get_histogram_data(pixbuf):
+    """Return the RGB histogram of <pixbuf>, as a list of 768 pixel counts
+    (256 for each of red, green and blue).
+    """
+    return image.get_histogram(pixbuf)[:768]
+
+
+def draw_histogram(pixbuf, height=170, fill=170, text=True, hist_data=None):
     """Draw a histogram from <pixbuf> and return it as another pixbuf.
 
     The returned prixbuf will be 262x<height> px.
@@ -24,14 +35,37 @@ def draw_histogram(pixbuf, height=170, fill=170, text=True):
 
     If <text> is True a label with the maximum pixel value will be added to
     one corner.
+
+    If <hist_data> is given, as returned by get_histogram_data(), it is
+    drawn instead of the histogram of <pixbuf>.
     """
-    im = Image.new('RGB', (258, height - 4), (30, 30, 30))
-    hist_data = image.pixbuf_to_pil(pixbuf).histogram()
+    if hist_data is None:
+        hist_data = get_histogram_data(pixbuf)
     maximum = max(hist_data[:768] + [1])
     y_scale = float(height - 6) / maximum
     r = [int(hist_data[n] * y_scale) for n in xrange(256)]
     g = [int(hist_data[n] * y_scale) for n in xrange(256, 512)]
     b = [int(hist_data[n] * y_scale) for n in xrange(512, 768)]
+    if numpy is not None:
+        im = _draw_graphs_numpy(r, g, b, height, fill)
+    else:
+        im = _draw_graphs(r, g, b, height, fill)
+    if text:
+        maxstr = 'max: ' + str(maximum)
+        draw = ImageDraw.Draw(im)
+        draw.rectangle((0, 0, len(maxstr) * 6 + 2, 10), fill=(30, 30, 30))
+        draw.text((2, 0), maxstr, fill=(255, 255, 255))
+    im = ImageOps.expand(im, 1, (80, 80, 80))
+    im = ImageOps.expand(im, 1, (0, 0, 0))
+    return image.pil_to_pixbuf(im)
+
+
+def _draw_graphs(r, g, b, height, fill):
+    """Return a PIL image, 258x(<height> - 4) px, with the graphs of the
+    scaled histogram values <r>, <g> and <b> filled with <fill> and
+    outlined.
+    """
+    im = Image.new('RGB', (258, height - 4), (30, 30, 30))
     im_data = im.getdata()
     # Draw the filling colours
     for x in xrange(256):
@@ -60,11 +94,31 @@ def draw_histogram(pixbuf, height=170, fill=170, text=True):
         for y in range(b[x] + 1, b[x-1] + 1):
             r_px, g_px, b_px = im_data.getpixel((x, height - 5 - y))
             im_data.putpixel((x, height - 5 - y), (r_px, g_px, 255))
-    if text:
-        maxstr = 'max: ' + str(maximum)
-        draw = ImageDraw.Draw(im)
-        draw.rectangle((0, 0, len(maxstr) * 6 + 2, 10), fill=(30, 30, 30))
-        draw.text((2, 0), maxstr, fill=(255, 255, 255))
-    im = ImageOps.expand(im, 1, (80, 80, 80))
-    im = ImageOps.expand(im, 1, (0, 0, 0))
-    return image.pil_to_pixbuf(im)
+    return im
+
+
+def _draw_graphs_numpy(r, g, b, height, fill):
+    """Do what _draw_graphs() does, with NumPy, for the whole image at
+    once.
+    """
+    levels = numpy.array([r, g, b]).T        # One row per x, 256 x 3.
+    # The graph value that each row of the image is at.
+    y = (height - 5 - numpy.arange(height - 4))[:, numpy.newaxis]
+    data = numpy.empty((height - 4, 258, 3), numpy.uint8)
+    data.fill(30)
+    # Draw the filling colours
+    inside = (y >= 1) & (y <= levels.max(axis=1))
+    area = data[:, 1:257]
+    area[inside] = numpy.where(y[:, :, numpy.newaxis] <= levels, fill,
+        0)[inside]
+    # Draw the outlines, where the graphs rise (in the column of the higher
+    # value) and fall (in the column before).
+    for channel in xrange(3):
+        previous = levels[:-1, channel]
+        current = levels[1:, channel]
+        rise = (((y > previous) & (y <= current)) |
+            ((y == current) & (current != 0)))
+        fall = (y > current) & (y <= previous)
+        data[:, 2:257, channel][rise] = 255
+        data[:, 1:256, channel][fall] = 255
+    return Image.fromarray(data, 'RGB')
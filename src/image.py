@@ -1,17 +1,21 @@
 """image.py - Various image manipulations."""
 
+import struct
+
 import gtk
 
 try:
     from PIL import Image
     from PIL import ImageEnhance
-    from PIL import ImageOps
     from PIL import ImageStat
 except:
     import Image
     import ImageEnhance
-    import ImageOps
     import ImageStat
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from preferences import prefs
 
@@ -48,7 +52,7 @@ def get_supported_format_extensions_preg():
 
 
 def fit_in_rectangle(src, width, height, scale_up=False, rotation=0,
-  animated=False):
+  animated=False, interpolation=gtk.gdk.INTERP_TILES, mipmap=False):
     """Scale (and return) a pixbuf so that it fits in a rectangle with
     dimensions <width> x <height>. A negative <width> or <height>
     means an unbounded dimension - both cannot be negative.
@@ -63,6 +67,13 @@ def fit_in_rectangle(src, width, height, scale_up=False, rotation=0,
 
     If <src> is an <animated> image (PixbufAnimation) it will be returned
     unchanged. There is no way to resize PixbufAnimation objects currently.
+
+    The pixbuf is scaled with the gtk.gdk.INTERP_* mode <interpolation>,
+    e.g. INTERP_NEAREST when speed matters more than quality. If <mipmap>
+    is True it is scaled from the nearest larger level of the mipmap
+    pyramid of <src> (see get_mipmap()), for pixbufs that are scaled often.
+    Missing levels are not built with INTERP_NEAREST, which is fast enough
+    from the full size.
     """
 # TODO: Fix the animated stuff. Eventually PixbufAnimation resizing should be  possible.
     if animated:
@@ -95,16 +106,19 @@ def fit_in_rectangle(src, width, height, scale_up=False, rotation=0,
             height = int(max(src_height * width / src_width, 1))
         else:
             width = int(max(src_width * height / src_height, 1))
+        if mipmap:
+            src = get_mipmap(src, width, height,
+                build=interpolation != gtk.gdk.INTERP_NEAREST)
 
         if src.get_has_alpha():
             if prefs['checkered bg for transparent images']:
                 src = src.composite_color_simple(width, height,
-                    gtk.gdk.INTERP_TILES, 255, 8, 0x777777, 0x999999)
+                    interpolation, 255, 8, 0x777777, 0x999999)
             else:
                 src = src.composite_color_simple(width, height,
-                    gtk.gdk.INTERP_TILES, 255, 1024, 0xFFFFFF, 0xFFFFFF)
+                    interpolation, 255, 1024, 0xFFFFFF, 0xFFFFFF)
         else:
-            src = src.scale_simple(width, height, gtk.gdk.INTERP_TILES)
+            src = src.scale_simple(width, height, interpolation)
 
     if rotation == 90:
         src = src.rotate_simple(gtk.gdk.PIXBUF_ROTATE_CLOCKWISE)
@@ -116,7 +130,8 @@ def fit_in_rectangle(src, width, height, scale_up=False, rotation=0,
 
 
 def fit_2_in_rectangle(src1, src2, width, height, scale_up=False,
-  rotation1=0, rotation2=0, animated1=False, animated2=False):
+  rotation1=0, rotation2=0, animated1=False, animated2=False,
+  interpolation=gtk.gdk.INTERP_TILES, mipmap=False):
     """Scale two pixbufs so that they fit together (side-by-side) into a
     rectangle with dimensions <width> x <height>, with a 2 px gap.
     If one pixbuf does not use all of its allotted space, the other one
@@ -144,10 +159,16 @@ def fit_2_in_rectangle(src1, src2, width, height, scale_up=False,
     width = max(width, 2)   # We need at least 1 px per image
     height = max(height, 1)
 
-    src1_width = src1.get_width()
-    src1_height = src1.get_height()
-    src2_width = src2.get_width()
-    src2_height = src2.get_height()
+    # Pixbufs decoded at reduced size are given space by their real size,
+    # so that the pages keep their proportions.
+    if animated1:
+        src1_width, src1_height = src1.get_width(), src1.get_height()
+    else:
+        src1_width, src1_height = get_original_size(src1)
+    if animated2:
+        src2_width, src2_height = src2.get_width(), src2.get_height()
+    else:
+        src2_width, src2_height = get_original_size(src2)
 # TODO: Fix the animated stuff. Eventually PixbufAnimation resizing should be  possible.
     if not animated1 and rotation1 in (90, 270):
         src1_width, src1_height = src1_height, src1_width
@@ -173,9 +194,37 @@ def fit_2_in_rectangle(src1, src2, width, height, scale_up=False,
         alloc_width_src1 += alloc_width_src2 - needed_width_src2
 
     return (fit_in_rectangle(src1, int(alloc_width_src1), height,
-                             scale_up, rotation1, animated1),
+                             scale_up, rotation1, animated1, interpolation,
+                             mipmap),
             fit_in_rectangle(src2, int(alloc_width_src2), height,
-                             scale_up, rotation2, animated2))
+                             scale_up, rotation2, animated2, interpolation,
+                             mipmap))
+
+
+def get_mipmap(pixbuf, width, height, build=True):
+    """Return the smallest level of the mipmap pyramid of <pixbuf> that is
+    at least <width> x <height>, which is <pixbuf> itself if nothing
+    smaller is. The levels are pixbufs of 1/2, 1/4 and 1/8 of the size of
+    <pixbuf>, each scaled from the one before. They are built when they
+    are first needed, unless <build> is False, and each is kept with the
+    level above it, taking at most a third more memory than <pixbuf>
+    together (see pixbufcache.get_pixbuf_size()).
+    """
+    level = pixbuf
+    for i in xrange(3):
+        level_width = level.get_width() // 2
+        level_height = level.get_height() // 2
+        if level_width < width or level_height < height:
+            break
+        next_level = level.get_data('comix-mipmap')
+        if next_level is None:
+            if not build:
+                break
+            next_level = level.scale_simple(max(level_width, 1),
+                max(level_height, 1), gtk.gdk.INTERP_TILES)
+            level.set_data('comix-mipmap', next_level)
+        level = next_level
+    return level
 
 
 def add_border(pixbuf, thickness, colour=0x000000FF):
@@ -201,6 +250,8 @@ def get_most_common_edge_colour(pixbuf):
     """
     if isinstance(pixbuf, gtk.gdk.PixbufAnimation):
         pixbuf = pixbuf.get_static_image()
+    if numpy is not None:
+        return _get_most_common_edge_colour_numpy(pixbuf)
     width = pixbuf.get_width()
     height = pixbuf.get_height()
     top_edge = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, True, 8, width, 1)
@@ -226,6 +277,29 @@ def get_most_common_edge_colour(pixbuf):
     return [val * 257 for val in most_common_colour]
 
 
+def _get_most_common_edge_colour_numpy(pixbuf):
+    """Do what get_most_common_edge_colour() does, with NumPy, straight on
+    the pixel data of <pixbuf>.
+    """
+    width = pixbuf.get_width()
+    height = pixbuf.get_height()
+    channels = pixbuf.get_n_channels()
+    rowstride = pixbuf.get_rowstride()
+    # The last row is not padded to the full rowstride.
+    pixels = numpy.frombuffer(pixbuf.get_pixels(), numpy.uint8,
+        rowstride * (height - 1) + width * channels)
+    rows = numpy.lib.stride_tricks.as_strided(pixels,
+        shape=(height, width, channels), strides=(rowstride, channels, 1))
+    edges = numpy.concatenate((rows[0], rows[-1], rows[:, 0], rows[:, -1]))
+    # Count the colours as 24 bit numbers, alpha is ignored.
+    colours = (edges[:, 0].astype(numpy.uint32) << 16 |
+        edges[:, 1].astype(numpy.uint32) << 8 | edges[:, 2])
+    values, indices = numpy.unique(colours, return_inverse=True)
+    colour = int(values[numpy.bincount(indices).argmax()])
+    return [(colour >> 16) * 257, (colour >> 8 & 0xff) * 257,
+        (colour & 0xff) * 257]
+
+
 def pil_to_pixbuf(image):
     """Return a pixbuf created from the PIL <image>."""
     IS_RGBA = image.mode == 'RGBA'
@@ -242,6 +316,88 @@ def pil_to_pixbuf(image):
         (IS_RGBA and 4 or 3) * image.size[0])
 
 
+def pixbuf_from_data(data, animated=False, target=None):
+    """Return a pixbuf decoded from the string <data>, which holds the
+    contents of an image file. If <animated> is True and the image
+    actually is animated, a PixbufAnimation is returned instead.
+
+    If <target> is a (width, height) tuple the image is decoded at a
+    reduced size if that is still large enough to fill it, see
+    get_decode_reduction().
+    """
+    loader = gtk.gdk.PixbufLoader()
+    original_size = []
+    if target is not None and not animated:
+        def size_prepared(loader, width, height):
+            reduction = get_decode_reduction(width, height, target)
+            if reduction > 1:
+                original_size.extend((width, height, reduction))
+                loader.set_size(max(width // reduction, 1),
+                    max(height // reduction, 1))
+        loader.connect('size-prepared', size_prepared)
+    try:
+        loader.write(data)
+    finally:
+        loader.close()
+    if animated and not loader.get_animation().is_static_image():
+        return loader.get_animation()
+    pixbuf = loader.get_pixbuf()
+    if original_size:
+        set_original_size(pixbuf, *original_size)
+    return pixbuf
+
+
+def get_decode_reduction(width, height, target):
+    """Return the factor (1, 2, 4 or 8) by which an image of <width> x
+    <height> can be shrunk when it is decoded, so that it still does not
+    have to be scaled up to fit in a rectangle of <target> (a (width,
+    height) tuple, where a negative value is unbounded, as for
+    fit_in_rectangle()) when it is displayed, rotated or not.
+    """
+    box_width, box_height = target
+    scale = 0.0
+    for image_width, image_height in ((width, height), (height, width)):
+        scales = []
+        if box_width >= 0:
+            scales.append(float(box_width) / max(image_width, 1))
+        if box_height >= 0:
+            scales.append(float(box_height) / max(image_height, 1))
+        if not scales:
+            return 1
+        scale = max(scale, min(scales))
+    reduction = 1
+    while reduction < 8 and scale * reduction * 2 < 1:
+        reduction *= 2
+    return reduction
+
+
+def set_original_size(pixbuf, width, height, reduction):
+    """Note on <pixbuf> that it was decoded at 1/<reduction> of the size
+    of the original <width> x <height> image.
+    """
+    pixbuf.set_data('comix-original-size', (width, height, reduction))
+
+
+def get_original_size(pixbuf):
+    """Return the (width, height) of the image that <pixbuf> was decoded
+    from, which is larger than the pixbuf if it was decoded at reduced size.
+    """
+    original = pixbuf.get_data('comix-original-size')
+    if original is None:
+        return pixbuf.get_width(), pixbuf.get_height()
+    return original[:2]
+
+
+def get_reduction(pixbuf):
+    """Return the factor by which <pixbuf> was shrunk when it was decoded,
+    1 if it is at full size.
+    """
+    original = pixbuf.get_data('comix-original-size')
+    if original is None:
+        return 1
+    return original[2]
+
+
 def pixbuf_to_pil(pixbuf):
     """Return a PIL image created from <pixbuf>."""
     dimensions = pixbuf.get_width(), pixbuf.get_height()
@@ -257,15 +413,20 @@ def enhance(pixbuf, brightness=1.0, contrast=1.0, saturation=1.0,
     corresponding to each argument has been performed. A value of 1.0 means
     no change. If <autocontrast> is True it overrides the <contrast> value,
     but only if the image mode is supported by ImageOps.autocontrast (i.e.
-    it is L or RGB.)
+    it is RGB, not RGBA.)
+
+    Brightness and contrast are applied together, in a single pass through
+    a lookup table. The alpha channel, if any, is left as it is.
     """
     im = pixbuf_to_pil(pixbuf)
-    if brightness != 1.0:
-        im = ImageEnhance.Brightness(im).enhance(brightness)
-    if autocontrast and im.mode in ('L', 'RGB'):
-        im = ImageOps.autocontrast(im, cutoff=0.1)
-    elif contrast != 1.0:
-        im = ImageEnhance.Contrast(im).enhance(contrast)
+    bands = len(im.getbands())
+    autocontrast = autocontrast and bands == 3
+    if brightness != 1.0 or contrast != 1.0 or autocontrast:
+        grey_hist_data = None
+        if contrast != 1.0 and not autocontrast and brightness == 1.0:
+            grey_hist_data = get_grey_histogram(pixbuf)
+        im = im.point(get_enhance_lut(get_histogram(pixbuf), bands,
+            brightness, contrast, autocontrast, grey_hist_data))
     if saturation != 1.0:
         im = ImageEnhance.Color(im).enhance(saturation)
     if sharpness != 1.0:
@@ -273,6 +434,123 @@ def enhance(pixbuf, brightness=1.0, contrast=1.0, saturation=1.0,
     return pil_to_pixbuf(im)
 
 
+def get_histogram(pixbuf):
+    """Return the histogram of <pixbuf>, as a list of 256 pixel counts
+    per channel (RGB or RGBA). It is counted when it is first needed and
+    kept with <pixbuf>.
+    """
+    hist_data = pixbuf.get_data('comix-histogram')
+    if hist_data is None:
+        hist_data = pixbuf_to_pil(pixbuf).histogram()
+        pixbuf.set_data('comix-histogram', hist_data)
+    return hist_data
+
+
+def get_grey_histogram(pixbuf):
+    """Return the histogram of the greyscale version of <pixbuf>, as a
+    list of 256 pixel counts. It is kept with <pixbuf> like the one from
+    get_histogram().
+    """
+    hist_data = pixbuf.get_data('comix-grey-histogram')
+    if hist_data is None:
+        hist_data = pixbuf_to_pil(pixbuf).convert('L').histogram()
+        pixbuf.set_data('comix-grey-histogram', hist_data)
+    return hist_data
+
+
+def get_enhance_lut(hist_data, bands, brightness=1.0, contrast=1.0,
+  autocontrast=False, grey_hist_data=None):
+    """Return a lookup table, for use with Image.point(), that changes the
+    <brightness> and then the <contrast> of an image with <bands> bands
+    (3 for RGB or 4 for RGBA). The alpha band is left as it is.
+
+    The values are worked out like ImageEnhance.Brightness followed by
+    ImageEnhance.Contrast (or ImageOps.autocontrast with a 0.1% cutoff, if
+    <autocontrast> is True) work them out, without the intermediate images.
+    <hist_data> is the histogram of the image.
+
+    The contrast is changed around the mean of the greyscale version of
+    the image after the brightness change. If <grey_hist_data>, the
+    histogram of that greyscale version, is given the mean is exact.
+    Otherwise it is worked out from <hist_data>, without another pass over
+    the image, but PIL truncates every greyscale pixel on its own, so the
+    result can then (rarely) be one level off.
+    """
+    bright = [_blend(0, value, brightness) for value in xrange(256)]
+    lut = []
+    if autocontrast:
+        for band in xrange(3):
+            # The histogram of the band after the brightness change.
+            band_hist = [0] * 256
+            for value, count in enumerate(
+              hist_data[band * 256:band * 256 + 256]):
+                band_hist[bright[value]] += count
+            band_lut = _get_autocontrast_lut(band_hist)
+            lut.extend([band_lut[value] for value in bright])
+    elif contrast != 1.0:
+        pixels = max(sum(hist_data[:256]), 1)
+        if grey_hist_data is not None:
+            total = sum([value * count for value, count in
+                enumerate(grey_hist_data)])
+        else:
+            # The weights that Image.convert('L') uses, in 1/65536.
+            total = 0
+            for band, weight in enumerate((19595, 38470, 7471)):
+                total += weight * sum([bright[value] * count
+                    for value, count in enumerate(
+                    hist_data[band * 256:band * 256 + 256])])
+            # PIL truncates the greyscale values, by half a level on
+            # average.
+            total = total / 65536.0 - 0.5 * pixels
+        mean = int(float(total) / pixels + 0.5)
+        lut = [_blend(mean, value, contrast) for value in bright] * 3
+    else:
+        lut = bright * 3
+    if bands == 4:
+        lut.extend(range(256))
+    return lut
+
+
+def _get_autocontrast_lut(band_hist, cutoff=0.1):
+    """Return the 256 entry lookup table that ImageOps.autocontrast uses
+    for a band with the histogram <band_hist>, where <cutoff> percent of
+    the pixels are removed from each end of the histogram.
+    """
+    band_hist = band_hist[:]
+    cut = sum(band_hist) * cutoff // 100
+    for values in (xrange(256), xrange(255, -1, -1)):
+        remaining = cut
+        for value in values:
+            if remaining > band_hist[value]:
+                remaining -= band_hist[value]
+                band_hist[value] = 0
+            else:
+                band_hist[value] -= remaining
+                break
+    used = [value for value in xrange(256) if band_hist[value]]
+    if not used or used[-1] <= used[0]:
+        return range(256)
+    low, high = used[0], used[-1]
+    scale = 255.0 / (high - low)
+    offset = -low * scale
+    return [min(255, max(0, int(value * scale + offset)))
+        for value in xrange(256)]
+
+
+def _blend(value1, value2, alpha):
+    """Return the pixel value that Image.blend() makes from <value1> and
+    <value2> with <alpha>. Like PIL, this is computed with single precision
+    floats and truncated.
+    """
+    value = _float32(value1 + _float32(_float32(alpha) * (value2 - value1)))
+    return min(255, max(0, int(value)))
+
+
+def _float32(value):
+    """Return <value> rounded to a single precision float."""
+    return struct.unpack('f', struct.pack('f', value))[0]
+
+
 def get_implied_rotation(pixbuf):
     """Return the implied rotation of the pixbuf, as given by the pixbuf's
     orientation option (the value of which is based on EXIF data etc.).
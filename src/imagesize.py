@@ -0,0 +1,128 @@
+"""imagesize.py - Image dimensions read from file headers.
+
+Finding out the size of an image with gdk-pixbuf or PIL can mean decoding
+much or all of it. The common formats store the size near the start of
+the file though, so for those it is read straight from the header here.
+"""
+
+import struct
+
+# JPEG markers that start a frame (and hold the image size), i.e. all
+# SOFn markers except DHT, JPG and DAC, which share the range.
+_JPEG_SOF_MARKERS = set(range(0xc0, 0xd0)) - set((0xc4, 0xc8, 0xcc))
+# JPEG markers that stand alone, without a length field (TEM, RSTn and
+# SOI). EOI is handled on its own, it ends the search.
+_JPEG_STANDALONE_MARKERS = set(range(0xd0, 0xd9)) | set((0x01,))
+
+
+def get_file_size(path):
+    """Return the (width, height) of the image file at <path>, or None if
+    it can not be read from the header.
+    """
+    try:
+        fd = open(path, 'rb')
+        try:
+            return get_size(fd)
+        finally:
+            fd.close()
+    except IOError:
+        return None
+
+
+def get_size(fd):
+    """Return the (width, height) of the image in the file object <fd>,
+    read from the current position on, or None if it can not be read
+    from the header. Only fd.read() is used, so <fd> does not have to be
+    seekable (e.g. a member opened with ZipFile.open()).
+    """
+    try:
+        header = fd.read(30)
+        if header[:8] == '\x89PNG\r\n\x1a\n' and header[12:16] == 'IHDR':
+            return struct.unpack('>II', header[16:24])
+        if header[:6] in ('GIF87a', 'GIF89a'):
+            return struct.unpack('<HH', header[6:10])
+        if header[:2] == 'BM':
+            return _get_bmp_size(header)
+        if header[:4] == 'RIFF' and header[8:12] == 'WEBP':
+            return _get_webp_size(header)
+        if header[:2] == '\xff\xd8':
+            return _get_jpeg_size(fd, header[2:])
+    except (struct.error, IndexError):
+        pass
+    return None
+
+
+def _get_bmp_size(header):
+    """Return the size from the BMP file <header>, its first 30 bytes."""
+    if struct.unpack('<I', header[14:18])[0] == 12:
+        # OS/2 1.x bitmap with 16 bit dimensions.
+        return struct.unpack('<HH', header[18:22])
+    width, height = struct.unpack('<ii', header[18:26])
+    # Top-down bitmaps have negative heights.
+    return width, abs(height)
+
+
+def _get_webp_size(header):
+    """Return the size from the WebP file <header>, the first 30 bytes."""
+    chunk = header[12:16]
+    if chunk == 'VP8 ':
+        width, height = struct.unpack('<HH', header[26:30])
+        return width & 0x3fff, height & 0x3fff
+    if chunk == 'VP8L':
+        bits = struct.unpack('<I', header[21:25])[0]
+        return (bits & 0x3fff) + 1, (bits >> 14 & 0x3fff) + 1
+    if chunk == 'VP8X':
+        width = struct.unpack('<I', header[24:27] + '\x00')[0]
+        height = struct.unpack('<I', header[27:30] + '\x00')[0]
+        return width + 1, height + 1
+    return None
+
+
+def _get_jpeg_size(fd, data):
+    """Return the size from the first frame header of the JPEG file <fd>,
+    whose data after the SOI marker starts with <data>. The segments in
+    front of it (e.g. EXIF data) are skipped.
+    """
+    while True:
+        data = _read_up_to(fd, data, 4)
+        if data[0] != '\xff':
+            return None
+        marker = ord(data[1])
+        if marker == 0xff:
+            # Fill byte.
+            data = data[1:]
+            continue
+        if marker in _JPEG_STANDALONE_MARKERS:
+            data = data[2:]
+            continue
+        if marker == 0xd9 or marker == 0xda:
+            # End of image, or start of the image data before any frame.
+            return None
+        length = struct.unpack('>H', data[2:4])[0]
+        if marker in _JPEG_SOF_MARKERS:
+            data = _read_up_to(fd, data, 9)
+            height, width = struct.unpack('>HH', data[5:9])
+            return width, height
+        if len(data) >= 2 + length:
+            data = data[2 + length:]
+            continue
+        # Skip what is left of the segment without keeping it around.
+        skip = 2 + length - len(data)
+        data = ''
+        while skip > 0:
+            skipped = len(fd.read(min(skip, 0x10000)))
+            if not skipped:
+                return None
+            skip -= skipped
+
+
+def _read_up_to(fd, data, size):
+    """Return <data> with bytes read from <fd> appended until it is at
+    least <size> bytes long. Raises IndexError at the end of the file.
+    """
+    while len(data) < size:
+        more = fd.read(max(size - len(data), 4096))
+        if not more:
+            raise IndexError('unexpected end of file')
+        data += more
+    return data
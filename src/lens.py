@@ -1,13 +1,15 @@
 """lens.py - Magnifying glass."""
 
-import math
-
 import gtk
+import gobject
 
 import cursor
 from preferences import prefs
 import image
 
+# Milliseconds between updates of the lens, about once per screen refresh.
+_FRAME_INTERVAL = 16
+
 
 class MagnifyingGlass:
 
@@ -23,41 +25,75 @@ class MagnifyingGlass:
 
     def __init__(self, window):
         self._window = window
+        self._pointer = None
+        self._update_id = None
+        self._canvas = None
+        # Magnified image data around the lens, for the left and right
+        # images (keyed by True and False), as tuples (state, rect, tile).
+        self._tiles = {}
 
     def set_lens_cursor(self, x, y):
         """Calculate what image data to put in the lens and update the cursor
         with it; <x> and <y> are the positions of the cursor within the
         main window layout area.
+
+        The lens is updated at most once per frame, so a quick succession
+        of calls (i.e. pointer motion) only draws it for the last position.
         """
-        if not self._window.file_handler.file_loaded:
-            return
-        pixbuf = self._get_lens_pixbuf(x, y)
-        cursor = gtk.gdk.Cursor(gtk.gdk.display_get_default(), pixbuf,
-            prefs['lens size'] // 2, prefs['lens size'] // 2)
-        self._window.cursor_handler.set_cursor_type(cursor)
+        self._pointer = (x, y)
+        if self._update_id is None:
+            self._update_id = gobject.timeout_add(_FRAME_INTERVAL,
+                self._update_lens)
 
     def toggle(self, action):
         """Toggle on or off the lens depending on the state of <action>."""
         if action.get_active():
             x, y = self._window.get_layout_pointer_position()
-            self.set_lens_cursor(x, y)
+            self._draw_lens(x, y)
         else:
+            if self._update_id is not None:
+                gobject.source_remove(self._update_id)
+                self._update_id = None
+            self._tiles.clear()
             self._window.cursor_handler.set_cursor_type(cursor.NORMAL)
 
+    def _update_lens(self):
+        """Draw the lens at the last pointer position given."""
+        self._update_id = None
+        self._draw_lens(*self._pointer)
+        return False
+
+    def _draw_lens(self, x, y):
+        """Put the image data around <x>, <y> in the lens cursor."""
+        if not self._window.file_handler.file_loaded:
+            return
+        pixbuf = self._get_lens_pixbuf(x, y)
+        cursor = gtk.gdk.Cursor(gtk.gdk.display_get_default(), pixbuf,
+            prefs['lens size'] // 2, prefs['lens size'] // 2)
+        self._window.cursor_handler.set_cursor_type(cursor)
+
     def _get_lens_pixbuf(self, x, y):
         """Get a pixbuf containing the appropiate image data for the lens
         where <x> and <y> are the positions of the cursor.
         """
-        canvas = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, True, 8,
-            prefs['lens size'], prefs['lens size'])
+        # The cursor gets its own copy of the data, so the same pixbuf is
+        # reused for every drawing of the lens.
+        size = prefs['lens size'] + 2
+        if self._canvas is None or self._canvas.get_width() != size:
+            self._canvas = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, True, 8,
+                size, size)
+            self._canvas.fill(0x000000ff)
+        canvas = self._canvas.subpixbuf(1, 1, size - 2, size - 2)
         canvas.fill(0x000000bb)
         if self._window.displayed_double():
             if self._window.is_manga_mode:
                 r_source_pixbuf, l_source_pixbuf = \
-                    self._window.file_handler.get_pixbufs()
+                    self._window.file_handler.get_pixbufs(
+                        full_size=True)
             else:
                 l_source_pixbuf, r_source_pixbuf = \
-                    self._window.file_handler.get_pixbufs()
+                    self._window.file_handler.get_pixbufs(
+                        full_size=True)
             l_image_size = self._window.left_image.size_request()
             r_image_size = self._window.right_image.size_request()
             self._add_subpixbuf(canvas, x, y, l_image_size, l_source_pixbuf,
@@ -65,10 +101,11 @@ class MagnifyingGlass:
             self._add_subpixbuf(canvas, x, y, r_image_size, r_source_pixbuf,
                 l_image_size[0], left=False)
         else:
-            source_pixbuf = self._window.file_handler.get_pixbufs()
+            source_pixbuf = self._window.file_handler.get_pixbufs(
+                full_size=True)
             image_size = self._window.left_image.size_request()
             self._add_subpixbuf(canvas, x, y, image_size, source_pixbuf)
-        return image.add_border(canvas, 1)
+        return self._canvas
 
     def _add_subpixbuf(self, canvas, x, y, image_size, source_pixbuf,
         other_image_width=0, left=True):
@@ -84,6 +121,10 @@ class MagnifyingGlass:
 
         The image we are getting the coordinates for is the left one unless
         <left> is False.
+
+        The magnified image data is made for an area around the lens that
+        is twice its size, and kept for the following calls. Only when the
+        lens moves out of that area is more data scaled from <source_pixbuf>.
         """
         area_x, area_y = self._window.get_visible_area_size()
         if left:
@@ -100,80 +141,89 @@ class MagnifyingGlass:
         if prefs['auto rotate from exif']:
             rotation += image.get_implied_rotation(source_pixbuf)
             rotation = rotation % 360
-
-        if rotation in [90, 270]:
-            scale = float(source_pixbuf.get_height()) / image_size[0]
-        else:
-            scale = float(source_pixbuf.get_width()) / image_size[0]
-        x *= scale
-        y *= scale
-        source_mag = prefs['lens magnification'] / scale
-        width = prefs['lens size'] / source_mag
-        height = width
-        paste_left = x > width / 2
-        paste_top = y > height / 2
-        dest_x = max(0, int(math.ceil((width / 2 - x) * source_mag)))
-        dest_y = max(0, int(math.ceil((height / 2 - y) * source_mag)))
-
-        if rotation == 90:
-            x, y = y, source_pixbuf.get_height() - x
-        elif rotation == 180:
-            x = source_pixbuf.get_width() - x
-            y = source_pixbuf.get_height() - y
-        elif rotation == 270:
-            x, y = source_pixbuf.get_width() - y, x
-        if prefs['horizontal flip']:
-            if rotation in (90, 270):
-                y = source_pixbuf.get_height() - y
-            else:
-                x = source_pixbuf.get_width() - x
-        if prefs['vertical flip']:
-            if rotation in (90, 270):
-                x = source_pixbuf.get_width() - x
-            else:
-                y = source_pixbuf.get_height() - y
-
-        src_x = x - width / 2
-        src_y = y - height / 2
-        if src_x < 0:
-            width += src_x
-            src_x = 0
-        if src_y < 0:
-            height += src_y
-            src_y = 0
-        width = max(0, min(source_pixbuf.get_width() - src_x, width))
-        height = max(0, min(source_pixbuf.get_height() - src_y, height))
-        if width < 1 or height < 1:
+        hflip = prefs['horizontal flip']
+        vflip = prefs['vertical flip']
+        magnification = prefs['lens magnification']
+        lens_size = prefs['lens size']
+
+        # The whole magnified image, as it would be displayed, is
+        # <width> x <height>. Everything below is in its coordinates.
+        width = int(image_size[0] * magnification)
+        height = int(image_size[1] * magnification)
+        lens_x = int(x * magnification) - lens_size // 2
+        lens_y = int(y * magnification) - lens_size // 2
+        x0 = max(0, lens_x)
+        y0 = max(0, lens_y)
+        x1 = min(width, lens_x + lens_size)
+        y1 = min(height, lens_y + lens_size)
+        if x1 <= x0 or y1 <= y0:
             return
 
-        subpixbuf = source_pixbuf.subpixbuf(int(src_x), int(src_y),
-            int(width), int(height))
-        subpixbuf = subpixbuf.scale_simple(
-            int(math.ceil(source_mag * subpixbuf.get_width())),
-            int(math.ceil(source_mag * subpixbuf.get_height())),
-            gtk.gdk.INTERP_TILES)
-
-        if rotation == 90:
-            subpixbuf = subpixbuf.rotate_simple(
-                gtk.gdk.PIXBUF_ROTATE_CLOCKWISE)
-        elif rotation == 180:
-            subpixbuf = subpixbuf.rotate_simple(
-                gtk.gdk.PIXBUF_ROTATE_UPSIDEDOWN)
-        elif rotation == 270:
-            subpixbuf = subpixbuf.rotate_simple(
-                gtk.gdk.PIXBUF_ROTATE_COUNTERCLOCKWISE)
-        if prefs['horizontal flip']:
-            subpixbuf = subpixbuf.flip(horizontal=True)
-        if prefs['vertical flip']:
-            subpixbuf = subpixbuf.flip(horizontal=False)
-        if paste_left:
-            dest_x = 0
-        else:
-            dest_x = min(canvas.get_width() - subpixbuf.get_width(), dest_x)
-        if paste_top:
-            dest_y = 0
-        else:
-            dest_y = min(canvas.get_height() - subpixbuf.get_height(), dest_y)
-
-        subpixbuf.copy_area(0, 0, subpixbuf.get_width(),
-            subpixbuf.get_height(), canvas, dest_x, dest_y)
+        state = (source_pixbuf, image_size, rotation, hflip, vflip,
+            magnification, lens_size)
+        tile_state, rect, tile = self._tiles.get(left, (None, None, None))
+        if (tile_state != state or x0 < rect[0] or y0 < rect[1] or
+          x1 > rect[0] + rect[2] or y1 > rect[1] + rect[3]):
+            tile_x = max(0, lens_x - lens_size // 2)
+            tile_y = max(0, lens_y - lens_size // 2)
+            rect = (tile_x, tile_y,
+                min(width, lens_x + lens_size * 3 // 2) - tile_x,
+                min(height, lens_y + lens_size * 3 // 2) - tile_y)
+            tile = _scale_region(source_pixbuf, rect, width, height,
+                rotation, hflip, vflip)
+            self._tiles[left] = (state, rect, tile)
+        tile.copy_area(x0 - rect[0], y0 - rect[1], x1 - x0, y1 - y0,
+            canvas, x0 - lens_x, y0 - lens_y)
+
+
+def _scale_region(source_pixbuf, rect, width, height, rotation, hflip,
+  vflip):
+    """Return the region <rect> (x, y, width, height) of <source_pixbuf>
+    as it would be if the whole of it was scaled to <width> x <height>,
+    after it has been rotated by <rotation> degrees and flipped if <hflip>
+    or <vflip> is True. Only the region itself is scaled.
+    """
+    x, y, region_width, region_height = _get_source_rect(rect, width,
+        height, rotation, hflip, vflip)
+    if rotation in (90, 270):
+        width, height = height, width
+    # If the region is less than half the size of the source pixbuf, a
+    # level of its mipmap pyramid is used instead.
+    if prefs['mipmap pages'] and width < source_pixbuf.get_width() // 2:
+        source_pixbuf = image.get_mipmap(source_pixbuf, width, height)
+    region = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB,
+        source_pixbuf.get_has_alpha(), 8, region_width, region_height)
+    source_pixbuf.scale(region, 0, 0, region_width, region_height, -x, -y,
+        float(width) / source_pixbuf.get_width(),
+        float(height) / source_pixbuf.get_height(), gtk.gdk.INTERP_TILES)
+    if rotation == 90:
+        region = region.rotate_simple(gtk.gdk.PIXBUF_ROTATE_CLOCKWISE)
+    elif rotation == 180:
+        region = region.rotate_simple(gtk.gdk.PIXBUF_ROTATE_UPSIDEDOWN)
+    elif rotation == 270:
+        region = region.rotate_simple(gtk.gdk.PIXBUF_ROTATE_COUNTERCLOCKWISE)
+    if hflip:
+        region = region.flip(horizontal=True)
+    if vflip:
+        region = region.flip(horizontal=False)
+    return region
+
+
+def _get_source_rect(rect, width, height, rotation, hflip, vflip):
+    """Return the rectangle (x, y, width, height) in an image that is
+    <rect> in the <width> x <height> image made by rotating it by
+    <rotation> degrees and then flipping it if <hflip> or <vflip> is True.
+    """
+    x, y, rect_width, rect_height = rect
+    if hflip:
+        x = width - x - rect_width
+    if vflip:
+        y = height - y - rect_height
+    if rotation == 90:
+        return y, width - x - rect_width, rect_height, rect_width
+    if rotation == 180:
+        return (width - x - rect_width, height - y - rect_height,
+            rect_width, rect_height)
+    if rotation == 270:
+        return height - y - rect_height, x, rect_height, rect_width
+    return x, y, rect_width, rect_height
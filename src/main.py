@@ -16,12 +16,18 @@ import event
 import filehandler
 import image
 import lens
+import pixbufcache
 import preferences
 from preferences import prefs
 import ui
 import slideshow
 import status
 import thumbbar
+import workerpool
+
+# Milliseconds without resizing or zooming after which the pages that were
+# drawn quickly during it are drawn again in full quality.
+_HIGH_QUALITY_DELAY = 250
 
 
 class MainWindow(gtk.Window):
@@ -47,6 +53,21 @@ class MainWindow(gtk.Window):
 
         self._manual_zoom = 100 # In percent of original image size
         self._waiting_for_redraw = False
+        # Final (scaled, rotated, flipped and enhanced) pixbufs.
+        self._scaled_pixbufs = pixbufcache.PixbufCache(
+            prefs['scaled cache size'] * 1048576)
+        # The final pixbufs are rendered in this worker thread. Results
+        # from before the last draw_image() call are out of date.
+        self._renderer = workerpool.WorkerPool(1)
+        self._render_generation = 0
+        self._render_info = None
+        # Smart background colours, (left page, output state) -> colour.
+        self._bg_colours = {}
+        # Interpolation for the next drawing, and the state of bursts of
+        # interactive drawing (see draw_image()).
+        self._interpolation = gtk.gdk.INTERP_TILES
+        self._interactive_id = None
+        self._needs_high_quality = False
 
         self.file_handler = filehandler.FileHandler(self)
         self.thumbnailsidebar = thumbbar.ThumbnailSidebar(self)
@@ -196,23 +217,40 @@ class MainWindow(gtk.Window):
         if show_library:
             self.actiongroup.get_action('library').activate()
 
-    def draw_image(self, at_bottom=False, scroll=True):
+    def draw_image(self, at_bottom=False, scroll=True, interactive=False):
         """Draw the current page(s) and update the titlebar and statusbar.
+
+        If <interactive> is True the drawing is part of a burst, e.g. while
+        the window is being resized or zoom is being stepped. The first
+        drawing in a burst is done as usual, the following ones are done
+        quickly in lower quality, and after the burst the pages are drawn
+        again in full quality.
         """
+        # Whatever is being rendered for an earlier call is out of date.
+        self._render_generation += 1
+        self._renderer.cancel_all()
+        if interactive:
+            if self._interactive_id is not None:
+                gobject.source_remove(self._interactive_id)
+                self._interpolation = gtk.gdk.INTERP_NEAREST
+                self._needs_high_quality = True
+            else:
+                self._interpolation = gtk.gdk.INTERP_TILES
+            self._interactive_id = gobject.timeout_add(_HIGH_QUALITY_DELAY,
+                self._end_interactive)
+        else:
+            self._interpolation = gtk.gdk.INTERP_TILES
         if not self._waiting_for_redraw: # Don't stack up redraws.
             self._waiting_for_redraw = True
             gobject.idle_add(self._draw_image, at_bottom, scroll,
                 priority=gobject.PRIORITY_HIGH_IDLE)
 
     def _draw_image(self, at_bottom, scroll):
-        def pixb_process(pixbuf):
-            """ Small helper for common stuff to few pixbufs. """
-            if prefs['horizontal flip']:
-                pixbuf = pixbuf.flip(horizontal=True)
-            if prefs['vertical flip']:
-                pixbuf = pixbuf.flip(horizontal=False)
-            pixbuf = self.enhancer.enhance(pixbuf)
-            return pixbuf
+        """Work out how the current page(s) should be drawn. The finished
+        pixbufs are taken from the cache if they are there, otherwise
+        they are rendered in a worker thread, so that the main loop can go
+        on meanwhile. Either way _show_pages() puts them on display.
+        """
         self._waiting_for_redraw = False
         self._display_active_widgets()
         if not self.file_handler.file_loaded:
@@ -229,6 +267,12 @@ class MainWindow(gtk.Window):
         scale_up = prefs['stretch']
         self.is_virtual_double_page = \
             self.file_handler.get_virtual_double_page()
+        self._scaled_pixbufs.set_max_size(
+            prefs['scaled cache size'] * 1048576)
+        # Everything but the page and size that the final pixbufs depend on.
+        plain_state = (prefs['horizontal flip'], prefs['vertical flip'],
+            prefs['checkered bg for transparent images'])
+        output_state = plain_state + (self.enhancer.get_parameters(),)
         # TODO: If and when it becomes possible to resize (and do other things)
         #       to PixbufAnimation objects, change these hacks to make them work
         #       correctly. All the conditionals about animated are part of this
@@ -239,10 +283,12 @@ class MainWindow(gtk.Window):
             #instead of modifying returns, just do two extra calls here
             left_animated = isinstance(left_pixbuf, gtk.gdk.PixbufAnimation)
             right_animated = isinstance(right_pixbuf, gtk.gdk.PixbufAnimation)
-            left_unscaled_x = left_pixbuf.get_width()
-            left_unscaled_y = left_pixbuf.get_height()
-            right_unscaled_x = right_pixbuf.get_width()
-            right_unscaled_y = right_pixbuf.get_height()
+            # Sizes of the images themselves, also for pixbufs that were
+            # decoded at a reduced size.
+            left_unscaled_x, left_unscaled_y = \
+                image.get_original_size(left_pixbuf)
+            right_unscaled_x, right_unscaled_y = \
+                image.get_original_size(right_pixbuf)
 
             left_rotation = prefs['rotation']
             right_rotation = prefs['rotation']
@@ -272,108 +318,175 @@ class MainWindow(gtk.Window):
                 scaled_height = int(self._manual_zoom * total_height / 100)
                 scale_up = True
 
-            left_pixbuf, right_pixbuf = image.fit_2_in_rectangle(
-                left_pixbuf, right_pixbuf, scaled_width, scaled_height,
-                scale_up=scale_up, rotation1=left_rotation,
-                rotation2=right_rotation, animated1=left_animated,
-                animated2=right_animated)
-            if not left_animated:
-                pixb_process(left_pixbuf)
-                self.left_image.set_from_pixbuf(left_pixbuf)
-            else:
-                self.left_image.set_from_animation(left_pixbuf)
-            if not right_animated:
-                pixb_process(right_pixbuf)
-                self.right_image.set_from_pixbuf(right_pixbuf)
-            else:
-                self.right_image.set_from_animation(right_pixbuf)
-
-            x_padding = (area_width - left_pixbuf.get_width() -
-                right_pixbuf.get_width()) / 2
-            y_padding = (area_height - max(left_pixbuf.get_height(),
-                right_pixbuf.get_height())) / 2
-
-            if not left_animated and left_rotation in (90, 270):
-                left_scale_percent = (100.0 * left_pixbuf.get_width() /
-                    left_unscaled_y)
-            else:
-                left_scale_percent = (100.0 * left_pixbuf.get_width() /
-                    left_unscaled_x)
-            if not right_animated and right_rotation in (90, 270):
-                right_scale_percent = (100.0 * right_pixbuf.get_width() /
-                    right_unscaled_y)
-            else:
-                right_scale_percent = (100.0 * right_pixbuf.get_width() /
-                    right_unscaled_x)
-            self.statusbar.set_page_number(
-                self.file_handler.get_current_page(),
-                self.file_handler.get_number_of_pages(), double_page=True)
-            self.statusbar.set_resolution(
-                (left_unscaled_x, left_unscaled_y, left_scale_percent),
-                (right_unscaled_x, right_unscaled_y, right_scale_percent))
-
-            if prefs['smart bg']:
-                bg_colour = image.get_most_common_edge_colour(left_pixbuf)
-                self.set_bg_colour(bg_colour)
-
-            left_filename, right_filename = \
-                self.file_handler.get_page_filename(double=True)
-            if self.is_manga_mode:
-                left_filename, right_filename = right_filename, left_filename
-            self.statusbar.set_filename(left_filename + ', ' + right_filename)
+            # The two pixbufs are scaled together, so they are cached
+            # together as well.
+            key = (self.file_handler.get_current_page(), self.is_manga_mode,
+                left_unscaled_x, left_unscaled_y, right_unscaled_x,
+                right_unscaled_y, scaled_width, scaled_height, scale_up,
+                left_rotation, right_rotation, output_state)
+            pixbufs = (left_pixbuf, right_pixbuf)
+            keys = (('left',) + key, ('right',) + key)
+            sizes = ((left_unscaled_x, left_unscaled_y),
+                (right_unscaled_x, right_unscaled_y))
+            rotations = (left_rotation, right_rotation)
+            animated = (left_animated, right_animated)
         else:
             pixbuf = self.file_handler.get_pixbufs(single=True)
             #instead of modifying returns, just do an extra single call here
-            animated = isinstance(pixbuf, gtk.gdk.PixbufAnimation)
-            unscaled_x = pixbuf.get_width()
-            unscaled_y = pixbuf.get_height()
+            is_animated = isinstance(pixbuf, gtk.gdk.PixbufAnimation)
+            unscaled_x, unscaled_y = image.get_original_size(pixbuf)
 
             rotation = prefs['rotation']
-            if not animated and prefs['auto rotate from exif']:
+            if not is_animated and prefs['auto rotate from exif']:
                 rotation += image.get_implied_rotation(pixbuf)
                 rotation = rotation % 360
 
             if self.zoom_mode == preferences.ZOOM_MODE_MANUAL:
-                if not animated:
+                if not is_animated:
                     scaled_width = int(self._manual_zoom * unscaled_x / 100)
                     scaled_height = int(self._manual_zoom * unscaled_y / 100)
                     if rotation in (90, 270):
                         scaled_width, scaled_height = scaled_height, scaled_width
                 scale_up = True
 
-            pixbuf = image.fit_in_rectangle(pixbuf, scaled_width,
-                scaled_height, scale_up=scale_up, rotation=rotation,
-                animated=animated)
-            if not animated:
-                pixbuf = pixb_process(pixbuf)
-                self.left_image.set_from_pixbuf(pixbuf)
+            pixbufs = (pixbuf,)
+            keys = (('single', self.file_handler.get_current_page(),
+                unscaled_x, unscaled_y, scaled_width, scaled_height,
+                scale_up, rotation, output_state),)
+            sizes = ((unscaled_x, unscaled_y),)
+            rotations = (rotation,)
+            animated = (is_animated,)
+
+        # The pixbufs as they are before they are enhanced are cached as
+        # well, so that they are not scaled again when only the enhancement
+        # values change.
+        plain_keys = None
+        if self.enhancer.is_active():
+            plain_keys = [page_key[:-1] + (plain_state,) for page_key in keys]
+            self._scaled_pixbufs.protect(list(keys) + plain_keys)
+        else:
+            self._scaled_pixbufs.protect(keys)
+        # The smart background colour only depends on the left page and on
+        # how it is enhanced, so it is only picked once for those.
+        bg_key = None
+        bg_colour = None
+        if prefs['smart bg']:
+            left_page = self.file_handler.get_current_page()
+            if len(keys) == 2 and self.is_manga_mode:
+                left_page += 1
+            bg_key = (left_page, output_state)
+            bg_colour = self._bg_colours.get(bg_key)
+        self._render_info = (keys, sizes, rotations, animated, at_bottom,
+            scroll, self._interpolation, bg_key, plain_keys)
+        if True not in animated and not [page_key for page_key in keys
+          if page_key not in self._scaled_pixbufs]:
+            pixbufs = [self._scaled_pixbufs.get(page_key) for page_key in keys]
+            if bg_key is not None and bg_colour is None:
+                bg_colour = image.get_most_common_edge_colour(pixbufs[0])
+                self._bg_colours[bg_key] = bg_colour
+            self._show_pages(pixbufs, bg_colour)
+        elif plain_keys is not None and True not in animated and \
+          not [page_key for page_key in plain_keys
+          if page_key not in self._scaled_pixbufs]:
+            self._renderer.submit(self._render_generation, _enhance_pages,
+                ([self._scaled_pixbufs.get(page_key)
+                for page_key in plain_keys],
+                animated, self.enhancer,
+                bg_key is not None and bg_colour is None),
+                self._pages_rendered)
+        else:
+            self._renderer.submit(self._render_generation, _render_pages,
+                (pixbufs, scaled_width, scaled_height, scale_up, rotations,
+                animated, prefs['horizontal flip'], prefs['vertical flip'],
+                self.enhancer, bg_key is not None and bg_colour is None,
+                self._interpolation), self._pages_rendered)
+        return False
+
+    def _end_interactive(self):
+        """End a burst of interactive drawing, drawing the pages again in
+        full quality if they were drawn quickly during it.
+        """
+        self._interactive_id = None
+        if self._needs_high_quality:
+            self._needs_high_quality = False
+            self.draw_image(scroll=False)
+        return False
+
+    def _pages_rendered(self, generation, result):
+        """Cache and show the pixbufs in <result> from _render_pages() or
+        _enhance_pages(), unless they have been made out of date by a
+        later draw_image().
+        """
+        if generation != self._render_generation or result is None:
+            return
+        pixbufs, bg_colour, plain_pixbufs = result
+        keys, sizes, rotations, animated = self._render_info[:4]
+        interpolation, bg_key, plain_keys = self._render_info[6:]
+        # Quickly drawn pixbufs are only good for the moment.
+        if True not in animated and interpolation == gtk.gdk.INTERP_TILES:
+            if plain_keys is not None:
+                for key, pixbuf in zip(plain_keys, plain_pixbufs):
+                    self._scaled_pixbufs.put(key, pixbuf)
+            for key, pixbuf in zip(keys, pixbufs):
+                self._scaled_pixbufs.put(key, pixbuf)
+        if bg_key is not None:
+            if bg_colour is None:
+                bg_colour = self._bg_colours.get(bg_key)
             else:
-                self.left_image.set_from_animation(pixbuf)
+                self._bg_colours[bg_key] = bg_colour
+        self._show_pages(pixbufs, bg_colour)
 
+    def _show_pages(self, pixbufs, bg_colour):
+        """Put the one or two finished <pixbufs> for the current page(s)
+        on display, and update everything that depends on them. If
+        <bg_colour> is not None it is used as the background colour.
+        """
+        keys, sizes, rotations, animated, at_bottom, scroll = \
+            self._render_info[:6]
+        area_width, area_height = self.get_visible_area_size()
+        double = len(pixbufs) == 2
+        for widget, pixbuf, is_animated in zip(
+          (self.left_image, self.right_image), pixbufs, animated):
+            if not is_animated:
+                widget.set_from_pixbuf(pixbuf)
+            else:
+                widget.set_from_animation(pixbuf)
+        if not double:
             self.right_image.clear()
-            x_padding = (area_width - pixbuf.get_width()) / 2
-            y_padding = (area_height - pixbuf.get_height()) / 2
-
-            if not animated and rotation in (90, 270):
+        x_padding = (area_width -
+            sum([pixbuf.get_width() for pixbuf in pixbufs])) / 2
+        y_padding = (area_height -
+            max([pixbuf.get_height() for pixbuf in pixbufs])) / 2
+
+        resolutions = []
+        for pixbuf, (unscaled_x, unscaled_y), rotation, is_animated in zip(
+          pixbufs, sizes, rotations, animated):
+            if not is_animated and rotation in (90, 270):
                 scale_percent = 100.0 * pixbuf.get_width() / unscaled_y
             else:
                 scale_percent = 100.0 * pixbuf.get_width() / unscaled_x
-            self.statusbar.set_page_number(
-                self.file_handler.get_current_page(),
-                self.file_handler.get_number_of_pages())
-            self.statusbar.set_resolution((unscaled_x, unscaled_y,
-                scale_percent))
+            resolutions.append((unscaled_x, unscaled_y, scale_percent))
+        self.statusbar.set_page_number(
+            self.file_handler.get_current_page(),
+            self.file_handler.get_number_of_pages(), double_page=double)
+        self.statusbar.set_resolution(*resolutions)
+        if double:
+            left_filename, right_filename = \
+                self.file_handler.get_page_filename(double=True)
+            if self.is_manga_mode:
+                left_filename, right_filename = right_filename, left_filename
+            self.statusbar.set_filename(left_filename + ', ' + right_filename)
+        else:
             self.statusbar.set_filename(self.file_handler.get_page_filename())
 
-            if prefs['smart bg']:
-                bg_colour = image.get_most_common_edge_colour(pixbuf)
-                self.set_bg_colour(bg_colour)
+        if bg_colour is not None:
+            self.set_bg_colour(bg_colour)
 
         self._image_box.window.freeze_updates()
         self._main_layout.move(self._image_box, max(0, x_padding),
             max(0, y_padding))
         self.left_image.show()
-        if self.displayed_double():
+        if double:
             self.right_image.show()
         else:
             self.right_image.hide()
@@ -393,7 +506,6 @@ class MainWindow(gtk.Window):
         enhance.draw_histogram(self.left_image)
         self.file_handler.do_cacheing()
         self.thumbnailsidebar.load_thumbnails()
-        return False
 
     def new_page(self, at_bottom=False):
         """Draw a *new* page correctly (as opposed to redrawing the same
@@ -515,7 +627,7 @@ class MainWindow(gtk.Window):
         if new_zoom > 1000:
             return
         self._manual_zoom = new_zoom
-        self.draw_image()
+        self.draw_image(interactive=True)
 
     def manual_zoom_out(self, *args):
         new_zoom = self._manual_zoom / 1.15
@@ -524,7 +636,7 @@ class MainWindow(gtk.Window):
         if new_zoom < 10:
             return
         self._manual_zoom = new_zoom
-        self.draw_image()
+        self.draw_image(interactive=True)
 
     def manual_zoom_original(self, *args):
         self._manual_zoom = 100
@@ -664,14 +776,41 @@ class MainWindow(gtk.Window):
 
     def clear(self):
         """Clear the currently displayed data (i.e. "close" the file)."""
+        self._render_generation += 1
+        self._renderer.cancel_all()
         self.left_image.clear()
         self.right_image.clear()
+        self._scaled_pixbufs.clear()
+        self._bg_colours.clear()
         self.thumbnailsidebar.clear()
         self.set_title('Comix')
         self.statusbar.set_message('')
         self.set_bg_colour(prefs['bg colour'])
         enhance.clear_histogram()
 
+    def remap_pages(self, mapping):
+        """Keep what is cached for the pages that are keys in <mapping>
+        under the page numbers they map to, after other pages have been
+        removed from the file. The rest is dropped.
+        """
+        self._render_generation += 1
+        self._renderer.cancel_all()
+
+        def get_key(key):
+            # Double pages are only kept if they are still side by side.
+            if key[0] in ('left', 'right') and key[1] + 1 not in mapping:
+                return None
+            if key[1] not in mapping:
+                return None
+            return key[:1] + (mapping[key[1]],) + key[2:]
+
+        self._scaled_pixbufs.remap(get_key)
+        self._bg_colours = dict([((mapping[key[0]],) + key[1:], colour)
+            for key, colour in self._bg_colours.iteritems()
+            if key[0] in mapping])
+        enhance.clear_histogram()
+        self.thumbnailsidebar.remap_pages(mapping)
+
     def displayed_double(self):
         """Return True if two pages are currently displayed."""
         return (self.is_double_page and not self.is_virtual_double_page and
@@ -832,10 +971,67 @@ class MainWindow(gtk.Window):
                 prefs['last path in save filechooser'])
 
         if save_dialog.run() == gtk.RESPONSE_ACCEPT and save_dialog.get_filename():
-            shutil.copy(self.file_handler.get_path_to_page(),
+            shutil.copy(self.file_handler.get_extracted_path_to_page(),
                 save_dialog.get_filename().decode('utf-8'))
             prefs['last path in save filechooser'] = \
                 save_dialog.get_current_folder();
 
         save_dialog.destroy()
 
+
+
+def _render_pages(pixbufs, width, height, scale_up, rotations, animated,
+  hflip, vflip, enhancer, smart_bg, interpolation, cancelled):
+    """Scale and rotate the one or two <pixbufs> (two are fitted side by
+    side) to fit in <width> x <height> with the gtk.gdk.INTERP_* mode
+    <interpolation>, flip them if <hflip> or <vflip> is True and enhance
+    them with <enhancer>. Animations, as flagged by the <animated>
+    sequence, are left as they are.
+
+    Return the result of _enhance_pages() for the scaled and flipped
+    pixbufs, or None if cancelled() turns True on the way. For use in a
+    worker thread.
+    """
+    if len(pixbufs) == 2:
+        pixbufs = image.fit_2_in_rectangle(pixbufs[0], pixbufs[1], width,
+            height, scale_up=scale_up, rotation1=rotations[0],
+            rotation2=rotations[1], animated1=animated[0],
+            animated2=animated[1], interpolation=interpolation,
+            mipmap=prefs['mipmap pages'])
+    else:
+        pixbufs = (image.fit_in_rectangle(pixbufs[0], width, height,
+            scale_up=scale_up, rotation=rotations[0], animated=animated[0],
+            interpolation=interpolation, mipmap=prefs['mipmap pages']),)
+    flipped = []
+    for pixbuf, is_animated in zip(pixbufs, animated):
+        if cancelled():
+            return None
+        if not is_animated:
+            if hflip:
+                pixbuf = pixbuf.flip(horizontal=True)
+            if vflip:
+                pixbuf = pixbuf.flip(horizontal=False)
+        flipped.append(pixbuf)
+    return _enhance_pages(flipped, animated, enhancer, smart_bg, cancelled)
+
+
+def _enhance_pages(pixbufs, animated, enhancer, smart_bg, cancelled):
+    """Enhance the one or two scaled <pixbufs> with <enhancer>, leaving
+    animations, as flagged by the <animated> sequence, as they are.
+
+    Return a tuple (pixbufs, bg_colour, plain_pixbufs), where <bg_colour>
+    is the colour for the smart background if <smart_bg> is True, else
+    None, and <plain_pixbufs> are the given <pixbufs>. Return None if
+    cancelled() turns True on the way. For use in a worker thread.
+    """
+    rendered = []
+    for pixbuf, is_animated in zip(pixbufs, animated):
+        if cancelled():
+            return None
+        if not is_animated:
+            pixbuf = enhancer.enhance(pixbuf)
+        rendered.append(pixbuf)
+    bg_colour = None
+    if smart_bg and not cancelled():
+        bg_colour = image.get_most_common_edge_colour(rendered[0])
+    return rendered, bg_colour, pixbufs
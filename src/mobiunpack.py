@@ -3,26 +3,51 @@
 Based on code from mobiunpack by Charles M. Hannum et al.
 """
 
-import struct, imghdr, re
+import struct, imghdr, re, mmap
 
 class unpackException(Exception):
     pass
 
 class Sectionizer:
+    """Read the sections of a PalmDB file, straight from a memory map of
+    the file. The section table is not read up front, the offsets of a
+    section are looked up in it when the section is loaded, so setting
+    up is the same amount of work no matter how many sections there are.
+    """
     def __init__(self, f):
-        self.f = f
-        header = self.f.read(78)
-        self.ident = header[0x3C:0x3C+8]
-        self.num_sections, = struct.unpack_from('>H', header, 76)
-        sections = self.f.read(self.num_sections*8)
-        self.sections = struct.unpack_from('>%dL' % (self.num_sections*2), sections, 0)[::2] + (0x7fffffff, )
+        try:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (mmap.error, ValueError):
+            # E.g. an empty file, which can't be mapped.
+            raise unpackException('invalid file format')
+        if len(self.data) < 78:
+            raise unpackException('invalid file format')
+        self.ident = self.data[0x3C:0x3C+8]
+        self.num_sections, = struct.unpack_from('>H', self.data, 76)
 
     def loadSection(self, section, limit=0x7fffffff):
-        before, after = self.sections[section:section+2]
-        self.f.seek(before)
+        """Return (a read-only buffer of) the data in <section>, at most
+        <limit> bytes of it, or None if the file has been closed. No data
+        is copied.
+        """
+        # Keep a reference, the file may be closed by another thread.
+        data = self.data
+        if data is None:
+            return None
+        before, = struct.unpack_from('>L', data, 78 + section*8)
+        if section + 1 < self.num_sections:
+            after, = struct.unpack_from('>L', data, 78 + section*8 + 8)
+        else:
+            after = len(data)
         if limit > after - before:
             limit = after - before
-        return self.f.read(limit)
+        return buffer(data, before, max(0, limit))
+
+    def close(self):
+        # The map is not closed explicitly, buffers returned by
+        # loadSection() may still be in use. It is unmapped when the last
+        # of them is gone.
+        self.data = None
 
 class MobiFile:
     def __init__(self, filename):
@@ -47,20 +72,31 @@ class MobiFile:
         names = []
         for i in xrange(self.firstimg, self.sect.num_sections):
             header = self.sect.loadSection(i, 32)
-            imgtype = imghdr.what(None, header)
+            imgtype = imghdr.what(None, header[:])
             if imgtype is not None:
                 names.append("image%05d.%s" % (1+i-self.firstimg, imgtype))
         return names
 
-    def extract(self, name, dst):
+    def read(self, name):
+        """Return a read-only buffer of the data of the image <name>, or
+        None if there is no such image or the file has been closed.
+        """
         fnparts = re.split('^image([0-9]*)\.', name)
         if len(fnparts) != 3:
-            return
+            return None
         i = int(fnparts[1])-1+self.firstimg
-        data = self.sect.loadSection(i)
+        if not self.firstimg <= i < self.sect.num_sections:
+            return None
+        return self.sect.loadSection(i)
+
+    def extract(self, name, dst):
+        data = self.read(name)
+        if data is None:
+            return
         f = open(dst, 'wb')
         f.write(data)
         f.close()
 
     def close(self):
+        self.sect.close()
         self.file.close()
@@ -0,0 +1,147 @@
+"""pixbufcache.py - Memory budgeted cache of decoded images."""
+
+
+class PixbufCache:
+
+    """A cache of pixbufs that is limited by the memory taken by the pixbufs
+    in it rather than by their number. When a new pixbuf does not fit the
+    budget, the least recently used ones are removed until it does.
+
+    Keys can be anything hashable, e.g. page indices. Pixbufs with keys
+    that have been set by protect() are never removed to make room, so
+    the images on display stay even if they alone exceed the budget. Nor
+    is a pixbuf removed to make room for itself, it stays until the next
+    one is put.
+
+    The mipmap levels built for the pixbufs while they are in the cache
+    count towards the budget as well. They are counted again whenever a
+    pixbuf is put or the budget is set.
+    """
+
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._pixbufs = {}
+        self._sizes = {}
+        self._order = []  # Keys, least recently used first.
+        self._size = 0
+        self._protected = set()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key):
+        """Return the pixbuf stored for <key>, or None if there is none.
+        This counts as a use of the pixbuf.
+        """
+        pixbuf = self._pixbufs.get(key)
+        if pixbuf is None:
+            self._misses += 1
+            return None
+        self._hits += 1
+        self._order.remove(key)
+        self._order.append(key)
+        return pixbuf
+
+    def put(self, key, pixbuf):
+        """Store <pixbuf> for <key>, replacing any earlier pixbuf for it,
+        and make room for it by removing other pixbufs.
+        """
+        self.discard(key)
+        self._pixbufs[key] = pixbuf
+        self._sizes[key] = get_pixbuf_size(pixbuf)
+        self._size += self._sizes[key]
+        self._order.append(key)
+        self._evict(key)
+
+    def discard(self, key):
+        """Remove the pixbuf for <key>, if there is one."""
+        if key in self._pixbufs:
+            del self._pixbufs[key]
+            self._size -= self._sizes.pop(key)
+            self._order.remove(key)
+
+    def clear(self):
+        """Remove all pixbufs. The hit and miss counts are kept."""
+        self._pixbufs.clear()
+        self._sizes.clear()
+        self._order = []
+        self._size = 0
+        self._protected = set()
+
+    def remap(self, get_key):
+        """Store every pixbuf under the key get_key(key) instead, e.g. when
+        pages have been removed and the page numbers changed. Pixbufs for
+        which it returns None are removed.
+        """
+        pixbufs = self._pixbufs
+        sizes = self._sizes
+        order = self._order
+        self._pixbufs = {}
+        self._sizes = {}
+        self._order = []
+        for key in order:
+            new_key = get_key(key)
+            if new_key is None:
+                self._size -= sizes[key]
+            else:
+                self._pixbufs[new_key] = pixbufs[key]
+                self._sizes[new_key] = sizes[key]
+                self._order.append(new_key)
+        self._protected = set([get_key(key) for key in self._protected])
+        self._protected.discard(None)
+
+    def protect(self, keys):
+        """Never remove the pixbufs for <keys> (a sequence) to make room,
+        until protect() is called again with other keys.
+        """
+        self._protected = set(keys)
+
+    def set_max_size(self, max_size):
+        """Set the budget to <max_size> bytes, removing pixbufs as needed."""
+        self._max_size = max_size
+        self._evict()
+
+    def get_stats(self):
+        """Return a tuple (hits, misses, number of pixbufs, used bytes,
+        budget in bytes).
+        """
+        self._update_sizes()
+        return (self._hits, self._misses, len(self._pixbufs), self._size,
+            self._max_size)
+
+    def __contains__(self, key):
+        return key in self._pixbufs
+
+    def _evict(self, keep=None):
+        """Remove least recently used pixbufs until the budget is met, or
+        only protected pixbufs (and the one for <keep>) are left.
+        """
+        self._update_sizes()
+        for key in self._order[:]:
+            if self._size <= self._max_size:
+                break
+            if key not in self._protected and key != keep:
+                self.discard(key)
+
+    def _update_sizes(self):
+        """Count the memory used by the pixbufs again, mipmap levels may
+        have been built for them since they were put.
+        """
+        for key, pixbuf in self._pixbufs.iteritems():
+            size = get_pixbuf_size(pixbuf)
+            self._size += size - self._sizes[key]
+            self._sizes[key] = size
+
+
+def get_pixbuf_size(pixbuf):
+    """Return the number of bytes used by the pixel data of <pixbuf>, and
+    of the levels of its mipmap pyramid built so far (see
+    image.get_mipmap()).
+    """
+    if not hasattr(pixbuf, 'get_rowstride'):
+        # Animations hold at least one full frame (with alpha).
+        return pixbuf.get_width() * pixbuf.get_height() * 4
+    size = 0
+    while pixbuf is not None:
+        size += pixbuf.get_rowstride() * pixbuf.get_height()
+        pixbuf = pixbuf.get_data('comix-mipmap')
+    return size
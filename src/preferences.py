@@ -21,9 +21,16 @@ prefs = {
     'page of last file': 1,
     'path to last file': '',
     'auto open next archive': True,
+    'prefetch next archive pages': 3,
     'bg colour': (5000, 5000, 5000),
     'checkered bg for transparent images': True,
     'cache': True,
+    'cache size': 256,
+    'scaled cache size': 64,
+    'decode at display size': True,
+    'mipmap pages': True,
+    'extract zip in memory': False,
+    'extraction workers': 2,
     'animate gifs': False,
     'animate': False,
     'stretch': False,
@@ -218,6 +225,15 @@ class _PreferencesDialog(gtk.Dialog):
         auto_open_next_button.set_tooltip_text(
             _('Automatically open the next archive in the directory when flipping past the last page, or the previous archive when flipping past the first page.'))
         page.add_row(auto_open_next_button)
+        label = gtk.Label('%s:' % _('Prepare the next archive this many pages before the end'))
+        adjustment = gtk.Adjustment(prefs['prefetch next archive pages'],
+            0, 50, 1, 5)
+        prefetch_spinner = gtk.SpinButton(adjustment)
+        prefetch_spinner.connect('value_changed', self._spinner_cb,
+            'prefetch next archive pages')
+        prefetch_spinner.set_tooltip_text(
+            _('When the next archive is to be opened automatically, start extracting it and decoding its first page in the background when this close to the end of the current one, so that it opens instantly. Set to 0 to turn this off.'))
+        page.add_row(label, prefetch_spinner)
         auto_open_last_button = gtk.CheckButton(
             _('Automatically open the last viewed file on startup.'))
         auto_open_last_button.set_active(prefs['auto load last file'])
@@ -250,6 +266,55 @@ class _PreferencesDialog(gtk.Dialog):
         cache_button.set_tooltip_text(
             _('Cache the images that are next to the currently viewed image in order to speed up browsing. Since the speed improvements are quite big, it is recommended that you have this preference set, unless you are running short on free RAM.'))
         page.add_row(cache_button)
+        label = gtk.Label('%s:' % _('Cache size (MiB)'))
+        adjustment = gtk.Adjustment(prefs['cache size'], 16, 4096, 16, 64)
+        cache_size_spinner = gtk.SpinButton(adjustment)
+        cache_size_spinner.connect('value_changed', self._spinner_cb,
+            'cache size')
+        cache_size_spinner.set_tooltip_text(
+            _('The amount of memory that decoded images may take up in the cache. When it is used up, the images that were viewed the longest time ago are removed first.'))
+        page.add_row(label, cache_size_spinner)
+        label = gtk.Label('%s:' % _('Cache size for scaled images (MiB)'))
+        adjustment = gtk.Adjustment(prefs['scaled cache size'], 0, 1024,
+            8, 32)
+        scaled_cache_size_spinner = gtk.SpinButton(adjustment)
+        scaled_cache_size_spinner.connect('value_changed', self._spinner_cb,
+            'scaled cache size')
+        scaled_cache_size_spinner.set_tooltip_text(
+            _('The amount of memory that images scaled to fit the window may take up. Going back to a recently viewed page at the same window size then needs no scaling.'))
+        page.add_row(label, scaled_cache_size_spinner)
+        display_size_button = gtk.CheckButton(
+            _('Decode large images at the size they are displayed at.'))
+        display_size_button.set_active(prefs['decode at display size'])
+        display_size_button.connect('toggled', self._check_button_cb,
+            'decode at display size')
+        display_size_button.set_tooltip_text(
+            _('Decode images that are much larger than the window at a half, a quarter or an eighth of their size, which is faster and takes less memory. They are decoded at full size when zooming manually or using the magnifying glass.'))
+        page.add_row(display_size_button)
+        mipmap_button = gtk.CheckButton(
+            _('Keep smaller copies of the cached images for scaling.'))
+        mipmap_button.set_active(prefs['mipmap pages'])
+        mipmap_button.connect('toggled', self._check_button_cb,
+            'mipmap pages')
+        mipmap_button.set_tooltip_text(
+            _('Keep copies at a half, a quarter and an eighth of the size of the cached images, and scale from the nearest of them. This makes zooming, the magnifying glass and thumbnails faster, but the cached images take up to a third more memory.'))
+        page.add_row(mipmap_button)
+        zip_memory_button = gtk.CheckButton(
+            _('Read images in ZIP archives straight into memory.'))
+        zip_memory_button.set_active(prefs['extract zip in memory'])
+        zip_memory_button.connect('toggled', self._check_button_cb,
+            'extract zip in memory')
+        zip_memory_button.set_tooltip_text(
+            _('Decode the images in ZIP archives (.cbz) directly from the archive instead of first extracting them to a temporary directory. This is faster, especially for archives on slow or network mounted drives. It takes effect when the next archive is opened.'))
+        page.add_row(zip_memory_button)
+        label = gtk.Label('%s:' % _('Number of extraction threads'))
+        adjustment = gtk.Adjustment(prefs['extraction workers'], 1, 16, 1, 1)
+        workers_spinner = gtk.SpinButton(adjustment)
+        workers_spinner.connect('value_changed', self._spinner_cb,
+            'extraction workers')
+        workers_spinner.set_tooltip_text(
+            _('Extract this many files in parallel from ZIP, tar and MobiPocket files. Other archive formats are always extracted one file at a time.'))
+        page.add_row(label, workers_spinner)
 
         page.new_section(_('Image Animation'))
         gif_button = gtk.CheckButton(_('Play GIF image animations.'))
@@ -341,7 +406,8 @@ class _PreferencesDialog(gtk.Dialog):
             else:
                 self._window.draw_image(scroll=False)
         elif preference in ('stretch', 'checkered bg for transparent images',
-          'no double page for wide images', 'auto rotate from exif'):
+          'no double page for wide images', 'auto rotate from exif',
+          'decode at display size'):
             self._window.draw_image(scroll=False)
         elif (preference == 'hide all in fullscreen' and
           self._window.is_fullscreen):
@@ -364,6 +430,9 @@ class _PreferencesDialog(gtk.Dialog):
             prefs[preference] = int(value)
         elif preference == 'lens magnification':
             prefs[preference] = value
+        elif preference in ('extraction workers',
+          'prefetch next archive pages', 'cache size', 'scaled cache size'):
+            prefs[preference] = int(value)
         elif preference == 'slideshow delay':
             prefs[preference] = int(value * 1000)
             self._window.slideshow.update_delay()
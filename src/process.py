@@ -42,6 +42,15 @@ class Process:
         finally:
             gc.enable()
 
+    def terminate(self):
+        """Terminate the process, if it is still running."""
+        if self._proc is None:
+            raise Exception('Process not spawned.')
+        try:
+            self._proc.terminate()
+        except OSError:
+            pass
+
     def wait(self):
         """Wait for the process to terminate."""
         if self._proc is None:
@@ -167,7 +167,8 @@ class _PropertiesDialog(gtk.Dialog):
                 (_('Modified'), time.strftime('%Y-%m-%d, %H:%M:%S',
                 time.localtime(stats.st_mtime))),
                 (_('Permissions'), oct(stat.S_IMODE(stats.st_mode))),
-                (_('Owner'), uid))
+                (_('Owner'), uid),
+                (_('Cache'), _get_cache_info(window.file_handler)))
             page.set_secondary_info(secondary_info)
         except Exception:
             pass
@@ -175,6 +176,18 @@ class _PropertiesDialog(gtk.Dialog):
         self.show_all()
 
 
+def _get_cache_info(file_handler):
+    """Return a text describing the use of the cache of decoded pages."""
+    hits, misses, count, size, max_size = file_handler.get_cache_stats()
+    if hits + misses:
+        ratio = 100.0 * hits / (hits + misses)
+    else:
+        ratio = 0.0
+    return _('%(pages)d pages, %(size).1f of %(max).0f MiB, %(ratio).0f%% hits') % {
+        'pages': count, 'size': size / 1048576.0,
+        'max': max_size / 1048576.0, 'ratio': ratio}
+
+
 def open_dialog(action, window):
     global _dialog
     if _dialog is None:
@@ -0,0 +1,348 @@
+"""seekindex.py - Random access in gzip and bzip2 compressed files.
+
+Compressed tar archives can normally only be read from the start, so
+reading a member near the end means decompressing everything in front of
+it. The readers in this module are file-like objects presenting the
+decompressed data, and they remember points in the compressed stream
+where decompression can be resumed while they pass them. Seeking back, or
+far ahead, then only costs decompressing from the nearest such point.
+
+For bzip2 the points are the starts of the compressed blocks, found during
+the first sequential pass. Every block can be decompressed on its own, so
+the block list can be stored in the archive index and given to a new
+reader, which can then seek right away.
+
+For gzip the points are snapshots of the decompressor state, taken every
+few MB. They depend on the last 32 kB of output, which zlib in Python 2
+can not be given again, so they only live as long as the reader.
+"""
+
+import bz2
+import zlib
+import binascii
+
+# Compressed data is read in chunks of this size.
+_CHUNK_SIZE = 0x10000
+# Distance (in decompressed bytes) between gzip checkpoints.
+_GZIP_SPAN = 0x400000
+# The 48 bit magic numbers starting every bzip2 block, and ending every
+# bzip2 stream.
+_BZIP2_BLOCK_MAGIC = 0x314159265359
+_BZIP2_END_MAGIC = 0x177245385090
+
+
+class _SeekableReader:
+
+    """Base class for the readers. A subclass decompresses the data from
+    a checkpoint on in _restart() and _decompress(), this class keeps
+    track of positions and takes care of read() and seek().
+    """
+
+    def __init__(self, path):
+        self.name = path
+        self._fd = open(path, 'rb')
+        self._pos = 0         # Position of the next read().
+        self._out_pos = 0     # Position of the next decompressed byte.
+        self._buffer = ''     # Decompressed data right in front of _out_pos.
+        self._eof = False
+        self._restart(0)
+
+    def read(self, size=-1):
+        """Read <size> bytes (or all bytes if <size> is negative) from the
+        current position in the decompressed data.
+        """
+        checkpoint = self._get_checkpoint(self._pos)
+        if (self._pos < self._out_pos - len(self._buffer) or
+          checkpoint > self._out_pos):
+            self._restart(checkpoint)
+        pieces = [self._buffer]
+        while not self._eof and (size < 0 or
+          self._out_pos < self._pos + size):
+            data = self._decompress()
+            self._out_pos += len(data)
+            if self._out_pos > self._pos:
+                pieces.append(data)
+            else:
+                pieces = []
+        buf = ''.join(pieces)
+        skip = max(0, self._pos - (self._out_pos - len(buf)))
+        if size < 0:
+            data = buf[skip:]
+        else:
+            data = buf[skip:skip + size]
+        self._buffer = buf[skip + len(data):]
+        self._pos += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        """Move to <offset> in the decompressed data, relative to the start
+        if <whence> is 0 or to the current position if <whence> is 1.
+        """
+        if whence == 1:
+            offset += self._pos
+        elif whence != 0:
+            raise IOError('seeking from the end is not supported')
+        self._pos = max(0, offset)
+
+    def tell(self):
+        """Return the current position in the decompressed data."""
+        return self._pos
+
+    def scan(self):
+        """Decompress everything from the current position to the end,
+        without keeping the data, so that all checkpoints are known.
+        """
+        while not self._eof:
+            self._out_pos += len(self._decompress())
+        self._buffer = ''
+
+    def close(self):
+        """Close the underlying file."""
+        self._fd.close()
+
+    def get_index(self):
+        """Return the checkpoints in a form that can be stored and given
+        to a new reader for the same file, or None if that is not possible.
+        """
+        return None
+
+    def _restart(self, out_pos):
+        """Set up to decompress from the checkpoint at <out_pos>."""
+        self._out_pos = out_pos
+        self._buffer = ''
+        self._eof = False
+
+    def _get_checkpoint(self, pos):
+        """Return the position of the last checkpoint at or before <pos>."""
+        return 0
+
+    def _decompress(self):
+        """Return the next piece of decompressed data, and set _eof when
+        there is no more.
+        """
+        raise NotImplementedError
+
+
+class GzipReader(_SeekableReader):
+
+    """Reader for gzip compressed files."""
+
+    def __init__(self, path):
+        # Checkpoints are tuples (out_pos, in_pos, decompressor), where
+        # the decompressor is None for the start of the file.
+        self._checkpoints = [(0, 0, None)]
+        _SeekableReader.__init__(self, path)
+
+    def _restart(self, out_pos):
+        _SeekableReader._restart(self, out_pos)
+        for checkpoint in reversed(self._checkpoints):
+            if checkpoint[0] == out_pos:
+                break
+        self._in_pos = checkpoint[1]
+        if checkpoint[2] is None:
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self._decompressor = checkpoint[2].copy()
+
+    def _get_checkpoint(self, pos):
+        for checkpoint in reversed(self._checkpoints):
+            if checkpoint[0] <= pos:
+                return checkpoint[0]
+
+    def _decompress(self):
+        self._fd.seek(self._in_pos)
+        compressed = self._fd.read(_CHUNK_SIZE)
+        if not compressed:
+            self._eof = True
+            return self._decompressor.flush()
+        self._in_pos += len(compressed)
+        data = []
+        while compressed:
+            data.append(self._decompressor.decompress(compressed))
+            # Files may consist of several concatenated gzip members,
+            # possibly padded with zeros.
+            compressed = self._decompressor.unused_data.lstrip('\x00')
+            if compressed:
+                self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        data = ''.join(data)
+        out_pos = self._out_pos + len(data)
+        if out_pos >= self._checkpoints[-1][0] + _GZIP_SPAN:
+            self._checkpoints.append((out_pos, self._in_pos,
+                self._decompressor.copy()))
+        return data
+
+
+class Bzip2Reader(_SeekableReader):
+
+    """Reader for bzip2 compressed files. <index> is what get_index()
+    returned for the same file earlier, if anything.
+
+    Until the whole file has been passed once (and the positions of all
+    blocks are known) it is read sequentially from the start, afterwards
+    it is read one block at a time from the block nearest in front.
+    """
+
+    def __init__(self, path, index=None):
+        # Markers are tuples (out_pos, bit_offset, is_block) for the start
+        # of every block and every end of stream mark, in file order.
+        self._markers = []
+        self._complete = False
+        if index is not None:
+            self._markers = [tuple(marker) for marker in index]
+            self._complete = True
+        _SeekableReader.__init__(self, path)
+
+    def get_index(self):
+        if not self._complete:
+            return None
+        return self._markers[:]
+
+    def _restart(self, out_pos):
+        _SeekableReader._restart(self, out_pos)
+        if self._complete:
+            for i, (pos, bit_offset, is_block) in enumerate(self._markers):
+                if is_block and pos == out_pos:
+                    self._marker = i
+                    break
+            else:
+                self._marker = None
+        else:
+            self._decompressor = bz2.BZ2Decompressor()
+            self._in_pos = 0
+            self._tail = ''
+            self._markers = []
+
+    def _get_checkpoint(self, pos):
+        checkpoint = 0
+        if self._complete:
+            for out_pos, bit_offset, is_block in self._markers:
+                if out_pos > pos:
+                    break
+                if is_block:
+                    checkpoint = out_pos
+        return checkpoint
+
+    def _decompress(self):
+        if self._complete:
+            return self._decompress_block()
+        self._fd.seek(self._in_pos)
+        compressed = self._fd.read(_CHUNK_SIZE)
+        if not compressed:
+            self._eof = True
+            self._complete = True
+            self._marker = None
+            return ''
+        # Feed the chunk in pieces ending right after each possible marker,
+        # so that the size of everything before it is known there. Where
+        # no more data came out, the magic number just turned up in the
+        # compressed data (except for the first block of a new stream).
+        data = []
+        out_pos = self._out_pos
+        fed = 0
+        base = (self._in_pos - len(self._tail)) * 8
+        for bit_offset, is_block in _find_bzip2_markers(self._tail +
+          compressed):
+            bit_offset += base
+            end = max(fed, (bit_offset + 7) // 8 - self._in_pos)
+            data.append(self._feed(compressed[fed:end]))
+            out_pos += len(data[-1])
+            fed = end
+            if (not self._markers or out_pos > self._markers[-1][0] or
+              is_block and not self._markers[-1][2]):
+                self._markers.append((out_pos, bit_offset, is_block))
+        data.append(self._feed(compressed[fed:]))
+        self._in_pos += len(compressed)
+        self._tail = compressed[-6:]
+        return ''.join(data)
+
+    def _feed(self, compressed):
+        """Feed <compressed> to the sequential decompressor and return all
+        data that comes out, starting over when a stream ends.
+        """
+        data = []
+        while True:
+            try:
+                piece = self._decompressor.decompress(compressed)
+            except EOFError:
+                # The stream ended where the previous data did.
+                self._decompressor = bz2.BZ2Decompressor()
+                if not compressed:
+                    break
+                continue
+            data.append(piece)
+            compressed = self._decompressor.unused_data
+            if compressed:
+                self._decompressor = bz2.BZ2Decompressor()
+            elif not piece:
+                break
+            # Otherwise ask again with no new data, Python 2 can hold
+            # back output when the input runs out.
+        return ''.join(data)
+
+    def _decompress_block(self):
+        """Decompress the block at the current marker and move on to the
+        next block.
+        """
+        i = self._marker
+        if i is None or i + 1 >= len(self._markers):
+            self._eof = True
+            return ''
+        start = self._markers[i][1]
+        end = self._markers[i + 1][1]
+        self._marker = None
+        for j in xrange(i + 1, len(self._markers)):
+            if self._markers[j][2]:
+                self._marker = j
+                break
+        # Wrap the block up as a stream of its own. The CRC of a stream
+        # with a single block is the CRC of the block, which follows the
+        # block magic.
+        first = start // 8
+        self._fd.seek(first)
+        compressed = self._fd.read((end + 7) // 8 - first)
+        bits = end - start
+        number = int(binascii.hexlify(compressed), 16)
+        number >>= len(compressed) * 8 - (end - first * 8)
+        number &= (1 << bits) - 1
+        crc = (number >> bits - 80) & 0xffffffff
+        number = number << 80 | _BZIP2_END_MAGIC << 32 | crc
+        bits += 80
+        number <<= -bits % 8
+        bits += -bits % 8
+        return bz2.decompress('BZh9' +
+            binascii.unhexlify('%0*x' % (bits // 4, number)))
+
+
+def _get_bzip2_patterns():
+    """Return a list of (shift, is_block, head, head_mask, middle, tail,
+    tail_mask) tuples describing how the bzip2 magic numbers look in
+    the compressed data when they start <shift> bits into a byte.
+    """
+    patterns = []
+    for magic, is_block in ((_BZIP2_BLOCK_MAGIC, True),
+      (_BZIP2_END_MAGIC, False)):
+        for shift in xrange(8):
+            data = binascii.unhexlify('%014x' % (magic << 8 - shift))
+            patterns.append((shift, is_block, ord(data[0]), 0xff >> shift,
+                data[1:6], ord(data[6]), (0xff << 8 - shift) & 0xff))
+    return patterns
+
+_bzip2_patterns = _get_bzip2_patterns()
+
+
+def _find_bzip2_markers(data):
+    """Return a sorted list of (bit_offset, is_block) tuples for all
+    places in <data> where a bzip2 block or end of stream magic number
+    starts.
+    """
+    markers = []
+    for shift, is_block, head, head_mask, middle, tail, tail_mask in \
+      _bzip2_patterns:
+        pos = data.find(middle, 1)
+        while pos != -1 and pos + 5 < len(data):
+            if (ord(data[pos - 1]) & head_mask == head and
+              ord(data[pos + 5]) & tail_mask == tail):
+                markers.append(((pos - 1) * 8 + shift, is_block))
+            pos = data.find(middle, pos + 1)
+    markers.sort()
+    return markers
@@ -0,0 +1,155 @@
+"""thumbatlas.py - Persistent thumbnails of the pages in archives.
+
+The thumbnails shown in the thumbnail sidebar for the pages of an archive
+are stored together in a single file, an atlas, so that they do not have
+to be made again from the pages the next time the archive is opened. An
+atlas holds a table of the offsets and lengths of the thumbnails, followed
+by the thumbnails themselves as PNG data.
+
+Atlases are stored one per archive, keyed by the archive path, and are
+only valid as long as the size and modification time of the archive and
+the thumbnail size are unchanged. The atlases together take at most
+_MAX_TOTAL_SIZE bytes, the least recently used ones are removed first.
+"""
+
+import os
+import cPickle
+import tempfile
+try: # The md5 module is deprecated as of Python 2.5, replaced by hashlib.
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+import constants
+import image
+
+_atlas_dir = os.path.join(constants.DATA_DIR, 'thumbnail_atlas')
+
+# Bump this whenever the layout of the atlases changes.
+_ATLAS_VERSION = 1
+
+_MAX_TOTAL_SIZE = 64 * 1048576
+
+
+def load(path, thumb_size):
+    """Return a list with a thumbnail pixbuf for each page of the archive
+    at <path>, or None if there is no valid atlas for it with thumbnails
+    of size <thumb_size>. Pages that have no thumbnail in the atlas are
+    None in the list.
+    """
+    atlaspath = _path_to_atlaspath(path)
+    try:
+        stat = os.stat(path)
+        atlas = open(atlaspath, 'rb')
+        try:
+            version = cPickle.load(atlas)
+            header = cPickle.load(atlas)
+            data = atlas.read()
+        finally:
+            atlas.close()
+    except Exception:
+        return None
+    if (version != _ATLAS_VERSION or header.get('path') != path or
+      header.get('size') != stat.st_size or
+      header.get('mtime') != stat.st_mtime or
+      header.get('thumb size') != thumb_size):
+        return None
+    thumbs = []
+    try:
+        for position in header['table']:
+            if position is None:
+                thumbs.append(None)
+            else:
+                offset, length = position
+                thumbs.append(image.pixbuf_from_data(
+                    data[offset:offset + length]))
+    except Exception:
+        return None
+    try:
+        # The modification time tells which atlases were used last.
+        os.utime(atlaspath, None)
+    except OSError:
+        pass
+    return thumbs
+
+
+def store(path, thumb_size, thumbs):
+    """Store an atlas for the archive at <path>, where <thumbs> is a list
+    with the PNG data (see encode()) of the thumbnail of each page, or None
+    for pages without one, and <thumb_size> is the thumbnail size. Older
+    atlases are removed as needed to keep within the total size.
+
+    Archives in the temporary directory (e.g. sub-archives extracted from
+    other archives) get no atlas, they will never be opened again.
+    """
+    if os.path.abspath(path).startswith(
+      os.path.join(tempfile.gettempdir(), '')):
+        return
+    atlaspath = _path_to_atlaspath(path)
+    table = []
+    offset = 0
+    for data in thumbs:
+        if data is None:
+            table.append(None)
+        else:
+            table.append((offset, len(data)))
+            offset += len(data)
+    try:
+        stat = os.stat(path)
+        header = {'path': path, 'size': stat.st_size,
+            'mtime': stat.st_mtime, 'thumb size': thumb_size, 'table': table}
+        if not os.path.isdir(_atlas_dir):
+            os.makedirs(_atlas_dir, 0700)
+        atlas = open(atlaspath + '-comixtemp', 'wb')
+        cPickle.dump(_ATLAS_VERSION, atlas, cPickle.HIGHEST_PROTOCOL)
+        cPickle.dump(header, atlas, cPickle.HIGHEST_PROTOCOL)
+        for data in thumbs:
+            if data is not None:
+                atlas.write(data)
+        atlas.close()
+        os.rename(atlaspath + '-comixtemp', atlaspath)
+    except Exception:
+        print '! thumbatlas.py: Could not write', atlaspath
+        return
+    _evict(atlaspath)
+
+
+def encode(pixbuf):
+    """Return the PNG data of <pixbuf>, for store()."""
+    chunks = []
+    pixbuf.save_to_callback(chunks.append, 'png')
+    return ''.join(chunks)
+
+
+def _evict(keep):
+    """Remove the least recently used atlases until they take at most
+    _MAX_TOTAL_SIZE bytes together. The atlas at <keep> is never removed.
+    """
+    atlases = []
+    total_size = 0
+    try:
+        for name in os.listdir(_atlas_dir):
+            atlaspath = os.path.join(_atlas_dir, name)
+            stat = os.stat(atlaspath)
+            atlases.append((stat.st_mtime, stat.st_size, atlaspath))
+            total_size += stat.st_size
+    except OSError:
+        return
+    atlases.sort()
+    for mtime, size, atlaspath in atlases:
+        if total_size <= _MAX_TOTAL_SIZE:
+            break
+        if atlaspath == keep:
+            continue
+        try:
+            os.remove(atlaspath)
+            total_size -= size
+        except OSError:
+            pass
+
+
+def _path_to_atlaspath(path):
+    """Return the path to the atlas file for the archive at <path>."""
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    return os.path.join(_atlas_dir, md5(os.path.normpath(path)).hexdigest())
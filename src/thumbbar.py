@@ -12,14 +12,26 @@ except:
     import Image
     import ImageDraw
 
+import archive
 import image
 from preferences import prefs
+import thumbatlas
 import thumbnail
 
+# Milliseconds that finished thumbnails are collected for before they are
+# put in the sidebar together, and that scrolling is waited out before the
+# thumbnails in view are moved to the front of the queue.
+_BATCH_INTERVAL = 100
+
 
 class ThumbnailSidebar(gtk.HBox):
 
-    """A thumbnail sidebar including scrollbar for the main window."""
+    """A thumbnail sidebar including scrollbar for the main window.
+
+    All rows are filled with placeholders at once, and the thumbnails are
+    made in the background by the file handler, those in view and around
+    the current page first.
+    """
 
     def __init__(self, window):
         gtk.HBox.__init__(self, False, 0)
@@ -27,6 +39,14 @@ class ThumbnailSidebar(gtk.HBox):
         self._loaded = False
         self._load_task = None
         self._height = 0
+        self._unloaded = set()  # Pages that still show a placeholder.
+        self._pending = []  # Finished (page, thumbnail) not shown yet.
+        self._flush_id = None
+        self._reorder_id = None
+        # The archive that a thumbnail atlas is being collected for, and
+        # the PNG data of the thumbnails collected so far, by page.
+        self._atlas_path = None
+        self._atlas_data = {}
 
         self._liststore = gtk.ListStore(gtk.gdk.Pixbuf)
         self._treeview = gtk.TreeView(self._liststore)
@@ -36,6 +56,7 @@ class ThumbnailSidebar(gtk.HBox):
 
         self._column = gtk.TreeViewColumn(None)
         cellrenderer = gtk.CellRendererPixbuf()
+        self._cellrenderer = cellrenderer
         self._layout = gtk.Layout()
         self._layout.put(self._treeview, 0, 0)
         self._column.set_sizing(gtk.TREE_VIEW_COLUMN_FIXED)
@@ -59,6 +80,7 @@ class ThumbnailSidebar(gtk.HBox):
         self._treeview.connect('drag_data_get', self._drag_data_get)
         self._selection.connect('changed', self._selection_event)
         self._layout.connect('scroll_event', self._scroll_event)
+        self._vadjust.connect('value-changed', self._scrolled)
 
     def get_width(self):
         """Return the width in pixels of the ThumbnailSidebar."""
@@ -74,11 +96,21 @@ class ThumbnailSidebar(gtk.HBox):
 
     def clear(self):
         """Clear the ThumbnailSidebar of any loaded thumbnails."""
+        self._window.file_handler.cancel_thumbnails()
+        for source in (self._load_task, self._flush_id, self._reorder_id):
+            if source is not None:
+                gobject.source_remove(source)
+        self._load_task = None
+        self._flush_id = None
+        self._reorder_id = None
+        self._unloaded = set()
+        self._pending = []
+        self._atlas_path = None
+        self._atlas_data = {}
         self._liststore.clear()
         self._layout.set_size(0, 0)
         self._height = 0
         self._loaded = False
-        self._stop_update = True
 
     def resize(self):
         """Reload the thumbnails with the size specified by in the
@@ -101,6 +133,44 @@ class ThumbnailSidebar(gtk.HBox):
             gobject.source_remove(self._load_task)
         self._load_task = gobject.idle_add(self._load)
 
+    def remap_pages(self, mapping):
+        """Remove the rows of the pages that are not keys in <mapping>, after
+        they have been removed from the file, and move the other rows to
+        the page numbers they map to. Their thumbnails are kept, only the
+        page numbers on them are drawn again.
+        """
+        if not self._loaded or self._load_task is not None:
+            # The rows are filled in later on, for the new pages.
+            return
+        self._window.file_handler.cancel_thumbnails()
+        if self._flush_id is not None:
+            gobject.source_remove(self._flush_id)
+            self._flush_id = None
+        # The thumbnails that are not shown yet are requested again.
+        self._pending = []
+        unloaded = self._unloaded
+        self._unloaded = set([mapping[page] for page in unloaded
+            if page in mapping])
+        # Removed rows would move the selection to other pages meanwhile.
+        self._selection.handler_block_by_func(self._selection_event)
+        for page in xrange(len(self._liststore), 0, -1):
+            new_page = mapping.get(page)
+            if new_page is None:
+                del self._liststore[page - 1]
+            elif (new_page != page and page not in unloaded and
+              prefs['show page numbers on thumbnails']):
+                pixbuf = self._liststore[page - 1][0]
+                # Drawn inside the border, over all of the old number.
+                _add_page_number(pixbuf.subpixbuf(1, 1,
+                    pixbuf.get_width() - 2, pixbuf.get_height() - 2),
+                    new_page, 6 * len(str(page)) + 2)
+                self._liststore[page - 1][0] = pixbuf
+        self._selection.handler_unblock_by_func(self._selection_event)
+        self._height = self._treeview.size_request()[1]
+        self._layout.set_size(0, self._height)
+        self.update_select()
+        self._request_thumbnails()
+
     def update_select(self):
         """Select the thumbnail for the currently viewed page and make sure
         that the thumbbar is scrolled so that the selected thumb is in view.
@@ -119,27 +189,127 @@ class ThumbnailSidebar(gtk.HBox):
             self._vadjust.set_value(value)
 
     def _load(self):
+        """Fill the sidebar with placeholders for all pages and request
+        their thumbnails. For archives, the thumbnails are taken from the
+        thumbnail atlas instead if there is one.
+        """
+        self._load_task = None
+        size = prefs['thumbnail size']
+        pages = self._window.file_handler.get_number_of_pages()
+        # All rows have the same height, placeholder or not, so that the
+        # sidebar does not shift as the thumbnails come in.
+        self._cellrenderer.set_fixed_size(-1,
+            size + 2 + 2 * self._cellrenderer.get_property('ypad'))
+        placeholder = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, True, 8,
+            size, size)
+        placeholder.fill(0x00000000)
+        placeholder = image.add_border(placeholder, 1)
+        thumbs = None
+        if self._window.file_handler.archive_type not in (None,
+          archive.DIRECTORY):
+            path = self._window.file_handler.get_path_to_base()
+            thumbs = thumbatlas.load(path, size)
+            if thumbs is None or len(thumbs) != pages:
+                thumbs = None
+                self._atlas_path = path
+        for i in xrange(pages):
+            if thumbs is not None and thumbs[i] is not None:
+                self._liststore.append([self._get_row_pixbuf(thumbs[i],
+                    i + 1)])
+            else:
+                self._liststore.append([placeholder])
+                self._unloaded.add(i + 1)
+        self._height = self._treeview.size_request()[1]
+        self._layout.set_size(0, self._height)
+        self.update_select()
+        self._request_thumbnails()
+        return False
+
+    def _request_thumbnails(self):
+        """Request the thumbnails for the rows that still show placeholders,
+        those in view first, then by their distance from the view and from
+        the current page.
+        """
+        if not self._unloaded:
+            return
         if self._window.file_handler.archive_type is not None:
             create = False
         else:
             create = prefs['create thumbnails']
-        self._stop_update = False
-        for i in xrange(1, self._window.file_handler.get_number_of_pages() + 1):
-            pixbuf = self._window.file_handler.get_thumbnail(i,
-                prefs['thumbnail size'], prefs['thumbnail size'], create)
-            if prefs['show page numbers on thumbnails']:
-                _add_page_number(pixbuf, i)
-            pixbuf = image.add_border(pixbuf, 1)
-            self._liststore.append([pixbuf])
-            while gtk.events_pending():
-                gtk.main_iteration(False)
-            if self._stop_update:
-                return
-            self._height += self._treeview.get_background_area(i - 1,
-                self._column).height
-            self._layout.set_size(0, self._height)
-        self._stop_update = True
-        self.update_select()
+        row_height = max(1.0, float(self._height) / len(self._liststore))
+        first_visible = int(self._vadjust.get_value() / row_height) + 1
+        last_visible = int((self._vadjust.get_value() +
+            self._vadjust.page_size) / row_height) + 1
+        current = self._window.file_handler.get_current_page()
+
+        def distance(page):
+            return min(abs(page - current),
+                max(0, first_visible - page, page - last_visible))
+
+        pages = sorted(self._unloaded, key=lambda page: (distance(page) > 0,
+            distance(page), page))
+        self._window.file_handler.request_thumbnails(pages,
+            prefs['thumbnail size'], prefs['thumbnail size'], create,
+            self._thumbnail_loaded)
+
+    def _thumbnail_loaded(self, page, thumb, failed):
+        """Collect the finished <thumb> for <page>, to be put in the sidebar
+        with the others that are done shortly after it. <failed> is True if
+        <thumb> is only a missing image.
+        """
+        self._pending.append((page, thumb, failed))
+        if self._flush_id is None:
+            self._flush_id = gobject.timeout_add(_BATCH_INTERVAL,
+                self._flush_thumbnails)
+
+    def _flush_thumbnails(self):
+        """Put the collected thumbnails in the sidebar."""
+        self._flush_id = None
+        for page, thumb, failed in self._pending:
+            if page not in self._unloaded:
+                continue
+            self._unloaded.discard(page)
+            # Pages that failed are left out of the atlas, so that they
+            # are tried again the next time.
+            if self._atlas_path is not None and not failed:
+                self._atlas_data[page] = thumbatlas.encode(thumb)
+            self._liststore[page - 1][0] = self._get_row_pixbuf(thumb, page)
+        self._pending = []
+        if not self._unloaded:
+            if self._atlas_data:
+                thumbatlas.store(self._atlas_path, prefs['thumbnail size'],
+                    [self._atlas_data.get(page)
+                    for page in xrange(1, len(self._liststore) + 1)])
+            self._atlas_path = None
+            self._atlas_data = {}
+        return False
+
+    def _get_row_pixbuf(self, thumb, page):
+        """Return the pixbuf shown in the row for <page>, made from the
+        thumbnail <thumb>.
+        """
+        if prefs['show page numbers on thumbnails']:
+            # The thumbnail may be a cached pixbuf (e.g. a small page or
+            # the missing image), so the number is drawn on a copy.
+            thumb = thumb.copy()
+            _add_page_number(thumb, page)
+        return image.add_border(thumb, 1)
+
+    def _scrolled(self, adjustment):
+        """Move the thumbnails that have come into view to the front of the
+        queue, once the scrolling has stopped for a moment.
+        """
+        if not self._unloaded:
+            return
+        if self._reorder_id is not None:
+            gobject.source_remove(self._reorder_id)
+        self._reorder_id = gobject.timeout_add(_BATCH_INTERVAL,
+            self._reorder_thumbnails)
+
+    def _reorder_thumbnails(self):
+        self._reorder_id = None
+        self._request_thumbnails()
+        return False
 
     def _get_selected_row(self):
         """Return the index of the currently selected row."""
@@ -169,7 +339,8 @@ class ThumbnailSidebar(gtk.HBox):
         """
         try:
             selected = self._get_selected_row()
-            path = self._window.file_handler.get_path_to_page(selected + 1)
+            path = self._window.file_handler.get_extracted_path_to_page(
+                selected + 1)
             uri = 'file://localhost' + urllib.pathname2url(path)
             selection.set_uris([uri])
         except Exception:
@@ -191,14 +362,15 @@ class ThumbnailSidebar(gtk.HBox):
         context.set_icon_pixbuf(pointer, -5, -5)
 
 
-def _add_page_number(pixbuf, page):
+def _add_page_number(pixbuf, page, min_width=0):
     """Add page number <page> in a black rectangle in the top left corner of
-    <pixbuf>. This is highly dependent on the dimensions of the built-in
-    font in PIL (bad). If the PIL font was changed, this function would
-    likely produce badly positioned numbers on the pixbuf.
+    <pixbuf>. The rectangle is at least <min_width> px wide. This is highly
+    dependent on the dimensions of the built-in font in PIL (bad). If the
+    PIL font was changed, this function would likely produce badly
+    positioned numbers on the pixbuf.
     """
     text = str(page)
-    width = min(6 * len(text) + 2, pixbuf.get_width())
+    width = min(max(6 * len(text) + 2, min_width), pixbuf.get_width())
     height = min(10, pixbuf.get_height())
     im = Image.new('RGB', (width, height), (0, 0, 0))
     draw = ImageDraw.Draw(im)
@@ -0,0 +1,126 @@
+"""workerpool.py - Pool of background threads for work like decoding."""
+
+import threading
+
+import gobject
+
+
+class WorkerPool:
+
+    """A pool of <workers> threads that run tasks in the order they are
+    submitted. The result of a task is handed to its callback in the main
+    loop (by gobject.idle_add()), so callbacks may safely use GTK.
+
+    Tasks are identified by keys. The main thread can take() the result of
+    a task directly instead of waiting for the callback, and tasks can be
+    cancelled in bulk, e.g. when the file they belong to is closed.
+    """
+
+    def __init__(self, workers=2):
+        self._queue = []
+        self._running = {}
+        self._generation = 0
+        self._condition = threading.Condition()
+        for i in xrange(workers):
+            thread = threading.Thread(target=self._work)
+            thread.setDaemon(True)
+            thread.start()
+
+    def submit(self, key, func, args=(), callback=None):
+        """Run func(*args, cancelled) in a worker thread, where <cancelled>
+        is a function that returns True once the task has been cancelled,
+        so that long tasks can give up early. When it is done,
+        callback(key, result) is called in the main loop unless the task
+        has been cancelled or taken in the meantime.
+
+        Nothing is done if a task with <key> is already waiting or running.
+        """
+        self._condition.acquire()
+        try:
+            running = self._running.get(key)
+            if ((running is not None and
+              running.generation == self._generation) or
+              key in [t.key for t in self._queue]):
+                return
+            self._queue.append(_Task(key, func, args, callback,
+                self._generation))
+            self._condition.notify()
+        finally:
+            self._condition.release()
+
+    def take(self, key):
+        """Take over the task with <key>. If it is running, wait for it to
+        finish and return its result (no callback is made). If it is still
+        waiting, it is dropped. Return None if there is no result.
+        """
+        self._condition.acquire()
+        try:
+            self._queue = [t for t in self._queue if t.key != key]
+            task = self._running.get(key)
+            if task is None or task.generation != self._generation:
+                return None
+            task.taken = True
+        finally:
+            self._condition.release()
+        task.done.wait()
+        return task.result
+
+    def clear_queue(self):
+        """Drop all tasks that are still waiting to run."""
+        self._condition.acquire()
+        self._queue = []
+        self._condition.release()
+
+    def cancel_all(self):
+        """Drop all waiting tasks, and discard the results of the running
+        ones.
+        """
+        self._condition.acquire()
+        self._queue = []
+        self._generation += 1
+        self._condition.release()
+
+    def _work(self):
+        """Run tasks, forever."""
+        while True:
+            self._condition.acquire()
+            while not self._queue:
+                self._condition.wait()
+            task = self._queue.pop(0)
+            self._running[task.key] = task
+            self._condition.release()
+
+            cancelled = lambda task=task: task.generation != self._generation
+            try:
+                task.result = task.func(*(task.args + (cancelled,)))
+            except Exception as e:
+                print '! workerpool.py: Task', task.key, 'failed:', e
+
+            self._condition.acquire()
+            if self._running.get(task.key) is task:
+                del self._running[task.key]
+            deliver = (not task.taken and task.callback is not None and
+                not cancelled())
+            self._condition.release()
+            task.done.set()
+            if deliver:
+                gobject.idle_add(self._deliver, task)
+
+    def _deliver(self, task):
+        """Hand the result of <task> to its callback (in the main loop)."""
+        if not task.taken and task.generation == self._generation:
+            task.callback(task.key, task.result)
+        return False
+
+
+class _Task:
+
+    def __init__(self, key, func, args, callback, generation):
+        self.key = key
+        self.func = func
+        self.args = tuple(args)
+        self.callback = callback
+        self.generation = generation
+        self.result = None
+        self.taken = False
+        self.done = threading.Event()
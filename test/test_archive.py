@@ -0,0 +1,186 @@
+"""Tests for the archive extraction in archive.py."""
+
+import os
+import sys
+import random
+import shutil
+import tarfile
+import tempfile
+import unittest
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'src'))
+
+import archive
+import archiveindex
+
+
+class TarExtractionTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp(prefix='comix-test.')
+        # Archives in the temporary directory are never indexed, so point
+        # tempfile somewhere else while the test runs.
+        self._tempdir = tempfile.tempdir
+        tempfile.tempdir = os.path.join(self._dir, 'tmp')
+        os.mkdir(tempfile.tempdir)
+        self._index_dir = archiveindex._index_dir
+        archiveindex._index_dir = os.path.join(self._dir, 'index')
+        self._contents = {}
+        rand = random.Random(0)
+        self._path = os.path.join(self._dir, 'book.tar')
+        tar = tarfile.open(self._path, 'w')
+        for i in xrange(120):
+            name = 'book/%03d.jpg' % i
+            data = ''.join([chr(rand.randrange(256))
+                for j in xrange(rand.randrange(1, 20000))])
+            member_path = os.path.join(self._dir, 'member')
+            member = open(member_path, 'wb')
+            member.write(data)
+            member.close()
+            tar.add(member_path, name)
+            self._contents[name] = data
+        tar.close()
+
+    def tearDown(self):
+        tempfile.tempdir = self._tempdir
+        archiveindex._index_dir = self._index_dir
+        shutil.rmtree(self._dir)
+
+    def _extract(self, workers):
+        dst = tempfile.mkdtemp(dir=self._dir)
+        extractor = archive.Extractor()
+        condition = extractor.setup(self._path, dst)
+        self.assertEqual(sorted(extractor.get_files()),
+            sorted(self._contents))
+        extractor.extract(workers)
+        condition.acquire()
+        try:
+            while [name for name in self._contents
+              if not extractor.is_ready(name)]:
+                condition.wait(0.5)
+        finally:
+            condition.release()
+        extractor.stop()
+        return dst
+
+    def test_parallel_extraction(self):
+        # The first run lists the archive and stores it in the index, the
+        # following ones use the index.
+        for run in xrange(4):
+            dst = self._extract(4)
+            for name, data in self._contents.iteritems():
+                member = open(os.path.join(dst, name), 'rb')
+                self.assertEqual(member.read(), data, name)
+                member.close()
+        self.assertTrue(archiveindex.load(self._path) is not None)
+
+
+# Output of "unrar x -kb -p- -o- -idc -idp -- book.cbr <dst>/" (unrar 5.61).
+_UNRAR_OUTPUT = """
+Extracting from %(src)s
+
+Creating    %(dst)sbook                                                     OK
+Extracting  %(dst)sbook/001.jpg                                             OK 
+Extracting  %(dst)sbook/002 two.jpg                                         OK 
+Extracting  %(dst)sbook/003.jpg                                             OK 
+All OK
+"""
+
+# Output of "7z x -bd -bb1 -p- -o<dst> -y book.cb7" (p7zip 16.02).
+_7Z_OUTPUT = """
+7-Zip [64] 16.02 : Copyright (c) 1999-2016 Igor Pavlov : 2016-05-21
+p7zip Version 16.02 (locale=en_US.UTF-8,Utf16=on,HugeFiles=on,64 bits,4 CPUs)
+
+Scanning the drive for archives:
+1 file, 30000 bytes (30 KiB)
+
+Extracting archive: %(src)s
+--
+Path = %(src)s
+Type = 7z
+Physical Size = 30000
+Headers Size = 200
+Method = LZMA2:24
+Solid = +
+Blocks = 1
+
+- book/001.jpg
+- book/002 two.jpg
+- book/003.jpg
+
+Everything is Ok
+
+Files: 3
+Size:       29000
+Compressed: 30000
+"""
+
+
+class StreamExtractTest(unittest.TestCase):
+
+    """The readiness reports parsed from the output of unrar and 7z while
+    they extract solid archives.
+    """
+
+    _names = ['book/001.jpg', 'book/002 two.jpg', 'book/003.jpg']
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp(prefix='comix-test.')
+        self._dst = os.path.join(self._dir, 'dst', '')
+        os.mkdir(self._dst)
+        # Any archive with the same names will do for the file list, the
+        # extractor output is replayed with cat.
+        self._src = os.path.join(self._dir, 'book.zip')
+        zfile = zipfile.ZipFile(self._src, 'w')
+        for name in self._names:
+            zfile.writestr(name, 'data')
+        zfile.close()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _replay(self, output, parse_line):
+        """Return the extractor after it has parsed <output>."""
+        output_path = os.path.join(self._dir, 'output')
+        fd = open(output_path, 'w')
+        fd.write(output % {'src': self._src, 'dst': self._dst})
+        fd.close()
+        extractor = archive.Extractor()
+        extractor.setup(self._src, self._dst)
+        self.assertTrue(extractor._stream_extract(['cat', output_path],
+            parse_line))
+        extractor.close()
+        return extractor
+
+    def test_unrar_lines(self):
+        parse = archive._parse_unrar_line
+        self.assertEqual(parse('Extracting  /tmp/x/book/001.jpg'
+            '                 OK '), '/tmp/x/book/001.jpg')
+        self.assertEqual(parse('Creating    /tmp/x/book          OK'), None)
+        self.assertEqual(parse('Extracting from /home/u/book.cbr'), None)
+        self.assertEqual(parse('All OK'), None)
+
+    def test_unrar_output(self):
+        extractor = self._replay(_UNRAR_OUTPUT, archive._parse_unrar_line)
+        for name in self._names:
+            self.assertTrue(extractor.is_ready(name), name)
+
+    def test_7z_lines(self):
+        parse = archive._7z_line_parser()
+        self.assertEqual(parse('- book/001.jpg'), None)
+        self.assertEqual(parse('Path = book.cb7'), None)
+        self.assertEqual(parse('- book/002.jpg'), 'book/001.jpg')
+
+    def test_7z_output(self):
+        extractor = self._replay(_7Z_OUTPUT, archive._7z_line_parser())
+        # A file is reported when 7z moves on to the next one, the last
+        # one is only marked when 7z is done.
+        self.assertTrue(extractor.is_ready('book/001.jpg'))
+        self.assertTrue(extractor.is_ready('book/002 two.jpg'))
+        self.assertFalse(extractor.is_ready('book/003.jpg'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+"""Tests for reading image sizes from file headers in imagesize.py."""
+
+import os
+import sys
+import struct
+import unittest
+import cStringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'src'))
+
+import imagesize
+
+
+class _Stream:
+
+    """A file object that can only be read, like a ZipFile member."""
+
+    def __init__(self, data):
+        self._fd = cStringIO.StringIO(data)
+
+    def read(self, size=-1):
+        return self._fd.read(size)
+
+
+def _jpeg_segment(marker, payload):
+    return struct.pack('>BBH', 0xff, marker, len(payload) + 2) + payload
+
+
+def _jpeg_frame(width, height):
+    return _jpeg_segment(0xc0, struct.pack('>BHHB', 8, height, width, 3) +
+        '\x01\x22\x00\x02\x11\x01\x03\x11\x01')
+
+
+class ImageSizeTest(unittest.TestCase):
+
+    def _size(self, data):
+        return imagesize.get_size(_Stream(data))
+
+    def test_png(self):
+        data = ('\x89PNG\r\n\x1a\n' + struct.pack('>I', 13) + 'IHDR' +
+            struct.pack('>IIBBBBB', 640, 480, 8, 6, 0, 0, 0) + '\x00' * 8)
+        self.assertEqual(self._size(data), (640, 480))
+
+    def test_gif(self):
+        data = 'GIF89a' + struct.pack('<HH', 320, 200) + '\x00' * 20
+        self.assertEqual(self._size(data), (320, 200))
+
+    def test_bmp(self):
+        data = ('BM' + '\x00' * 12 + struct.pack('<Iii', 40, 800, -600) +
+            '\x00' * 4)
+        self.assertEqual(self._size(data), (800, 600))
+        data = 'BM' + '\x00' * 12 + struct.pack('<IHH', 12, 30, 40) + '\x00' * 8
+        self.assertEqual(self._size(data), (30, 40))
+
+    def test_webp(self):
+        riff = 'RIFF' + struct.pack('<I', 1000) + 'WEBP'
+        lossy = (riff + 'VP8 ' + struct.pack('<I', 980) + '\x10\x02\x00' +
+            '\x9d\x01\x2a' + struct.pack('<HH', 1024, 768))
+        self.assertEqual(self._size(lossy), (1024, 768))
+        lossless = (riff + 'VP8L' + struct.pack('<I', 980) + '\x2f' +
+            struct.pack('<I', (1023) | (767 << 14)) + '\x00' * 5)
+        self.assertEqual(self._size(lossless), (1024, 768))
+        extended = (riff + 'VP8X' + struct.pack('<I', 10) + '\x00' * 4 +
+            struct.pack('<I', 1023)[:3] + struct.pack('<I', 767)[:3])
+        self.assertEqual(self._size(extended), (1024, 768))
+
+    def test_jpeg(self):
+        # A large EXIF segment and some fill bytes in front of the frame.
+        data = ('\xff\xd8' + _jpeg_segment(0xe1, 'Exif\x00\x00' +
+            'x' * 60000) + '\xff\xff' + _jpeg_segment(0xdb, '\x00' * 65) +
+            _jpeg_frame(1200, 1800) + '\xff\xda')
+        self.assertEqual(self._size(data), (1200, 1800))
+
+    def test_jpeg_without_frame(self):
+        # The image ends before any frame header, whatever follows it.
+        data = '\xff\xd8' + '\xff\xd9' + _jpeg_frame(1200, 1800)
+        self.assertEqual(self._size(data), None)
+        data = '\xff\xd8' + '\xff\xda' + _jpeg_frame(1200, 1800)
+        self.assertEqual(self._size(data), None)
+
+    def test_truncated(self):
+        jpeg = ('\xff\xd8' + _jpeg_segment(0xe1, 'x' * 5000) +
+            _jpeg_frame(1200, 1800))
+        self.assertEqual(self._size(jpeg[:3000]), None)
+        self.assertEqual(self._size(jpeg[:-12]), None)
+        self.assertEqual(self._size('\x89PNG\r\n\x1a\n'), None)
+        self.assertEqual(self._size('GIF89a'), None)
+        self.assertEqual(self._size(''), None)
+
+    def test_unknown(self):
+        self.assertEqual(self._size('II*\x00' + '\x00' * 100), None)
+
+    def test_file(self):
+        self.assertEqual(imagesize.get_file_size(os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), 'nonexistent.png')),
+            None)
+
+
+if __name__ == '__main__':
+    unittest.main()
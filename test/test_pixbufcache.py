@@ -0,0 +1,141 @@
+"""Tests for the memory budgeted cache in pixbufcache.py."""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'src'))
+
+import pixbufcache
+
+
+class _Pixbuf:
+
+    """Stand-in for a gtk.gdk.Pixbuf taking <size> bytes."""
+
+    def __init__(self, size):
+        self._size = size
+        self._data = {}
+
+    def get_rowstride(self):
+        return self._size
+
+    def get_height(self):
+        return 1
+
+    def get_data(self, key):
+        return self._data.get(key)
+
+    def set_data(self, key, value):
+        self._data[key] = value
+
+
+class _Animation:
+
+    """Stand-in for a gtk.gdk.PixbufAnimation."""
+
+    def get_width(self):
+        return 10
+
+    def get_height(self):
+        return 20
+
+
+class PixbufCacheTest(unittest.TestCase):
+
+    def test_budget(self):
+        cache = pixbufcache.PixbufCache(300)
+        for key in xrange(5):
+            cache.put(key, _Pixbuf(100))
+        self.assertEqual(cache.get_stats()[2:], (3, 300, 300))
+        self.assertEqual([key for key in xrange(5) if key in cache],
+            [2, 3, 4])
+        cache.set_max_size(150)
+        self.assertEqual([key for key in xrange(5) if key in cache], [4])
+
+    def test_replace(self):
+        cache = pixbufcache.PixbufCache(300)
+        cache.put(0, _Pixbuf(100))
+        cache.put(0, _Pixbuf(200))
+        self.assertEqual(cache.get_stats()[2:4], (1, 200))
+        cache.discard(0)
+        cache.discard(0)
+        self.assertEqual(cache.get_stats()[2:4], (0, 0))
+
+    def test_lru_order(self):
+        cache = pixbufcache.PixbufCache(300)
+        for key in xrange(3):
+            cache.put(key, _Pixbuf(100))
+        # Using 0 makes 1 the least recently used one.
+        cache.get(0)
+        cache.put(3, _Pixbuf(100))
+        self.assertEqual([key for key in xrange(4) if key in cache],
+            [0, 2, 3])
+
+    def test_protect(self):
+        cache = pixbufcache.PixbufCache(200)
+        cache.protect([0, 1])
+        for key in xrange(4):
+            cache.put(key, _Pixbuf(100))
+        self.assertEqual([key for key in xrange(4) if key in cache],
+            [0, 1, 3])
+        cache.protect([3])
+        cache.set_max_size(100)
+        self.assertEqual([key for key in xrange(4) if key in cache], [3])
+        cache.clear()
+        self.assertEqual(cache.get_stats()[2:4], (0, 0))
+
+    def test_put_over_budget(self):
+        # A pixbuf that is put is kept, even with no budget at all, until
+        # the next one takes its place.
+        cache = pixbufcache.PixbufCache(0)
+        cache.put(0, _Pixbuf(100))
+        self.assertTrue(0 in cache)
+        cache.put(1, _Pixbuf(100))
+        self.assertFalse(0 in cache)
+        self.assertTrue(1 in cache)
+
+    def test_stats(self):
+        cache = pixbufcache.PixbufCache(1000)
+        cache.put(0, _Pixbuf(100))
+        cache.put(1, _Animation())
+        self.assertEqual(cache.get(2), None)
+        self.assertTrue(cache.get(0) is not None)
+        self.assertTrue(cache.get(1) is not None)
+        self.assertEqual(cache.get_stats(), (2, 1, 2, 100 + 800, 1000))
+        cache.clear()
+        self.assertEqual(cache.get_stats(), (2, 1, 0, 0, 1000))
+
+    def test_remap(self):
+        cache = pixbufcache.PixbufCache(1000)
+        pixbufs = [_Pixbuf(100) for i in xrange(4)]
+        for key, pixbuf in enumerate(pixbufs):
+            cache.put(key, pixbuf)
+        cache.protect([3])
+        cache.remap({0: 0, 2: 1, 3: 2}.get)
+        self.assertEqual(cache.get_stats()[2:4], (3, 300))
+        self.assertTrue(cache.get(1) is pixbufs[2])
+        self.assertTrue(cache.get(2) is pixbufs[3])
+        # The order of use and the protection follow the pixbufs.
+        cache.set_max_size(100)
+        self.assertEqual([key for key in xrange(4) if key in cache], [2])
+
+    def test_mipmap_levels(self):
+        # Levels built after the pixbuf was put are counted once the
+        # cache is used again.
+        cache = pixbufcache.PixbufCache(1000)
+        pixbuf = _Pixbuf(400)
+        cache.put(0, pixbuf)
+        level = _Pixbuf(100)
+        pixbuf.set_data('comix-mipmap', level)
+        level.set_data('comix-mipmap', _Pixbuf(25))
+        self.assertEqual(cache.get_stats()[3], 525)
+        cache.put(1, _Pixbuf(400))
+        cache.put(2, _Pixbuf(100))
+        self.assertFalse(0 in cache)
+        self.assertEqual(cache.get_stats()[3], 500)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+"""Tests for the random access readers in seekindex.py."""
+
+import os
+import sys
+import bz2
+import gzip
+import random
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'src'))
+
+import seekindex
+
+
+def _make_data(rand, size):
+    """Return <size> bytes of compressible, but not trivial, data."""
+    words = [''.join([chr(rand.randint(97, 122))
+        for i in xrange(rand.randint(1, 12))]) for j in xrange(5000)]
+    pieces = []
+    length = 0
+    while length < size:
+        word = rand.choice(words) + ' '
+        pieces.append(word)
+        length += len(word)
+    return ''.join(pieces)[:size]
+
+
+class _ReaderTest:
+
+    """Reads at random positions compared to the data decompressed in one
+    go. Mixed in with unittest.TestCase below.
+    """
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp(prefix='comix-test.')
+        self._rand = random.Random(1)
+        # Several streams, so that the readers have to move on from one
+        # to the next.
+        self._streams = [_make_data(self._rand, size)
+            for size in (500000, 1, 200000)]
+        self._data = ''.join(self._streams)
+        self._path = os.path.join(self._dir, 'data')
+        self._write()
+        # Plenty of checkpoints, without needing much data.
+        self._gzip_span = seekindex._GZIP_SPAN
+        seekindex._GZIP_SPAN = 0x10000
+
+    def tearDown(self):
+        seekindex._GZIP_SPAN = self._gzip_span
+        shutil.rmtree(self._dir)
+
+    def _check_random_reads(self, reader, count=60):
+        for i in xrange(count):
+            offset = self._rand.randint(0, len(self._data) + 10)
+            size = self._rand.choice((1, 100, 5000, 150000, -1))
+            if self._rand.random() < 0.5:
+                reader.seek(offset)
+            else:
+                reader.seek(offset - reader.tell(), 1)
+            if size < 0:
+                expected = self._data[offset:]
+            else:
+                expected = self._data[offset:offset + size]
+            self.assertEqual(reader.read(size), expected)
+            self.assertEqual(reader.tell(), offset + len(expected))
+
+    def test_sequential(self):
+        reader = self._open()
+        pieces = []
+        piece = reader.read(12345)
+        while piece:
+            pieces.append(piece)
+            piece = reader.read(12345)
+        reader.close()
+        self.assertEqual(''.join(pieces), self._data)
+
+    def test_random_reads(self):
+        reader = self._open()
+        self._check_random_reads(reader)
+        reader.close()
+
+    def test_random_reads_after_scan(self):
+        reader = self._open()
+        reader.scan()
+        self._check_random_reads(reader)
+        reader.close()
+
+
+class GzipReaderTest(_ReaderTest, unittest.TestCase):
+
+    def _write(self):
+        fd = open(self._path, 'wb')
+        for stream in self._streams:
+            gzfile = gzip.GzipFile(fileobj=fd, mode='wb')
+            gzfile.write(stream)
+            gzfile.close()
+        fd.close()
+
+    def _open(self):
+        return seekindex.GzipReader(self._path)
+
+
+class Bzip2ReaderTest(_ReaderTest, unittest.TestCase):
+
+    def _write(self):
+        fd = open(self._path, 'wb')
+        for stream in self._streams:
+            # Small blocks, so that there are many of them.
+            fd.write(bz2.compress(stream, 1))
+        fd.close()
+
+    def _open(self):
+        return seekindex.Bzip2Reader(self._path)
+
+    def test_saved_index(self):
+        reader = self._open()
+        self.assertEqual(reader.get_index(), None)
+        reader.scan()
+        index = reader.get_index()
+        reader.close()
+        self.assertTrue(len([marker for marker in index if marker[2]]) > 5)
+        reader = seekindex.Bzip2Reader(self._path, index)
+        self._check_random_reads(reader)
+        reader.close()
+
+
+if __name__ == '__main__':
+    unittest.main()